@@ -1,9 +1,27 @@
 import pandas as pd
 from pathlib import Path
+from contextlib import nullcontext
+from urllib.parse import urlparse
 import aiohttp
 import asyncio
+import codecs
+import hashlib
+import json
+import os
+import shutil
+import time
+import tracemalloc
 from tqdm.asyncio import tqdm_asyncio
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
+from document_store import write_table
+from instrumentation import metrics
+import argparse
+import instrumentation
+
+# statuses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# bytes read from the network, or characters from the cache, at a time
+CHUNK_SIZE = 64 * 1024
 def clean_text(text):
     """
     remove space and not line
@@ -24,58 +42,352 @@ def clean_text(text):
     cleaned_text = f'"{cleaned_text}"'
 
     return cleaned_text
+
+
+class PrefixCleaner:
+    """clean_text(text)[:limit] of a text that arrives in chunks, without keeping the text
+
+    clean_text turns every run of whitespace (line breaks included) into one space and quotes the result,
+    so the prefix is final as soon as enough whole words are known and later chunks are ignored.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.parts = ['"']
+        self.length = 1
+        self.pending = ''  # word cut by the end of the previous chunk
+        self.done = False
+
+    def add_word(self, word: str) -> None:
+        if self.length > 1:
+            word = ' ' + word
+        self.parts.append(word)
+        self.length += len(word)
+        self.done = self.length >= self.limit
+
+    def feed(self, chunk: str) -> None:
+        if self.done:
+            return
+        text = self.pending + chunk
+        words = text.split()
+        self.pending = words.pop() if words and not text[-1].isspace() else ''
+        for word in words:
+            self.add_word(word)
+            if self.done:
+                return
+        # a whole prefix without whitespace
+        if len(self.pending) >= self.limit:
+            self.add_word(self.pending)
+            self.pending = ''
+
+    def result(self) -> str:
+        if not self.done and self.pending:
+            self.add_word(self.pending)
+            self.pending = ''
+        return (''.join(self.parts) + '"')[:self.limit]
+
+
+class DocumentSink:
+    """Destination of one downloaded body: the full text goes to disk, only the cleaned prefixes stay in memory"""
+    def __init__(self, url: str, file_path: Path, text_limit: int = 4000, raw_limit: int = 8000):
+        self.url = url
+        self.file_path = file_path
+        self.tmp_path = file_path.with_suffix(file_path.suffix + '.part')
+        self.text_limit = text_limit
+        self.raw_limit = raw_limit
+        self.file = None
+        self.length = 0  # characters of the body
+        self.bytes = 0  # bytes received from the network
+
+    def start(self) -> None:
+        """(Re)start receiving the body, a retry discards what the failed attempt wrote"""
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.tmp_path, 'w', encoding='utf-8')
+        self.length = 0
+        self.bytes = 0
+        # text_content is the cleaned "url\ncontent", raw_text_content the cleaned content
+        self.text = PrefixCleaner(self.text_limit)
+        self.text.feed(f"{self.url}\n")
+        self.raw = PrefixCleaner(self.raw_limit)
+
+    def write(self, chunk: str) -> None:
+        self.file.write(chunk)
+        self.length += len(chunk)
+        self.text.feed(chunk)
+        self.raw.feed(chunk)
+
+    def finish(self) -> None:
+        self.file.close()
+        self.file = None
+        os.replace(self.tmp_path, self.file_path)
+
+    def discard(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.tmp_path.unlink(missing_ok=True)
+
+
+class DownloadCache:
+    """Persistent URL-keyed cache of downloaded documents
+
+    Every entry is a body file plus a small JSON metadata file named after the
+    sha256 of the URL, both written atomically as soon as the download ends, so
+    a killed run resumes where it stopped and the same URL is reused across
+    datasets whatever its row index.
+    """
+    def __init__(self, cache_dir: Path, max_age: Optional[float] = None):
+        self.cache_dir = cache_dir
+        self.max_age = max_age  # seconds an entry is trusted without revalidation, None: always fresh
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'stale': 0}
+
+    def key(self, url: str) -> str:
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def paths(self, url: str) -> Tuple[Path, Path]:
+        key = self.key(url)
+        return self.cache_dir / f"{key}.txt", self.cache_dir / f"{key}.json"
+
+    def get(self, url: str) -> Optional[Dict]:
+        """Return the metadata of a complete entry, or None"""
+        body_path, meta_path = self.paths(url)
+        if not (body_path.exists() and meta_path.exists()):
+            return None
+        try:
+            meta = json.loads(meta_path.read_text(encoding='utf-8'))
+        except ValueError:
+            return None
+        return meta if meta.get('url') == url else None
+
+    def is_fresh(self, meta: Dict) -> bool:
+        return self.max_age is None or time.time() - meta['fetched_at'] < self.max_age
+
+    def read(self, url: str) -> str:
+        return self.paths(url)[0].read_text(encoding='utf-8')
+
+    def copy_to(self, url: str, sink: DocumentSink) -> None:
+        """Replay a cached body into a sink, chunk by chunk"""
+        sink.start()
+        with open(self.paths(url)[0], encoding='utf-8') as body:
+            while chunk := body.read(CHUNK_SIZE):
+                sink.write(chunk)
+        sink.finish()
+
+    def conditional_headers(self, meta: Optional[Dict]) -> Dict[str, str]:
+        """Validators for a conditional GET of a stale entry"""
+        headers = {}
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def write_atomic(self, path: Path, text: str) -> None:
+        tmp_path = path.with_suffix(path.suffix + '.tmp')
+        tmp_path.write_text(text, encoding='utf-8')
+        os.replace(tmp_path, path)
+
+    def put(self, url: str, content: str, etag: Optional[str] = None, last_modified: Optional[str] = None) -> None:
+        body_path, meta_path = self.paths(url)
+        # body first: metadata only exists for complete bodies
+        self.write_atomic(body_path, content)
+        self.write_atomic(meta_path, json.dumps({
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched_at': time.time(),
+            'length': len(content),
+        }))
+
+    def put_file(self, url: str, source: Path, length: int,
+                 etag: Optional[str] = None, last_modified: Optional[str] = None) -> None:
+        """Same as put for a body already written to disk"""
+        body_path, meta_path = self.paths(url)
+        tmp_path = body_path.with_suffix(body_path.suffix + '.tmp')
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, body_path)
+        self.write_atomic(meta_path, json.dumps({
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched_at': time.time(),
+            'length': length,
+        }))
+
+    def touch(self, url: str, meta: Dict) -> None:
+        """Mark a revalidated entry as fresh again"""
+        meta['fetched_at'] = time.time()
+        self.write_atomic(self.paths(url)[1], json.dumps(meta))
+
+
 class DatasetProcessor:
-    def __init__(self, min_length: int = 500):
+    def __init__(self,
+                 min_length: int = 500,
+                 max_concurrency: int = 32,
+                 per_host_limit: int = 8,
+                 max_retries: int = 3,
+                 backoff: float = 0.5,
+                 timeout: float = 60,
+                 cache: Optional[DownloadCache] = None,
+                 text_limit: int = 4000,
+                 raw_limit: int = 8000):
         self.min_length = min_length
+        self.max_concurrency = max_concurrency
+        self.per_host_limit = per_host_limit
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.text_limit = text_limit  # characters kept of the cleaned text_content
+        self.raw_limit = raw_limit  # characters kept of the cleaned raw_text_content
         self.valid_files: Dict[int, str] = {}
         self.failed_downloads: List[str] = []
         self.file_paths: Dict[str, str] = {}
+        self.host_stats: Dict[str, Dict[str, float]] = {}
 
+    def create_session(self) -> aiohttp.ClientSession:
+        """One pooled session per run, the connector enforces the global and per-host limits"""
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.per_host_limit)
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
 
-    async def download_file(self, url: str, file_path: Path) -> Tuple[bool, str]:
-        """Download a single file asynchronously"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        content = await response.text()
-                        if len(content) >= self.min_length:
-                            # Save original content
-                            file_path.write_text(content, encoding='utf-8')
-                            # Returns content with URL and original content
-                            content_with_url = f"{url}\n{content}"
-                            return True, (content_with_url, content)
-        except Exception as e:
-            print(f"Error downloading {url}: {e}")
+    def record(self, url: str, key: str, value: float = 1) -> None:
+        """Accumulate a per-host counter"""
+        host = urlparse(url).netloc
+        stats = self.host_stats.setdefault(
+            host, {'requests': 0, 'failures': 0, 'retries': 0, 'bytes': 0, 'seconds': 0.0}
+        )
+        stats[key] += value
+        metrics.count(f"download.{key}", value)
+
+    def host_summary(self) -> pd.DataFrame:
+        """Per-host throughput and latency of the run"""
+        summary = pd.DataFrame.from_dict(self.host_stats, orient='index')
+        if summary.empty:
+            return summary
+        summary['mean_latency_s'] = summary['seconds'] / summary['requests'].clip(lower=1)
+        summary['throughput_kb_s'] = summary['bytes'] / 1024 / summary['seconds'].where(summary['seconds'] > 0)
+        return summary.sort_values('requests', ascending=False)
+
+    async def fetch(self,
+                    session: aiohttp.ClientSession,
+                    url: str,
+                    semaphore: asyncio.Semaphore,
+                    sink: DocumentSink) -> bool:
+        """Stream the document body into sink, from the cache when possible, retrying transient errors with exponential backoff"""
+        meta = self.cache.get(url) if self.cache else None
+        if meta and self.cache.is_fresh(meta):
+            self.cache.stats['hits'] += 1
+            metrics.count("download.cache_hits")
+            self.cache.copy_to(url, sink)
+            return True
+        headers = self.cache.conditional_headers(meta) if self.cache else {}
+
+        transient = True  # False once the server refused the document for good
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.record(url, 'retries')
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            start = time.perf_counter()
+            try:
+                async with semaphore:
+                    async with session.get(url, headers=headers) as response:
+                        # every response is a request, retried and refused ones included
+                        self.record(url, 'requests')
+                        if response.status in RETRY_STATUSES:
+                            self.record(url, 'seconds', time.perf_counter() - start)
+                            continue
+                        if response.status == 304 and meta:
+                            self.record(url, 'seconds', time.perf_counter() - start)
+                            self.cache.stats['revalidated'] += 1
+                            metrics.count("download.cache_revalidated")
+                            self.cache.touch(url, meta)
+                            self.cache.copy_to(url, sink)
+                            return True
+                        if response.status != 200:
+                            self.record(url, 'seconds', time.perf_counter() - start)
+                            transient = False
+                            break
+                        # decoded as it arrives, a character split between two chunks is completed by the next one
+                        decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+                        sink.start()
+                        async for block in response.content.iter_chunked(CHUNK_SIZE):
+                            sink.bytes += len(block)
+                            sink.write(decoder.decode(block))
+                        sink.write(decoder.decode(b'', final=True))
+                        etag = response.headers.get('ETag')
+                        last_modified = response.headers.get('Last-Modified')
+                sink.finish()
+                self.record(url, 'seconds', time.perf_counter() - start)
+                self.record(url, 'bytes', sink.bytes)
+                if self.cache:
+                    self.cache.stats['misses'] += 1
+                    metrics.count("download.cache_misses")
+                    self.cache.put_file(url, sink.file_path, sink.length, etag, last_modified)
+                return True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Error downloading {url} (attempt {attempt + 1}): {e!r}")
+            except Exception as e:
+                print(f"Error downloading {url}: {e}")
+                transient = False
+                break
+        if meta and transient:
+            # the server could not be reached to revalidate a stale entry, its last copy is still the document
+            print(f"Serving the cached copy of {url}, revalidation failed")
+            self.cache.stats['stale'] += 1
+            metrics.count("download.cache_stale")
+            self.cache.copy_to(url, sink)
+            return True
+        sink.discard()
+        self.record(url, 'failures')
+        self.failed_downloads.append(url)
+        return False
+
+    async def download_file(self,
+                            session: aiohttp.ClientSession,
+                            url: str,
+                            file_path: Path,
+                            semaphore: Optional[asyncio.Semaphore] = None) -> Tuple[bool, Tuple[str, str]]:
+        """Download a single file to disk, returning its cleaned (text_content, raw_text_content) prefixes"""
+        semaphore = semaphore or asyncio.Semaphore(self.max_concurrency)
+        sink = DocumentSink(url, file_path, self.text_limit, self.raw_limit)
+        with metrics.span("download.document"):
+            downloaded = await self.fetch(session, url, semaphore, sink)
+        if downloaded and sink.length >= self.min_length:
+            metrics.count("download.documents_valid")
+            return True, (sink.text.result(), sink.raw.result())
+        if downloaded:
+            # too short to be a document
+            file_path.unlink(missing_ok=True)
         return False, ("", "")
 
     async def process_dataset(self,
                               dataset: pd.DataFrame,
-                              output_dir: Path) -> pd.DataFrame:
-        """Process the entire dataset"""
+                              output_dir: Path,
+                              session: Optional[aiohttp.ClientSession] = None) -> pd.DataFrame:
+        """Process the entire dataset, or one chunk of it when a shared session is given"""
         output_dir.mkdir(exist_ok=True)
 
-        # Prepare download task
-        tasks = []
-        for idx, url in dataset['text version'].items():
-            file_path = output_dir / f"dataset_pdf_{idx}.txt"
-            tasks.append(self.download_file(url, file_path))
-
-        # Concurrent downloads
-        results = await tqdm_asyncio.gather(*tasks)
+        # Bounded concurrent downloads over a single pooled session
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with (nullcontext(session) if session else self.create_session()) as session:
+            tasks = []
+            for idx, url in dataset['text version'].items():
+                file_path = output_dir / f"dataset_pdf_{idx}.txt"
+                tasks.append(self.download_file(session, url, file_path, semaphore))
+            with metrics.span("download", documents=len(tasks)):
+                results = await tqdm_asyncio.gather(*tasks)
 
         # Processing results
         valid_mask = pd.Series(False, index=dataset.index)
         text_contents = {}
         raw_text_contents = {}
 
-        for idx, (success, (content_with_url, raw_content)) in enumerate(results):
+        for idx, (success, (text_content, raw_text_content)) in zip(dataset.index, results):
             if success:
-                valid_mask.iloc[idx] = True
-                content_with_url = clean_text(content_with_url)
-                text_contents[idx] = content_with_url[:4000]
-                raw_content = clean_text(raw_content)
-                raw_text_contents[idx] = raw_content[:8000]
+                valid_mask.loc[idx] = True
+                text_contents[idx] = text_content
+                raw_text_contents[idx] = raw_text_content
 
         # Update the dataset
         dataset_valid = dataset[valid_mask].copy()
@@ -84,10 +396,116 @@ class DatasetProcessor:
         ]
         dataset_valid['text_content'] = dataset_valid.index.map(text_contents)
         dataset_valid['raw_text_content'] = dataset_valid.index.map(raw_text_contents)
+        metrics.memory("download")
 
         return dataset_valid
 
+
+def serve_documents(sizes_mb: List[int], port_queue) -> None:
+    """Local test server, in its own process so its buffers are not counted: GET /<size>/<i> returns <size> MB of text"""
+    from aiohttp import web
+
+    paragraph = ("Le conseil municipal, après en avoir délibéré à l'unanimité, approuve la convention. \n"
+                 "   Séance du 16 janvier 2023    Envoyé en préfecture le 20/01/2023\n\n")
+    bodies = {size: (paragraph * (size * 1024 ** 2 // len(paragraph.encode('utf-8')) + 1)).encode('utf-8')
+              for size in sizes_mb}
+
+    async def document(request: web.Request) -> web.Response:
+        return web.Response(body=bodies[int(request.match_info['size'])], content_type='text/plain', charset='utf-8')
+
+    async def run() -> None:
+        app = web.Application()
+        app.router.add_get('/{size}/{i}', document)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port_queue.put(runner.addresses[0][1])
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+async def benchmark_memory(sizes_mb: List[int], docs: int = 4, work_dir: Path = Path("./benchmark_download")) -> pd.DataFrame:
+    """Peak Python memory and time of `docs` concurrent downloads per size, whole-body (before) vs streamed"""
+    import multiprocessing
+
+    context = multiprocessing.get_context('spawn')
+    port_queue = context.Queue()
+    server = context.Process(target=serve_documents, args=(sizes_mb, port_queue), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get()}"
+    work_dir.mkdir(parents=True, exist_ok=True)
+    processor = DatasetProcessor()
+
+    async def whole_body(session: aiohttp.ClientSession, url: str, file_path: Path) -> Tuple[str, str]:
+        # what download_file and process_dataset did before streaming
+        async with session.get(url) as response:
+            content = await response.text()
+        file_path.write_text(content, encoding='utf-8')
+        content_with_url = f"{url}\n{content}"
+        return clean_text(content_with_url)[:4000], clean_text(content)[:8000]
+
+    async def streamed(session: aiohttp.ClientSession, url: str, file_path: Path) -> Tuple[str, str]:
+        return (await processor.download_file(session, url, file_path))[1]
+
+    rows = []
+    try:
+        async with processor.create_session() as session:
+            for size in sizes_mb:
+                outputs = {}
+                for mode, download in (('whole body', whole_body), ('streamed', streamed)):
+                    urls = [f"{base_url}/{size}/{i}" for i in range(docs)]
+                    tracemalloc.start()
+                    start = time.perf_counter()
+                    outputs[mode] = await asyncio.gather(*[
+                        download(session, url, work_dir / f"{mode.replace(' ', '_')}_{i}.txt") for i, url in enumerate(urls)
+                    ])
+                    elapsed = time.perf_counter() - start
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    rows.append({'size_mb': size, 'docs': docs, 'mode': mode,
+                                 'peak_mb': peak / 1024 ** 2, 'seconds': elapsed})
+                rows[-1]['same_output'] = outputs['whole body'] == outputs['streamed']
+    finally:
+        server.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return pd.DataFrame(rows)
+
+
+def add_download_arguments(parser: argparse.ArgumentParser) -> None:
+    """Download cache, concurrency and retry options, shared with pipeline.py"""
+    parser.add_argument("--cache_dir", type=str, default="./download_cache",
+                        help="Downloaded documents, reused by later runs of any dataset")
+    parser.add_argument("--cache_max_age", type=float, default=None,
+                        help="Seconds a cached document is trusted before it is revalidated (default: never revalidated)")
+    parser.add_argument("--max_concurrency", type=int, default=32, help="Downloads in flight")
+    parser.add_argument("--per_host_limit", type=int, default=8, help="Downloads in flight per host")
+    parser.add_argument("--max_retries", type=int, default=3, help="Retries of a timeout, 429 or 5xx")
+    parser.add_argument("--backoff", type=float, default=0.5, help="Seconds before the first retry, doubled each time")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds per download attempt")
+
+
+def processor_from_args(args: argparse.Namespace) -> DatasetProcessor:
+    return DatasetProcessor(max_concurrency=args.max_concurrency, per_host_limit=args.per_host_limit,
+                            max_retries=args.max_retries, backoff=args.backoff, timeout=args.timeout,
+                            cache=DownloadCache(Path(args.cache_dir), max_age=args.cache_max_age))
+
+
 async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark_memory", type=int, nargs="+", default=None, metavar="MB",
+                        help="Compare memory of whole-body and streamed downloads of documents of these sizes, and exit")
+    parser.add_argument("--benchmark_docs", type=int, default=4, help="Concurrent documents per size")
+    add_download_arguments(parser)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args(args)
+    if args.benchmark_memory:
+        result = await benchmark_memory(args.benchmark_memory, args.benchmark_docs)
+        print(result.to_string(index=False, float_format="%.2f"))
+        return
+
     # configuration
     ## if you want to run the whole dataset, please change the path here
 
@@ -95,21 +513,30 @@ async def main():
 
     dataset_path = Path("./dataset_200example.csv")
     output_dir = Path("./txt")
+    # dataset_valid.parquet or dataset_valid.arrow write a columnar file instead (see document_store.py)
+    output_path = Path("./dataset_valid.csv")
 
     # Loading data
     data = pd.read_csv(dataset_path)
 
-    # Processing Data
-    processor = DatasetProcessor()
+    # Processing Data, documents already fetched by a previous run (of any dataset) come from the cache
+    processor = processor_from_args(args)
+    cache = processor.cache
     dataset_valid = await processor.process_dataset(data, output_dir)
 
     # Save the results
-    dataset_valid.to_csv("dataset_valid.csv", index=False)
-    print(f"Valid entries: {len(dataset_valid)}")
+    write_table(dataset_valid, output_path)
+    print(f"Valid entries: {len(dataset_valid)}, saved to {output_path}")
+    print(f"Failed downloads: {len(processor.failed_downloads)}")
+    print(f"Download cache: {cache.stats['hits']} hits, {cache.stats['revalidated']} revalidated, "
+          f"{cache.stats['misses']} misses, {cache.stats['stale']} stale copies served")
+    print("\nPer-host download stats:")
+    print(processor.host_summary().to_string())
     print("\nSample with URL:")
     print(dataset_valid['text_content'].head(1))
     print("\nSample without URL:")
     print(dataset_valid['raw_text_content'].head(1))
+    metrics.finish()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,29 +1,30 @@
-from transformers import AutoTokenizer, AutoModelForTokenClassification, pipeline
+# torch and transformers are imported where the model is used: --help, the rules mode and the worker
+# client start without them
 import pandas as pd
 from pathlib import Path
-from typing import List, Dict, Tuple
-import torch
-from torch.utils.data import Dataset, DataLoader
+from typing import Callable, List, Dict, Optional, Tuple
 from tqdm import tqdm
 import logging
 import sys
 import gc
+import ast
+import importlib
+import importlib.util
+import io
+import os
+import re
+import subprocess
+import time
+import numpy as np
+import dedup
+import ner_worker
+from document_store import read_table, write_table
+from instrumentation import metrics
+import instrumentation
+from result_store import ResultStore, config_hash, content_hash
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('ner_processing.log'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
-
-def print_gpu_utilization():
-    if torch.cuda.is_available():
-        logging.info(f"GPU utilization: {torch.cuda.utilization()}%")
-        logging.info(f"Memory allocated: {torch.cuda.memory_allocated() / 1024**2:.2f} MB")
-
-class TextDataset(Dataset):
+class TextDataset:
+    """Map-style dataset of the DataLoader"""
     def __init__(self, dataframe: pd.DataFrame):
         self.data = dataframe
         logging.info(f"Dataset initialized with {len(dataframe)} rows")
@@ -45,58 +46,308 @@ def custom_collate_fn(batch: List[Tuple[str, str, str]]) -> Tuple[List[str], Lis
     file_names, texts, urls = zip(*batch)
     return list(file_names), list(texts), list(urls)
 
+date_cleaning = importlib.import_module("5_clean_date")
+
+# columns written by the extractors, copied from their representative to the duplicates
+TIME_COLUMNS = ['time_list', 'time_groups', 'time_offsets']
+MAX_CANDIDATES = 15  # distinct dates kept per document
+
+def is_candidate(date: str) -> bool:
+    return 5 < len(date) < 20 and "à" not in date and any(char.isdigit() for char in date)
+
+def group_dates(spans: List[Tuple[str, int, int]]) -> Tuple[List[str], List[Dict], List[List]]:
+    """Candidate occurrences (date, start, end) grouped by normalized date, in order of first appearance
+
+    Returns the time_list (one surface form per distinct date), the time_groups
+    ({'date': '01/12/2023', 'forms': ['le 01/12/2023', '1er décembre 2023'], 'first': 1520, 'count': 3})
+    and the time_offsets ([date, start, end] of every occurrence of a kept date).
+    """
+    groups: Dict[str, Dict] = {}
+    time_list = []
+    offsets = []
+    for date, start, end in spans:
+        if not is_candidate(date):
+            continue
+        key, form = date_cleaning.candidate_key(date)
+        group = groups.get(key)
+        if group is None:
+            if len(groups) == MAX_CANDIDATES:
+                continue
+            group = groups[key] = {'date': key, 'forms': [], 'first': start, 'count': 0}
+            time_list.append(form)
+        if date not in group['forms']:
+            group['forms'].append(date)
+        group['count'] += 1
+        offsets.append([date, start, end])
+    return time_list, list(groups.values()), offsets
+
+def filter_dates(dates: List[str]) -> List[str]:
+    """Filtering and cleaning dates, one per distinct date"""
+    return group_dates([(date, 0, len(date)) for date in dates])[0]
+
+class RuleDateExtractor:
+    """Regex fast path producing the same time_list as the NER model, without loading a transformer"""
+    def __init__(self):
+        # the date formats the cleaning step understands, compiled into a single alternation
+        clean_date_module = importlib.import_module("5_clean_date")
+        self.clean_date = clean_date_module.clean_date
+        self.pattern = re.compile(
+            '|'.join(f'(?:{pattern})' for pattern in clean_date_module.date_patterns),
+            re.IGNORECASE
+        )
+
+    def extract_spans(self, text: str) -> List[Tuple[str, int, int]]:
+        """(date, start, end) of every match, in order of appearance"""
+        if not isinstance(text, str):
+            return []
+        return [(match.group(0), match.start(), match.end()) for match in self.pattern.finditer(text)]
+
+    def extract(self, text: str) -> List[str]:
+        """Scan a text once and return its candidate dates in order of appearance"""
+        return group_dates(self.extract_spans(text))[0]
+
+    def process_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        with metrics.span("ner.rules", documents=len(df)):
+            grouped = [group_dates(self.extract_spans(text)) for text in df['raw_text_content']]
+            df['time_list'] = [time_list for time_list, _, _ in grouped]
+            df['time_groups'] = [groups for _, groups, _ in grouped]
+            df['time_offsets'] = [offsets for _, _, offsets in grouped]
+        metrics.count("ner.documents", len(df))
+        metrics.count("ner.candidates", sum(map(len, df['time_list'])))
+        logging.info(f"Rules found dates in {sum(map(bool, df['time_list']))}/{len(df)} files")
+        return df
+
+    def compare_with_model(self, df: pd.DataFrame, text_column: str = 'context') -> Dict[str, float]:
+        """Recall overlap between rule candidates and the model's time_list, after date normalization"""
+        model_total = covered = docs_fully_covered = docs_without_rules = 0
+        gold_in_rules = gold_in_model = 0
+        for text, time_list, gold in zip(df[text_column], df['time_list'], df['Gold_label']):
+            rule_dates = {self.clean_date(date) for date in self.extract(text)} - {None}
+            model_dates = {self.clean_date(date) for date in parse_time_list(time_list)} - {None}
+            gold_date = self.clean_date(str(gold))
+            model_total += len(model_dates)
+            covered += len(model_dates & rule_dates)
+            docs_fully_covered += model_dates <= rule_dates
+            docs_without_rules += not rule_dates
+            gold_in_rules += gold_date in rule_dates
+            gold_in_model += gold_date in model_dates
+        n_docs = max(len(df), 1)
+        return {
+            'documents': len(df),
+            'model_dates_recalled_by_rules': covered / max(model_total, 1),
+            'documents_fully_covered': docs_fully_covered / n_docs,
+            'documents_without_rule_dates': docs_without_rules / n_docs,
+            'gold_in_rule_candidates': gold_in_rules / n_docs,
+            'gold_in_model_candidates': gold_in_model / n_docs,
+        }
+
+def parse_time_list(time_list) -> List[str]:
+    """time_list as read back from a csv: the repr of a python list"""
+    if isinstance(time_list, list):
+        return time_list
+    try:
+        return list(ast.literal_eval(time_list))
+    except (ValueError, SyntaxError):
+        return re.findall(r"'([^']*)'", str(time_list))
+
+def logits_only(model) -> 'torch.nn.Module':
+    """The model with positional inputs and a plain tensor output, so that it can be traced"""
+    import torch
+
+    class LogitsOnly(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+    return LogitsOnly(model)
+
+# a short, a long and a padded sentence: optimize_for_cpu checks the traced graph labels them like eager mode
+PARITY_TEXTS = [
+    "Séance du 16 janvier 2023",
+    "Délibération du conseil municipal du 12 mars 2023, publiée le 15/03/2023 et transmise en préfecture "
+    "le 16 mars 2023. " * 8,
+    "Arrêté n° 2023-114 du 1er décembre 2023, affiché le 04/12/2023",
+]
+
 class OptimizedNERProcessor:
     def __init__(
             self,
             model_name: str = "Jean-Baptiste/camembert-ner-with-dates",
-            device: str = "cuda" if torch.cuda.is_available() else "cpu",
+            device: Optional[str] = None,
             batch_size: int = 64,
-            num_workers: int = 8
+            num_workers: int = 8,
+            stride: int = 128,
+            max_windows_per_forward: Optional[int] = None,
+            store: Optional[ResultStore] = None,
+            quantize: bool = False,
+            torchscript: bool = False
     ):
-        self.device = device
+        import torch
+        from transformers import AutoTokenizer, AutoModelForTokenClassification
+
+        self.model_name = model_name
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
         self.batch_size = batch_size
         self.num_workers = num_workers
-        self.max_length = 512  # tokenizer maximum length
+        self.max_length = 512  # tokenizer maximum length, in tokens
+        self.stride = stride  # tokens shared by two consecutive windows
+        self.max_windows_per_forward = max_windows_per_forward  # None: one forward pass per batch
+        self.store = store  # per-document checkpoints, None: no checkpointing
+        self.quantize = quantize  # int8 dynamic quantization of the linear layers, CPU only
+        self.torchscript = torchscript  # frozen TorchScript graph
+        self.forward = None  # (input_ids, attention_mask) -> logits
+        self.groups: Dict[str, List[Dict]] = {}  # local_filename -> time_groups
+        self.offsets: Dict[str, List[List]] = {}  # local_filename -> time_offsets
 
-        logging.info(f"Initializing NER processor with device: {device}")
+        logging.info(f"Initializing NER processor with device: {self.device}")
         try:
             self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-            self.model = AutoModelForTokenClassification.from_pretrained(model_name).to(device)
-
-            self.nlp = pipeline(
-                task='ner',
-                model=self.model,
-                tokenizer=self.tokenizer,
-                device=0 if device == "cuda" else -1,
-                aggregation_strategy='simple'
-            )
+            self.model = AutoModelForTokenClassification.from_pretrained(model_name).to(self.device)
+            self.model.eval()
+            self.max_length = min(self.max_length, self.tokenizer.model_max_length)
+            if not 0 <= self.stride < self.max_length // 2:
+                raise ValueError(f"stride must be in [0, {self.max_length // 2}), got {self.stride}")
+            self.forward = self.optimize_for_cpu() if quantize or torchscript else logits_only(self.model)
             logging.info("Model loaded successfully")
-            print_gpu_utilization()
+            metrics.memory("ner")
 
         except Exception as e:
             logging.error(f"Error initializing model: {e}")
             raise
 
-    def process_text(self, text: str) -> List[str]:
-        """Process a single text and return a list of dates"""
-        try:
-            # Process long text in chunks
-            dates = []
-            chunks = [text[i:i + self.max_length] for i in range(0, len(text), self.max_length)]
+    def optimize_for_cpu(self) -> 'torch.nn.Module':
+        """int8 weights for the linear layers (most of the compute) and/or a frozen TorchScript graph"""
+        import torch
+        if self.device != "cpu":
+            raise ValueError(f"quantize/torchscript are CPU optimizations, got device {self.device}")
+        parity = self.tokenizer(PARITY_TEXTS, max_length=self.max_length, truncation=True, padding=True,
+                                return_tensors='pt')
+        parity_inputs = (parity['input_ids'], parity['attention_mask'])
+        tokens = parity['attention_mask'].bool()
+
+        def labels(module) -> 'torch.Tensor':
+            with torch.no_grad():
+                return module(*parity_inputs).argmax(dim=-1)[tokens]
+
+        if self.quantize:
+            fp32_labels = labels(logits_only(self.model).eval())
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            # int8 is an approximation: report how far it moves the labels, --benchmark_cpu measures the time_list
+            agreement = (labels(logits_only(self.model).eval()) == fp32_labels).float().mean().item()
+            logging.info(f"int8 model: {agreement:.1%} of the parity tokens keep their fp32 label")
+        module = logits_only(self.model).eval()
+        if self.torchscript:
+            # sizes are recorded as operations, so a short example also serves longer and batched windows
+            example = self.tokenizer(PARITY_TEXTS[:1], return_tensors='pt')
+            with torch.no_grad():
+                traced = torch.jit.freeze(torch.jit.trace(
+                    module, (example['input_ids'], example['attention_mask']), check_trace=False
+                ))
+            # the trace is only checked on the example, so compare it with eager mode on longer and padded inputs
+            if torch.equal(labels(traced), labels(module)):
+                module = traced
+            else:
+                logging.warning("The TorchScript graph labels the parity texts differently from eager mode, "
+                                "running in eager mode")
+                self.torchscript = False
+        logging.info(f"CPU optimizations: quantize={self.quantize}, torchscript={self.torchscript}, "
+                     f"{torch.get_num_threads()} intra-op threads")
+        return module
+
+    def encode_windows(self, texts: List[str]):
+        """Cut every text into overlapping token windows, padded into a single tensor batch"""
+        return self.tokenizer(
+            texts,
+            max_length=self.max_length,
+            stride=self.stride,
+            truncation=True,
+            padding=True,
+            return_overflowing_tokens=True,
+            return_offsets_mapping=True,
+            return_special_tokens_mask=True,
+            return_tensors='pt'
+        )
 
-            for chunk in chunks:
-                with torch.no_grad():
-                    results = self.nlp(chunk)
+    def extract_entities(self, texts: List[str]) -> List[List[Dict]]:
+        """Run the model over all windows of all texts and return entities with document offsets"""
+        import torch
+        texts = [text if isinstance(text, str) else "" for text in texts]
+        encoding = self.encode_windows(texts)
+        sample_mapping = encoding.pop('overflow_to_sample_mapping').tolist()
+        offsets = encoding.pop('offset_mapping').tolist()
+        valid = encoding['attention_mask'].bool() & ~encoding.pop('special_tokens_mask').bool()
 
-                    chunk_dates = [
-                        item['word']
-                        for item in results
-                        if isinstance(item, dict)
-                           and item.get('entity_group') == 'DATE'
-                    ]
-                    dates.extend(chunk_dates)
+        n_windows = len(sample_mapping)
+        metrics.count("ner.windows", n_windows)
+        step = self.max_windows_per_forward or n_windows
+        probabilities = []
+        with torch.no_grad(), metrics.span("ner.forward", documents=len(texts), windows=n_windows):
+            for start in range(0, n_windows, step):
+                inputs = {key: value[start:start + step].to(self.device) for key, value in encoding.items()}
+                logits = self.forward(inputs['input_ids'], inputs['attention_mask'])
+                probabilities.append(torch.softmax(logits.float(), dim=-1).cpu())
+        scores, label_ids = torch.cat(probabilities).max(dim=-1)
 
-            return self.filter_dates(dates)
+        # A token seen by two windows keeps the prediction of the window where it is furthest from the edge
+        tokens: List[Dict[int, Tuple[int, int, int, float]]] = [{} for _ in texts]
+        for window, doc in enumerate(sample_mapping):
+            positions = valid[window].nonzero().flatten().tolist()
+            for rank, position in enumerate(positions):
+                token_start, token_end = offsets[window][position]
+                if token_end <= token_start:
+                    continue
+                distance = min(rank, len(positions) - 1 - rank)
+                previous = tokens[doc].get(token_start)
+                if previous is None or distance > previous[0]:
+                    tokens[doc][token_start] = (
+                        distance, label_ids[window, position].item(), token_end, scores[window, position].item()
+                    )
+
+        return [self.group_entities(text, doc_tokens) for text, doc_tokens in zip(texts, tokens)]
+
+    def group_entities(self, text: str, tokens: Dict[int, Tuple[int, int, int, float]]) -> List[Dict]:
+        """Merge consecutive tokens of the same entity type, like the pipeline 'simple' aggregation"""
+        entities = []
+        current = None
+        for token_start in sorted(tokens):
+            _, label_id, token_end, score = tokens[token_start]
+            tag, _, group = self.model.config.id2label[label_id].rpartition('-')
+            if group == 'O':
+                current = None
+            elif current is not None and current['entity_group'] == group and tag != 'B':
+                current['end'] = token_end
+                current['scores'].append(score)
+            else:
+                current = {'entity_group': group, 'start': token_start, 'end': token_end, 'scores': [score]}
+                entities.append(current)
+
+        for entity in entities:
+            word = text[entity['start']:entity['end']]
+            entity['start'] += len(word) - len(word.lstrip())
+            entity['word'] = word.strip()
+            scores = entity.pop('scores')
+            entity['score'] = sum(scores) / len(scores)
+        return entities
+
+    def extract_date_spans(self, texts: List[str]) -> List[List[Tuple[str, int, int]]]:
+        """(date, start, end) of every DATE entity of each text, in order of appearance"""
+        return [
+            [(item['word'], item['start'], item['start'] + len(item['word']))
+             for item in entities if item['entity_group'] == 'DATE']
+            for entities in self.extract_entities(texts)
+        ]
+
+    def process_texts(self, texts: List[str]) -> List[List[str]]:
+        """Process several texts in one forward pass and return a list of dates for each"""
+        return [self.filter_dates([date for date, _, _ in spans]) for spans in self.extract_date_spans(texts)]
+
+    def process_text(self, text: str) -> List[str]:
+        """Process a single text and return a list of dates"""
+        try:
+            return self.process_texts([text])[0]
 
         except Exception as e:
             logging.error(f"Error processing text: {str(e)}")
@@ -104,32 +355,62 @@ class OptimizedNERProcessor:
 
     def filter_dates(self, dates: List[str]) -> List[str]:
         """Filtering and cleaning dates"""
-        filtered_dates = [
-            date for date in dates
-            if 5 < len(date) < 20
-               and "à" not in date
-               and any(char.isdigit() for char in date)
-        ]
-        # Remove duplicates and keep order
-        return list(dict.fromkeys(filtered_dates))[:15]
+        return filter_dates(dates)
 
     def process_batch(self, file_names: List[str], texts: List[str], urls: List[str]) -> Dict[str, List[str]]:
-        """Process a batch of text, returning a mapping from filenames to lists of dates"""
+        """Process a batch of text, returning a mapping from filenames to lists of dates
+
+        The groups and offsets of the dates of each text are kept in self.groups and self.offsets.
+        """
+        try:
+            with metrics.span("ner.batch", documents=len(texts)):
+                batch_spans = self.extract_date_spans(texts)
+        except Exception as e:
+            metrics.count("ner.batch_errors")
+            logging.error(f"Error processing batch {file_names[0]}..{file_names[-1]}: {e}")
+            # fall back to one document at a time so a single bad text does not empty the batch
+            batch_spans = []
+            for text in texts:
+                try:
+                    batch_spans.extend(self.extract_date_spans([text]))
+                except Exception as e:
+                    logging.error(f"Error processing text: {str(e)}")
+                    batch_spans.append([])
+
         results = {}
-        for fname, text, url in zip(file_names, texts, urls):
-            try:
-                dates = self.process_text(text)
-                logging.info(f"File: {fname}, Found {len(dates)} dates")
-                results[fname] = dates
-            except Exception as e:
-                logging.error(f"Error processing file {fname}: {e}")
-                results[fname] = []
+        for fname, spans in zip(file_names, batch_spans):
+            results[fname], self.groups[fname], self.offsets[fname] = group_dates(spans)
+            logging.info(f"File: {fname}, Found {len(results[fname])} dates")
+        metrics.count("ner.documents", len(results))
+        metrics.count("ner.candidates", sum(map(len, results.values())))
         return results
 
+    def stage_config(self) -> Dict[str, object]:
+        """Everything that changes the time_list of a document"""
+        return {'model': self.model_name, 'max_length': self.max_length, 'stride': self.stride, 'quantize': self.quantize,
+                'candidates': 'normalized', 'max_candidates': MAX_CANDIDATES}
+
     def process_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
         """Processing the entire DataFrame"""
+        import torch
+        from torch.utils.data import DataLoader
         try:
-            dataset = TextDataset(df[['local_filename', 'raw_text_content', 'text version']])
+            all_results = {}
+            todo = df
+            if self.store is not None:
+                # only documents without a checkpoint for this configuration are processed
+                config = config_hash(self.stage_config())
+                hash_by_file = {
+                    fname: content_hash(text) for fname, text in zip(df['local_filename'], df['raw_text_content'])
+                }
+                cached = self.store.get_many('ner', config, hash_by_file.values())
+                for fname, h in hash_by_file.items():
+                    if h in cached:
+                        all_results[fname], self.groups[fname], self.offsets[fname] = cached[h]
+                todo = df[~df['local_filename'].isin(all_results)]
+                logging.info(f"{len(all_results)} files already processed, {len(todo)} to process")
+
+            dataset = TextDataset(todo[['local_filename', 'raw_text_content', 'text version']])
             dataloader = DataLoader(
                 dataset,
                 batch_size=self.batch_size,
@@ -139,52 +420,356 @@ class OptimizedNERProcessor:
                 pin_memory=True
             )
 
-            all_results = {}
             for file_names, raw_texts, urls in tqdm(dataloader, desc="Processing files"):
                 batch_results = self.process_batch(file_names, raw_texts, urls)
                 all_results.update(batch_results)
+                if self.store is not None:
+                    self.store.put_many('ner', config, [
+                        (hash_by_file[fname], fname, [dates, self.groups[fname], self.offsets[fname]])
+                        for fname, dates in batch_results.items()
+                    ])
 
                 if len(all_results) % 50 == 0:
-                    print_gpu_utilization()
+                    metrics.memory("ner")
                     if torch.cuda.is_available():
                         torch.cuda.empty_cache()
                         gc.collect()
 
             df['time_list'] = df['local_filename'].map(all_results)
+            df['time_groups'] = df['local_filename'].map(self.groups)
+            df['time_offsets'] = df['local_filename'].map(self.offsets)
             return df
 
         except Exception as e:
             logging.error(f"Error in process_dataframe: {e}")
             raise
 
+def extract_time_lists(df: pd.DataFrame, mode: str, make_processor: Callable[[], OptimizedNERProcessor]) -> pd.DataFrame:
+    """Fill the time_list column with the "model", "rules" or "hybrid" candidate extractor"""
+    if mode in ("rules", "hybrid"):
+        df = RuleDateExtractor().process_dataframe(df)
+    if mode == "rules":
+        return df
+    if mode == "model":
+        return make_processor().process_dataframe(df)
+
+    to_model = df['time_list'].str.len() == 0
+    if to_model.any():
+        logging.info(f"Running the model on {to_model.sum()} files without rule dates")
+        model_df = make_processor().process_dataframe(df[to_model].copy())
+        for column in TIME_COLUMNS:
+            model_values = dict(zip(model_df['local_filename'], model_df[column]))
+            df[column] = [model_values.get(fname, value) for fname, value in zip(df['local_filename'], df[column])]
+    return df
+
+def model_size_mb(model: 'torch.nn.Module') -> float:
+    """Serialized size of the weights, the memory a worker needs for them"""
+    import torch
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024 ** 2
+
+def benchmark_cpu(df: pd.DataFrame, model_name: str, batch_size: int = 16, threads: Optional[int] = None) -> pd.DataFrame:
+    """Throughput, per-document latency, weight size and time_list parity with fp32 of the CPU variants"""
+    import torch
+    if threads:
+        torch.set_num_threads(threads)
+    column = next(col for col in ('raw_text_content', 'text_content', 'context') if col in df.columns)
+    texts = [text if isinstance(text, str) else "" for text in df[column]]
+    rows = []
+    reference = None
+    for name, quantize, torchscript in (('fp32', False, False), ('fp32 traced', False, True),
+                                  ('int8', True, False), ('int8 traced', True, True)):
+        processor = OptimizedNERProcessor(model_name, device="cpu", batch_size=batch_size, num_workers=0,
+                                          quantize=quantize, torchscript=torchscript)
+        processor.process_texts(texts[:2])  # warm-up
+        start = time.perf_counter()
+        time_lists = []
+        for batch_start in range(0, len(texts), batch_size):
+            time_lists.extend(processor.process_texts(texts[batch_start:batch_start + batch_size]))
+        elapsed = time.perf_counter() - start
+        latencies = []
+        for text in texts[:50]:
+            text_start = time.perf_counter()
+            processor.process_texts([text])
+            latencies.append(time.perf_counter() - text_start)
+
+        reference = reference or time_lists
+        reference_dates = sum(len(set(dates)) for dates in reference)
+        recalled = sum(len(set(dates) & set(ref)) for dates, ref in zip(time_lists, reference))
+        rows.append({
+            'variant': name,
+            'docs_per_s': len(texts) / elapsed,
+            'p50_ms': float(np.percentile(latencies, 50) * 1000),
+            'p99_ms': float(np.percentile(latencies, 99) * 1000),
+            'weights_mb': model_size_mb(processor.model),
+            'identical_time_lists': sum(a == b for a, b in zip(time_lists, reference)) / max(len(texts), 1),
+            'fp32_dates_recalled': recalled / max(reference_dates, 1),
+        })
+        del processor
+        gc.collect()
+    result = pd.DataFrame(rows)
+    result['speedup'] = result['docs_per_s'] / result['docs_per_s'].iloc[0]
+    return result
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """"i/N" -> (i, N), shards are numbered from 0"""
+    index, count = (int(part) for part in value.split('/'))
+    if not 0 <= index < count:
+        raise ValueError(f"shard index must be in [0, {count}), got {value}")
+    return index, count
+
+def take_shard(df: pd.DataFrame, index: int, count: int) -> pd.DataFrame:
+    """Contiguous slice `index` of `count`, remembering the original row positions for the merge"""
+    df = df.assign(shard_row=range(len(df)))
+    return df.iloc[index * len(df) // count:(index + 1) * len(df) // count].copy()
+
+def shard_path(output_path: Path, index: int, count: int, shard_dir: Path) -> Path:
+    return shard_dir / f"{output_path.stem}.shard{index:03d}of{count:03d}{output_path.suffix}"
+
+def write_atomic(df: pd.DataFrame, path: Path) -> None:
+    """A shard file only exists once complete, so a crashed worker is never merged"""
+    tmp_path = path.with_name(f".{path.stem}.tmp{path.suffix}")
+    write_table(df, tmp_path)
+    os.replace(tmp_path, path)
+
+def merge_shards(output_path: Path, count: int, shard_dir: Path) -> pd.DataFrame:
+    """Concatenate the shards of every worker, on this machine or others, back in the original row order"""
+    paths = [shard_path(output_path, index, count, shard_dir) for index in range(count)]
+    missing = [str(path) for path in paths if not path.exists()]
+    if missing:
+        raise FileNotFoundError(f"{len(missing)} shard(s) not finished: {', '.join(missing)}")
+    df = pd.concat([read_table(path) for path in paths], ignore_index=True)
+    if sorted(df['shard_row']) != list(range(len(df))):
+        raise ValueError("Shards overlap or have gaps: were they made from the same input?")
+    return df.sort_values('shard_row', kind='stable').drop(columns='shard_row').reset_index(drop=True)
+
+def launch_local_shards(argv: List[str], processes: int, threads: Optional[int] = None, model: bool = True) -> None:
+    """Run `processes` shards of this script at once, each pinned to its own cores and intra-op threads"""
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    threads = threads or max(len(cpus) // processes, 1)
+    n_gpus = 0
+    # the rules mode runs without torch, only look for GPUs when the model runs
+    if model and importlib.util.find_spec("torch") is not None:
+        import torch
+        n_gpus = torch.cuda.device_count() if torch.cuda.is_available() else 0
+    workers = []
+    for index in range(processes):
+        worker_cpus = cpus[index * len(cpus) // processes:(index + 1) * len(cpus) // processes] or cpus
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads),
+                   TOKENIZERS_PARALLELISM="false")
+        command = [sys.executable, __file__, *argv, '--shard', f"{index}/{processes}", '--threads', str(threads),
+                   # the DataLoader workers would compete with the other shards for the same cores
+                   '--num_workers', '0', '--device', f"cuda:{index % n_gpus}" if n_gpus else "cpu",
+                   # a resident worker would run every shard in its own process, ignoring the pinning
+                   '--no_worker']
+        preexec = (lambda cpus=worker_cpus: os.sched_setaffinity(0, cpus)) if hasattr(os, 'sched_setaffinity') else None
+        workers.append(subprocess.Popen(command, env=env, preexec_fn=preexec))
+        logging.info(f"Started shard {index}/{processes} on cpus {worker_cpus[0]}-{worker_cpus[-1]}")
+    failed = [index for index, worker in enumerate(workers) if worker.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Shard(s) {failed} failed, rerun them with --shard i/{processes} then --merge {processes}")
+
+def worker_or_local(args, local_processor: Callable[[], OptimizedNERProcessor]) -> OptimizedNERProcessor:
+    """Client of the resident worker at --worker when it runs the same configuration, else local_processor()"""
+    if not args.no_worker:
+        expected = {'model': args.model, 'stride': args.stride, 'quantize': args.quantize,
+                    'max_candidates': MAX_CANDIDATES}
+        client = ner_worker.WorkerClient.connect(args.worker, expected, TIME_COLUMNS, args.store)
+        if client is not None:
+            logging.info(f"NER served by the worker at {args.worker}")
+            return client
+    return local_processor()
+
+def benchmark_worker(df: pd.DataFrame, argv: List[str], requests: int = 5, script: str = __file__) -> pd.DataFrame:
+    """Latency of a small NER job: the CLI loading the model, the CLI served by a warm worker, a worker request"""
+    import socket
+    import tempfile
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        address = f"127.0.0.1:{probe.getsockname()[1]}"
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = Path(tmp) / "job.csv"
+        df.to_csv(input_path, index=False)
+
+        def run_cli(*options: str) -> float:
+            start = time.perf_counter()
+            subprocess.run([sys.executable, script, '--csv', str(input_path), *argv, *options],
+                           cwd=tmp, check=True, stdout=subprocess.DEVNULL)
+            return time.perf_counter() - start
+
+        timings['cold CLI (--no_worker)'] = [run_cli('--no_worker') for _ in range(requests)]
+        start = time.perf_counter()
+        server = subprocess.Popen([sys.executable, script, '--serve', '--worker', address, *argv],
+                                  cwd=tmp, stdout=subprocess.DEVNULL)
+        try:
+            client = None
+            while client is None:
+                if server.poll() is not None:
+                    raise RuntimeError(f"The NER worker exited with code {server.returncode}")
+                time.sleep(0.1)
+                client = ner_worker.WorkerClient.connect(address, {}, TIME_COLUMNS)
+            timings['worker startup'] = [time.perf_counter() - start]
+            timings['warm CLI (--worker)'] = [run_cli('--worker', address) for _ in range(requests)]
+            timings['warm request'] = []
+            for _ in range(requests):
+                start = time.perf_counter()
+                client.process_dataframe(df.copy())
+                timings['warm request'].append(time.perf_counter() - start)
+            client.close()
+        finally:
+            server.terminate()
+            server.wait()
+    return pd.DataFrame([{'path': name, 'documents': len(df), 'runs': len(seconds), 'mean_s': np.mean(seconds),
+                          'min_s': min(seconds), 'max_s': max(seconds)} for name, seconds in timings.items()])
+
 def main():
     import argparse
+    # configured here rather than on import, so that pipeline.py and benchmark.py keep their own logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('ner_processing.log'),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
     parser = argparse.ArgumentParser()
-    parser.add_argument("--csv", type=str, required=True, help="Input CSV path")
+    parser.add_argument("--csv", type=str, default=None, help="Input path (.csv, .parquet or .arrow)")
     parser.add_argument("--model", type=str, default="Jean-Baptiste/camembert-ner-with-dates")
     parser.add_argument("--batch_size", type=int, default=16)
     parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--stride", type=int, default=128, help="Tokens shared by two consecutive windows")
+    parser.add_argument("--mode", type=str, default="model", choices=["model", "rules", "hybrid"],
+                        help="rules: regex only, hybrid: the model only runs where rules find nothing")
+    parser.add_argument("--store", type=str, default=None,
+                        help="SQLite checkpoint file: documents already processed with the same config are skipped")
+    parser.add_argument("--dedup_threshold", type=float, default=None,
+                        help="Mark near-duplicates first (see dedup.py), the NER only runs once per cluster")
+    parser.add_argument("--compare", action="store_true",
+                        help="Report rules/model recall overlap on a csv that already has a time_list (e.g. demo_data)")
+    parser.add_argument("--device", type=str, default=None, help="cuda, cuda:1, cpu (default: cuda if available)")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads of this process")
+    parser.add_argument("--shard", type=str, default=None,
+                        help="i/N: only process slice i of N and write it to --shard_dir (one per process or machine)")
+    parser.add_argument("--shard_dir", type=str, default="./ner_shards", help="Shard files, shared by every machine")
+    parser.add_argument("--merge", type=int, default=None,
+                        help="N: rebuild the output from the N shard files of --shard_dir, in the input order")
+    parser.add_argument("--quantize", action="store_true",
+                        help="CPU: int8 dynamic quantization of the linear layers, time_list can differ from fp32 "
+                             "(see --benchmark_cpu)")
+    parser.add_argument("--torchscript", action="store_true",
+                        help="CPU: run a frozen TorchScript graph of the model, eager mode is kept if the graph "
+                             "labels the parity texts differently")
+    parser.add_argument("--benchmark_cpu", action="store_true",
+                        help="Compare fp32/int8, eager/traced CPU throughput and time_list parity on --csv and exit")
+    parser.add_argument("--serve", action="store_true",
+                        help="Load the model once and answer the NER of other 2_ner.py runs on --worker (see ner_worker.py)")
+    parser.add_argument("--worker", type=str, default=ner_worker.DEFAULT_ADDRESS,
+                        help="host:port of the resident worker, used when one with the same model/stride/quantize answers")
+    parser.add_argument("--no_worker", action="store_true", help="Always load the model in this process")
+    parser.add_argument("--benchmark_worker", type=int, default=None,
+                        help="N: time N cold CLI runs, N runs served by a warm worker and N worker requests on --csv")
+    instrumentation.add_arguments(parser)
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Run this many shards locally at once, pinned to separate cores, then merge them")
     args = parser.parse_args()
+    instrumentation.configure_from_args(args)
+
+    def local_processor(num_workers: int = args.num_workers) -> OptimizedNERProcessor:
+        if args.threads:
+            import torch
+            torch.set_num_threads(args.threads)
+        return OptimizedNERProcessor(
+            model_name=args.model,
+            device=args.device,
+            batch_size=args.batch_size,
+            num_workers=num_workers,
+            stride=args.stride,
+            store=ResultStore(Path(args.store)) if args.store else None,
+            quantize=args.quantize,
+            torchscript=args.torchscript
+        )
+
+    if args.serve:
+        # DataLoader processes per request would cost more than the tokenization they save
+        ner_worker.serve(local_processor(num_workers=0), args.worker, TIME_COLUMNS)
+        return
+    if args.csv is None:
+        parser.error("--csv is required")
+
+    output_path = Path(Path(args.csv).stem + "_ner" + Path(args.csv).suffix)
+    shard_dir = Path(args.shard_dir)
+    if args.processes > 1 or args.merge:
+        if args.processes > 1:
+            shard_dir.mkdir(parents=True, exist_ok=True)
+            # forward every option except the launcher ones
+            argv = list(sys.argv[1:])
+            for option in ('--processes', '--merge'):
+                if option in argv:
+                    position = argv.index(option)
+                    del argv[position:position + 2]
+            launch_local_shards(argv, args.processes, args.threads, model=args.mode != "rules")
+        result_df = merge_shards(output_path, args.merge or args.processes, shard_dir)
+        write_table(result_df, output_path)
+        logging.info(f"Merged {args.merge or args.processes} shards, {len(result_df)} rows saved to {output_path}")
+        return
 
     try:
         # Reading Data
-        df = pd.read_csv(args.csv)
+        df = read_table(args.csv)
         logging.info(f"Loaded DataFrame with {len(df)} rows")
+        if args.dedup_threshold:
+            # before the sharding, so that every shard knows the representatives of the whole file
+            dedup_index = dedup.DedupIndex(args.dedup_threshold)
+            df = dedup.mark_duplicates(df, dedup_index)
+            logging.info(f"Duplicates: {dedup_index.report()}")
+        if args.shard:
+            index, count = parse_shard(args.shard)
+            df = take_shard(df, index, count)
+            shard_dir.mkdir(parents=True, exist_ok=True)
+            output_path = shard_path(output_path, index, count, shard_dir)
+            logging.info(f"Shard {index}/{count}: {len(df)} rows")
 
-        # Initialize the processor
-        processor = OptimizedNERProcessor(
-            model_name=args.model,
-            batch_size=args.batch_size,
-            num_workers=args.num_workers
-        )
+        if args.benchmark_cpu:
+            logging.info("\n" + benchmark_cpu(df, args.model, args.batch_size, args.threads).to_string(
+                index=False, float_format="%.3f"))
+            return
+
+        if args.benchmark_worker:
+            # forward every option except the benchmark ones
+            argv = list(sys.argv[1:])
+            for option in ('--csv', '--benchmark_worker', '--worker'):
+                if option in argv:
+                    position = argv.index(option)
+                    del argv[position:position + 2]
+            logging.info("\n" + benchmark_worker(df, argv, args.benchmark_worker).to_string(
+                index=False, float_format="%.3f"))
+            return
+
+        if args.compare:
+            for name, value in RuleDateExtractor().compare_with_model(df).items():
+                logging.info(f"{name}: {value:.3f}" if isinstance(value, float) else f"{name}: {value}")
+            return
+
+        # Initialize the processor only if the model has to run, a resident worker first
+        def make_processor() -> OptimizedNERProcessor:
+            return worker_or_local(args, local_processor)
 
         # Processing Data
-        result_df = processor.process_dataframe(df)
+        with metrics.span("ner", documents=len(df), mode=args.mode):
+            # documents marked by dedup.py get the candidates of their representative
+            result_df = dedup.process_representatives(
+                df, lambda todo: extract_time_lists(todo, args.mode, make_processor), TIME_COLUMNS)
 
         # Save the results
-        output_path = Path(args.csv).stem + "_ner.csv"
-        result_df.to_csv(output_path, index=False)
+        if args.shard:
+            write_atomic(result_df, output_path)
+        else:
+            write_table(result_df, output_path)
         logging.info(f"Results saved to {output_path}")
+        metrics.finish()
 
     except Exception as e:
         logging.error(f"Error in main: {e}")
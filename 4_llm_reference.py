@@ -1,15 +1,37 @@
 # vllm_model.py
-from vllm import LLM, SamplingParams,LLMEngine
-from vllm.engine.arg_utils import EngineArgs
-from transformers import AutoTokenizer,AutoConfig
+from typing import Callable, Dict, List, Optional, Tuple
+from pathlib import Path
+import aiohttp
+import argparse
+import ast
+import asyncio
+import gc
+import hashlib
+import math
 import os
+import re
+import sys
 import json
+import logging
+import time
 import pandas as pd
+import importlib
+import dedup
+from document_store import read_table, write_table
+from instrumentation import metrics
+import instrumentation
+from result_store import ResponseCache, ResultStore, config_hash, content_hash
 
 
 # True to use modelscope , false to use huggingface
 os.environ['VLLM_USE_MODELSCOPE']='True'
 
+date_cleaning = importlib.import_module("5_clean_date")
+
+STOP_TOKEN_IDS = [151329, 151336, 151338]
+# statuses worth retrying: rate limiting, overloaded or restarting server
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 def clean_text(text):
     """
     remove space and not line
@@ -31,107 +53,976 @@ def clean_text(text):
 
     return cleaned_text
 
-def get_completion(prompts, model, tokenizer=None, max_tokens=100, temperature=0.1, top_p=0.9,max_model_len=20000):
-    stop_token_ids = [151329, 151336, 151338]
-
-    # create sampling param : not used
-    sampling_params = SamplingParams(
-        temperature=temperature,
-        top_p=top_p,
-        max_tokens=max_tokens,
-        stop_token_ids=stop_token_ids
-    )
-
-    # Initialize LLM
-
-    llm = LLM(
-        model=model,
-        tokenizer=model,
-        trust_remote_code=True,
-        max_model_len=80000,  # Reduce this value
-        gpu_memory_utilization=0.95,
-        rope_scaling={
-            "factor": 4.0,
-            "original_max_position_embeddings": 32768,
-            "type": "yarn"
+
+class VLLMBackend:
+    """In-process vLLM engine, loaded once and reused for every batch of prompts"""
+    def __init__(self, model: str, max_model_len: int = 80000, gpu_memory_utilization: float = 0.95,
+                 enable_prefix_caching: bool = True):
+        # vllm is only imported here so the selection logic can run on CPU with another backend
+        from vllm import LLM
+
+        self.model = model
+        self.llm = LLM(
+            model=model,
+            tokenizer=model,
+            trust_remote_code=True,
+            max_model_len=max_model_len,  # Reduce this value
+            gpu_memory_utilization=gpu_memory_utilization,
+            # the KV cache of SHARED_PREFIX is computed once and reused by every prompt
+            enable_prefix_caching=enable_prefix_caching,
+            rope_scaling={
+                "factor": 4.0,
+                "original_max_position_embeddings": 32768,
+                "type": "yarn"
+            }
+        )
+        self.tokenizer = self.llm.get_tokenizer()
+
+    def apply_chat_template(self, messages: List[Dict[str, str]]) -> str:
+        """Render messages with the model's own chat template, ready for the assistant turn"""
+        return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def generate(self, prompts: List[str], max_tokens: int = 100, temperature: float = 0.1, top_p: float = 0.9) -> List[str]:
+        """Generate one completion per prompt, in the same order as the prompts"""
+        from vllm import SamplingParams
+
+        sampling_params = SamplingParams(
+            temperature=temperature,
+            top_p=top_p,
+            max_tokens=max_tokens,
+            stop_token_ids=STOP_TOKEN_IDS
+        )
+        outputs = self.llm.generate(prompts, sampling_params)
+        metrics.count("llm.prompt_tokens", sum(len(output.prompt_token_ids) for output in outputs))
+        metrics.count("llm.generated_tokens", sum(len(output.outputs[0].token_ids) for output in outputs))
+        return [output.outputs[0].text for output in outputs]
+
+    def score(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        """Log-probability of each continuation, end of turn included, after its prompt
+
+        vLLM does not read the prefix cache for requests with prompt_logprobs, whose logits it has to
+        compute: every candidate pays the full prefill of its document (see --benchmark_prefill).
+        """
+        from vllm import SamplingParams
+
+        sampling_params = SamplingParams(max_tokens=1, prompt_logprobs=0)
+        inputs = []
+        spans = []
+        for prompt, continuation in pairs:
+            prompt_ids = self.tokenizer.encode(prompt, add_special_tokens=False)
+            continuation_ids = self.tokenizer.encode(continuation, add_special_tokens=False) + [self.tokenizer.eos_token_id]
+            inputs.append({'prompt_token_ids': prompt_ids + continuation_ids})
+            spans.append((len(prompt_ids), continuation_ids))
+        outputs = self.llm.generate(inputs, sampling_params)
+        metrics.count("llm.prompt_tokens", sum(len(item['prompt_token_ids']) for item in inputs))
+        return [
+            sum(output.prompt_logprobs[offset + i][token_id].logprob for i, token_id in enumerate(continuation_ids))
+            for output, (offset, continuation_ids) in zip(outputs, spans)
+        ]
+
+
+class FakeBackend:
+    """Deterministic CPU stand-in: answers with the first date of the current task's Date List
+
+    It also simulates the engine's block-level automatic prefix caching on a word-level fake
+    tokenizer, to count the prefill tokens a prompt layout costs.
+    """
+    def __init__(self, model: str = "fake", enable_prefix_caching: bool = True, block_size: int = 16):
+        self.model = model
+        self.enable_prefix_caching = enable_prefix_caching
+        self.block_size = block_size
+        self.calls: List[int] = []  # size of every generate call, to check batching
+        self.cached_blocks = set()
+        self.prompt_tokens = 0
+        self.prefill_tokens = 0
+
+    @staticmethod
+    def apply_chat_template(messages: List[Dict[str, str]]) -> str:
+        return "".join(f"<|{message['role']}|>\n{message['content']}\n" for message in messages) + "<|assistant|>\n"
+
+    @staticmethod
+    def count_tokens(text: str) -> int:
+        return len(re.findall(r"\w+|[^\w\s]", text))
+
+    def prefill(self, prompt: str, use_cache: bool = True) -> int:
+        """Tokens left to compute once the full blocks shared with previous prompts are reused"""
+        tokens = re.findall(r"\w+|[^\w\s]", prompt)
+        cached = 0
+        block_hash = None
+        for start in range(0, len(tokens) - self.block_size + 1, self.block_size):
+            # a block is only reusable if the whole prefix before it is identical too
+            block_hash = hash((block_hash, *tokens[start:start + self.block_size]))
+            if self.enable_prefix_caching and use_cache and block_hash in self.cached_blocks and cached == start:
+                cached += self.block_size
+            self.cached_blocks.add(block_hash)
+        self.prompt_tokens += len(tokens)
+        self.prefill_tokens += len(tokens) - cached
+        metrics.count("llm.prompt_tokens", len(tokens))
+        metrics.count("llm.prefill_tokens", len(tokens) - cached)
+        return len(tokens) - cached
+
+    def generate(self, prompts: List[str], max_tokens: int = 100, temperature: float = 0.1, top_p: float = 0.9) -> List[str]:
+        self.calls.append(len(prompts))
+        completions = []
+        for prompt in prompts:
+            self.prefill(prompt)
+            date_list = prompt.rsplit("[Date List]", 1)[-1].split("[Reference Text]", 1)[0]
+            candidates = re.findall(r"'([^']*)'", date_list)
+            completions.append(candidates[0][:max_tokens] if candidates else "")
+        metrics.count("llm.generated_tokens", sum(len(re.findall(r"\w+|[^\w\s]", c)) for c in completions))
+        return completions
+
+    def score(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        """Fake log-probability: candidates that occur more often in the reference text score higher"""
+        scores = []
+        for prompt, continuation in pairs:
+            # like vLLM, prompt log-probabilities are computed without the prefix cache
+            self.prefill(prompt + continuation, use_cache=False)
+            text = prompt.rsplit("[Reference Text]", 1)[-1]
+            scores.append(math.log(1 + text.count(continuation)) - 0.01 * len(continuation))
+        return scores
+
+
+class ServerError(RuntimeError):
+    """A request to the inference server still failed after every retry"""
+
+
+class OpenAIBackend:
+    """Client of a long-lived OpenAI-compatible inference server (vllm serve, TGI, llama.cpp...) on /v1/completions
+
+    Every prompt is its own request and up to max_in_flight of them are sent at once, so the server's continuous
+    batching always has work queued while this process holds no GPU. Transient errors are retried with exponential
+    backoff; a prompt that still fails raises ServerError, so a checkpointed run can simply be restarted.
+    Prompts are rendered with the model's chat template from a local tokenizer ("plain": the fake backend's).
+    """
+    def __init__(self, model: str, base_url: str = "http://127.0.0.1:8000", tokenizer: Optional[str] = None,
+                 max_in_flight: int = 64, timeout: float = 300, max_retries: int = 3, backoff: float = 1.0,
+                 api_key: Optional[str] = None):
+        self.model = model
+        self.base_url = base_url.rstrip('/')
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.headers = {'Authorization': f"Bearer {api_key}"} if api_key else {}
+        tokenizer = tokenizer or model
+        if tokenizer == "plain":
+            self.tokenizer = None
+        else:
+            # transformers is only imported when a chat template is needed, as vllm in VLLMBackend
+            from transformers import AutoTokenizer
+            self.tokenizer = AutoTokenizer.from_pretrained(tokenizer, trust_remote_code=True)
+        self.stats = {'requests': 0, 'retries': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'seconds': 0.0}
+
+    def apply_chat_template(self, messages: List[Dict[str, str]]) -> str:
+        if self.tokenizer is None:
+            return FakeBackend.apply_chat_template(messages)
+        return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+    def count_tokens(self, text: str) -> int:
+        if self.tokenizer is None:
+            return FakeBackend.count_tokens(text)
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    async def complete(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                       payload: Dict[str, object]) -> Dict:
+        """POST one completion request, retrying transient errors, and return its first choice"""
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats['retries'] += 1
+                metrics.count("llm.retries")
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                async with semaphore:
+                    start = time.perf_counter()
+                    async with session.post(f"{self.base_url}/v1/completions", json=payload) as response:
+                        if response.status in RETRY_STATUSES:
+                            error = f"HTTP {response.status}"
+                            continue
+                        if response.status != 200:
+                            raise ServerError(f"HTTP {response.status}: {(await response.text())[:200]}")
+                        body = await response.json()
+                    elapsed = time.perf_counter() - start
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+                continue
+            usage = body.get('usage') or {}
+            self.stats['requests'] += 1
+            self.stats['seconds'] += elapsed
+            self.stats['prompt_tokens'] += usage.get('prompt_tokens', 0)
+            self.stats['completion_tokens'] += usage.get('completion_tokens', 0)
+            metrics.count("llm.requests")
+            metrics.count("llm.prompt_tokens", usage.get('prompt_tokens', 0))
+            metrics.count("llm.generated_tokens", usage.get('completion_tokens', 0))
+            return body['choices'][0]
+        raise ServerError(f"{self.base_url} failed after {self.max_retries + 1} attempts: {error}")
+
+    async def complete_all(self, payloads: List[Dict[str, object]]) -> List[Dict]:
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        async with aiohttp.ClientSession(connector=connector, headers=self.headers,
+                                         timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+            return await asyncio.gather(*[self.complete(session, semaphore, payload) for payload in payloads])
+
+    def generate(self, prompts: List[str], max_tokens: int = 100, temperature: float = 0.1, top_p: float = 0.9) -> List[str]:
+        """Generate one completion per prompt, in the same order as the prompts"""
+        # called from a worker thread by pipeline.py, which has no event loop of its own
+        choices = asyncio.run(self.complete_all([
+            {'model': self.model, 'prompt': prompt, 'max_tokens': max_tokens, 'temperature': temperature,
+             'top_p': top_p} for prompt in prompts
+        ]))
+        return [choice['text'] for choice in choices]
+
+    def score(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        """Log-probability of each continuation, end of turn included, after its prompt
+
+        The server echoes the prompt with the log-probability and character offset of each of its tokens;
+        the tokens from the end of the prompt on are summed, as VLLMBackend.score does with token ids.
+        Echoed log-probabilities bypass the prefix cache too, each candidate is a full prefill.
+        """
+        eos = self.tokenizer.eos_token if self.tokenizer is not None and self.tokenizer.eos_token else ""
+        texts = [prompt + continuation + eos for prompt, continuation in pairs]
+        choices = asyncio.run(self.complete_all([
+            {'model': self.model, 'prompt': text, 'max_tokens': 1, 'temperature': 0, 'echo': True, 'logprobs': 0}
+            for text in texts
+        ]))
+        scores = []
+        for (prompt, _), text, choice in zip(pairs, texts, choices):
+            logprobs = choice['logprobs']
+            scores.append(sum(
+                logprob for logprob, offset in zip(logprobs['token_logprobs'], logprobs['text_offset'])
+                # the last token is the generated one, after the echoed text
+                if logprob is not None and len(prompt) <= offset < len(text)
+            ))
+        return scores
+
+
+class CachedBackend:
+    """Any backend behind the on-disk response cache: cached prompts and scored candidates never reach the model"""
+    def __init__(self, backend, cache: ResponseCache, bypass: bool = False):
+        self.backend = backend
+        self.model = backend.model
+        self.cache = cache
+        self.bypass = bypass  # ignore cached completions, but still store the new ones
+
+    def apply_chat_template(self, messages: List[Dict[str, str]]) -> str:
+        return self.backend.apply_chat_template(messages)
+
+    def count_tokens(self, text: str) -> int:
+        return self.backend.count_tokens(text)
+
+    def score(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        keys = [self.cache.key(self.model, {'score': True, 'continuation': continuation}, prompt)
+                for prompt, continuation in pairs]
+        found = {} if self.bypass else self.cache.get_many(keys)
+
+        # log-probabilities are stored as their repr, which reads back to the same float
+        missing = {key: pair for key, pair in zip(keys, pairs) if key not in found}
+        if missing:
+            scored = {key: repr(score) for key, score in zip(missing, self.backend.score(list(missing.values())))}
+            self.cache.put_many(scored)
+            found.update(scored)
+        return [float(found[key]) for key in keys]
+
+    def generate(self, prompts: List[str], max_tokens: int = 100, temperature: float = 0.1, top_p: float = 0.9) -> List[str]:
+        params = {'max_tokens': max_tokens, 'temperature': temperature, 'top_p': top_p}
+        keys = [self.cache.key(self.model, params, prompt) for prompt in prompts]
+        found = {} if self.bypass else self.cache.get_many(keys)
+
+        # identical prompts of the batch are only generated once
+        missing = {key: prompt for key, prompt in zip(keys, prompts) if key not in found}
+        if missing:
+            completions = self.backend.generate(list(missing.values()), max_tokens=max_tokens,
+                                                temperature=temperature, top_p=top_p)
+            generated = dict(zip(missing, completions))
+            self.cache.put_many(generated)
+            found.update(generated)
+        return [found[key] for key in keys]
+
+
+def build_backend(name: str, model: str, response_cache: Optional[str] = None,
+                  cache_max_mb: int = 512, bypass_cache: bool = False, base_url: str = "http://127.0.0.1:8000",
+                  tokenizer: Optional[str] = None, max_in_flight: int = 64, request_timeout: float = 300,
+                  gpu_memory_utilization: float = 0.95):
+    """Create the generation backend once for the whole run"""
+    if name == "vllm":
+        backend = VLLMBackend(model, gpu_memory_utilization=gpu_memory_utilization)
+    elif name == "openai":
+        backend = OpenAIBackend(model, base_url, tokenizer=tokenizer, max_in_flight=max_in_flight,
+                                timeout=request_timeout, api_key=os.environ.get("OPENAI_API_KEY"))
+    else:
+        backend = FakeBackend(model)
+    if response_cache:
+        backend = CachedBackend(backend, ResponseCache(Path(response_cache), cache_max_mb * 1024 ** 2), bypass_cache)
+    return backend
+
+
+def build_prompt(timelist: str, context: str, max_context_length: int = 4000,
+                 apply_chat_template: Optional[Callable[[List[Dict[str, str]]], str]] = None) -> str:
+    """Shared few-shot prefix as the system message, then one document's candidate dates and text"""
+    # clean " \n"
+    context_cleaned = clean_text(context)
+    context_cleaned = context_cleaned[:max_context_length]
+    return render_prompt(timelist, context_cleaned, apply_chat_template)
+
+
+def render_prompt(timelist: str, reference_text: str,
+                  apply_chat_template: Optional[Callable[[List[Dict[str, str]]], str]] = None) -> str:
+    # each distinct date is listed once
+    task = TASK_TEMPLATE.format(Event_List=parse_candidates(timelist), text=reference_text)
+    if apply_chat_template is None:
+        return SHARED_PREFIX + task
+    return apply_chat_template([
+        {"role": "system", "content": SHARED_PREFIX},
+        {"role": "user", "content": task},
+    ])
+
+
+def parse_offsets(offsets) -> List[Tuple[int, int]]:
+    """(start, end) of the time_offsets entries [date, start, end], a repr once read back from a csv"""
+    if not isinstance(offsets, list):
+        try:
+            offsets = list(ast.literal_eval(offsets))
+        except (ValueError, SyntaxError):
+            return []
+    return [(int(start), int(end)) for _, start, end in offsets]
+
+
+def locate_candidates(text: str, candidates: List[str]) -> List[Tuple[int, int]]:
+    """(start, end) of every occurrence of the candidates, for NER outputs written without time_offsets"""
+    spans = []
+    for date in candidates:
+        start = text.find(date)
+        while start != -1:
+            spans.append((start, start + len(date)))
+            start = text.find(date, start + 1)
+    return sorted(spans)
+
+
+def window_context(text: str, spans: List[Tuple[int, int]], url: str = "", header_chars: int = 300,
+                   window_chars: int = 150, max_tokens: int = 512,
+                   count_tokens: Optional[Callable[[str], int]] = None) -> str:
+    """Reference text made of the URL, the header and the text around each candidate, within max_tokens
+
+    The header (commune, séance, transmission stamps) always comes first. Then the first occurrence of
+    every candidate is taken before any second occurrence, and so on, while the budget allows. Kept windows
+    go back in document order, overlapping ones are merged and the text left out is marked with "…".
+    """
+    count_tokens = count_tokens or (lambda part: len(part.split()))
+
+    def word_start(position: int) -> int:
+        return text.rfind(' ', 0, max(position, 0)) + 1
+
+    def word_end(position: int) -> int:
+        end = text.find(' ', min(position, len(text)))
+        return len(text) if end == -1 else end
+
+    header_end = word_end(header_chars) if len(text) > header_chars else len(text)
+    kept = [(0, header_end)]
+    used = count_tokens(url) + count_tokens(text[:header_end])
+    occurrences: Dict[str, int] = {}
+    ranked = []
+    for start, end in sorted(spans):
+        rank = occurrences.get(text[start:end], 0)
+        occurrences[text[start:end]] = rank + 1
+        ranked.append((rank, start, end))
+    for _, start, end in sorted(ranked):
+        window = (word_start(start - window_chars), word_end(end + window_chars))
+        if window[1] <= header_end:
+            continue
+        # overlaps are counted twice, so the merged text stays under the budget
+        cost = count_tokens(text[window[0]:window[1]])
+        if used + cost <= max_tokens:
+            kept.append(window)
+            used += cost
+
+    merged = []
+    for start, end in sorted(kept):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    # the quotes clean_text put around the text are put back around the whole context
+    parts = ' … '.join(text[start:end].strip() for start, end in merged).strip('"')
+    if merged[-1][1] < len(text):
+        parts += ' …'
+    return f'"{url} {parts}"' if url else f'"{parts}"'
+
+
+def parse_time_list(timelist) -> List[str]:
+    """time_list as read back from a csv: the repr of a python list"""
+    if not isinstance(timelist, list):
+        try:
+            timelist = list(ast.literal_eval(timelist))
+        except (ValueError, SyntaxError):
+            timelist = re.findall(r"'([^']*)'", str(timelist))
+    return [str(date) for date in timelist if str(date).strip()]
+
+
+def parse_candidates(timelist) -> List[str]:
+    """Distinct candidate dates of a time_list: one surface form per normalized date, in order of appearance
+
+    NER files written before the normalized deduplication may repeat a date in several forms.
+    """
+    forms = {}
+    for date in parse_time_list(timelist):
+        key, form = date_cleaning.candidate_key(date)
+        forms.setdefault(key, form)
+    return list(forms.values())
+
+
+class DateSelector:
+    """Send every prompt of a dataset through one backend, in chunks, and map answers back to filenames"""
+    def __init__(
+            self,
+            backend,
+            chunk_size: Optional[int] = None,
+            max_tokens: int = 25,
+            temperature: float = 0.08,
+            top_p: float = 0.95,
+            store: Optional[ResultStore] = None,
+            mode: str = "generate",
+            context: str = "truncate",
+            window_chars: int = 150,
+            context_tokens: int = 512
+    ):
+        if mode not in ("generate", "score"):
+            raise ValueError(f"Unknown selection mode {mode}")
+        if context not in ("truncate", "windows"):
+            raise ValueError(f"Unknown context layout {context}")
+        self.backend = backend
+        self.chunk_size = chunk_size  # None: a single generate call for the whole dataset
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.store = store  # per-document checkpoints, None: no checkpointing
+        self.mode = mode  # "generate": free-form answer, "score": argmax of the candidates log-probabilities
+        self.confidences: Dict[str, float] = {}  # score mode: probability of the answer among the candidates
+        # "truncate": the first max_context_length characters, "windows": header and text around the candidates
+        self.context = context
+        self.window_chars = window_chars  # characters kept on each side of a candidate
+        self.context_tokens = context_tokens  # token budget of the windowed reference text
+
+    def stage_config(self, max_context_length: int) -> Dict[str, object]:
+        """Everything that changes the completion of a document"""
+        config = {
+            'model': self.backend.model,
+            'template': TEMPLATE_HASH,
+            'max_context_length': max_context_length,
+            'max_tokens': self.max_tokens,
+            'temperature': self.temperature,
+            'top_p': self.top_p,
+            'mode': self.mode,
         }
-    )
+        if self.context == "windows":
+            config.update(context=self.context, window_chars=self.window_chars, context_tokens=self.context_tokens)
+        return config
+
+    def window_contexts(self, dataframe: pd.DataFrame) -> List[str]:
+        """window_context of every row, around the NER offsets in raw_text_content when the columns are there"""
+        n_rows = len(dataframe)
+        if 'raw_text_content' in dataframe.columns:
+            texts = dataframe['raw_text_content']
+            urls = dataframe['text version'] if 'text version' in dataframe.columns else [''] * n_rows
+            offsets = dataframe['time_offsets'] if 'time_offsets' in dataframe.columns else [None] * n_rows
+        else:
+            # text_content already starts with the URL
+            texts, urls, offsets = dataframe['text_content'], [''] * n_rows, [None] * n_rows
+        contexts = []
+        for text, url, timelist, doc_offsets in zip(texts, urls, dataframe['time_list'], offsets):
+            text = text if isinstance(text, str) else ""
+            spans = parse_offsets(doc_offsets)
+            if not spans:
+                # NER output written before time_offsets
+                spans = locate_candidates(text, list(dict.fromkeys(parse_time_list(timelist))))
+            contexts.append(window_context(text, spans, url if isinstance(url, str) else "",
+                                           window_chars=self.window_chars, max_tokens=self.context_tokens,
+                                           count_tokens=self.backend.count_tokens))
+        return contexts
+
+    def build_prompts(self, dataframe: pd.DataFrame,
+                      max_context_length: int = 4000) -> Tuple[Dict[str, str], Dict[str, List[str]]]:
+        """Prompt and distinct candidates of every row, by local_filename"""
+        if self.context == "windows":
+            contexts = self.window_contexts(dataframe)
+        else:
+            contexts = [clean_text(context)[:max_context_length] for context in dataframe['text_content']]
+        prompts = {}
+        candidates = {}
+        for file, context, timelist in zip(dataframe['local_filename'], contexts, dataframe['time_list']):
+            prompts[file] = render_prompt(timelist, context, self.backend.apply_chat_template)
+            candidates[file] = parse_candidates(timelist)
+        return prompts, candidates
+
+    def select(self, prompts: Dict[str, str], on_chunk: Optional[Callable[[Dict[str, str]], None]] = None) -> Dict[str, str]:
+        """Return a mapping from local_filename to the raw completion, on_chunk gets the results of every generate call"""
+        file_list = list(prompts)
+        step = self.chunk_size or max(len(file_list), 1)
+        results_all = {}
+        for start in range(0, len(file_list), step):
+            files = file_list[start:start + step]
+            logging.info(f"Generating {len(files)} files, {len(file_list) - start - len(files)} left")
+            with metrics.span("selection.generate", documents=len(files)):
+                completions = self.backend.generate(
+                    [prompts[file] for file in files],
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    top_p=self.top_p
+                )
+            if len(completions) != len(files):
+                raise ValueError(f"Backend returned {len(completions)} completions for {len(files)} prompts")
+            results_all.update(zip(files, completions))
+            if on_chunk is not None:
+                on_chunk(dict(zip(files, completions)))
+        return results_all
+
+    def score(self, prompts: Dict[str, str], candidates: Dict[str, List[str]],
+              on_chunk: Optional[Callable[[Dict[str, list]], None]] = None) -> Dict[str, str]:
+        """Pick the candidate the model finds most likely as the answer of each prompt"""
+        file_list = list(prompts)
+        step = self.chunk_size or max(len(file_list), 1)
+        results_all = {}
+        for start in range(0, len(file_list), step):
+            files = file_list[start:start + step]
+            logging.info(f"Scoring {len(files)} files, {len(file_list) - start - len(files)} left")
+            pairs = [(prompts[file], date) for file in files for date in candidates[file]]
+            with metrics.span("selection.score", documents=len(files), candidates=len(pairs)):
+                scores = iter(self.backend.score(pairs))
+            chunk_results = {}
+            for file in files:
+                file_scores = [next(scores) for _ in candidates[file]]
+                best = max(range(len(file_scores)), key=file_scores.__getitem__)
+                # softmax over the candidates of the document
+                confidence = 1 / sum(math.exp(score - file_scores[best]) for score in file_scores)
+                results_all[file] = candidates[file][best]
+                self.confidences[file] = confidence
+                chunk_results[file] = [candidates[file][best], confidence]
+            if on_chunk is not None:
+                on_chunk(chunk_results)
+        return results_all
+
+    def select_dataframe(self, dataframe: pd.DataFrame, max_context_length: int = 4000) -> Dict[str, str]:
+        """Build one prompt per row of a NER output dataframe and select its date"""
+        cached = {}
+        checkpoint = None
+        if self.store is not None:
+            # only documents without a checkpoint for this configuration are sent to the backend
+            config = config_hash(self.stage_config(max_context_length))
+            inputs = [dataframe['text_content'], dataframe['time_list']]
+            if self.context == "windows":
+                inputs += [dataframe[col] for col in ('raw_text_content', 'time_offsets') if col in dataframe.columns]
+            hash_by_file = {
+                file: content_hash(*values) for file, *values in zip(dataframe['local_filename'], *inputs)
+            }
+            stored = self.store.get_many('selection', config, hash_by_file.values())
+            for file, h in hash_by_file.items():
+                if h not in stored:
+                    continue
+                if isinstance(stored[h], list):
+                    cached[file], self.confidences[file] = stored[h]
+                else:
+                    cached[file] = stored[h]
+            logging.info(f"{len(cached)} files already processed, {len(hash_by_file) - len(cached)} to process")
+
+            def checkpoint(chunk_results: Dict[str, object]) -> None:
+                self.store.put_many('selection', config, [
+                    (hash_by_file[file], file, completion) for file, completion in chunk_results.items()
+                ])
+
+        todo = dataframe[~dataframe['local_filename'].isin(cached)]
+        with metrics.span("selection.build_prompts", documents=len(todo)):
+            prompts, candidates = self.build_prompts(todo, max_context_length)
+        metrics.count("selection.documents", len(prompts))
+        metrics.count("selection.candidates", sum(map(len, candidates.values())))
+        metrics.count("selection.prompt_chars", sum(map(len, prompts.values())))
+
+        if self.mode == "generate":
+            return {**cached, **self.select(prompts, checkpoint)}
+        # documents without candidates fall back to free-form generation
+        to_score = {file: prompt for file, prompt in prompts.items() if candidates[file]}
+        to_generate = {file: prompt for file, prompt in prompts.items() if not candidates[file]}
+        return {**cached, **self.score(to_score, candidates, checkpoint), **self.select(to_generate, checkpoint)}
+
+
+# "Envoyé en préfecture le 06/01/2024", "Publié le 5 août 2023": the date right after is the publication date
+ANCHOR_REGEX = re.compile(r"(?:envoy[ée]e?\s+en\s+pr[ée]fecture|publi[ée]e?)\s+le\s+", re.IGNORECASE)
+
+
+def rule_answer(timelist, context: str) -> Optional[str]:
+    """Date of a trivial document without calling a model, None when the document is ambiguous
+
+    Trivial: every candidate normalizes to the same date, or every anchor of the text is followed by the same date.
+    """
+    normalized = {}
+    for date in parse_candidates(timelist):
+        normalized.setdefault(date_cleaning.normalize_date(date)[1], date)
+    if len(normalized) == 1 and None not in normalized:
+        return next(iter(normalized.values()))
+
+    anchored = {}
+    context = str(context)
+    for match in ANCHOR_REGEX.finditer(context):
+        following = context[match.end():match.end() + 30]
+        extracted, cleaned = date_cleaning.normalize_date(following)
+        if cleaned and following.startswith(extracted):
+            anchored.setdefault(cleaned, extracted)
+    if len(anchored) == 1:
+        return next(iter(anchored.values()))
+    return None
+
+
+def release_gpu_memory() -> None:
+    """Hand the memory of a deleted engine back before the next one is created"""
+    gc.collect()
+    # torch is only loaded by the vllm backend
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class CascadeRouter:
+    """Rules first, then each model tier in turn; a tier keeps the answers it is confident about
+
+    tiers are (name, make_selector) pairs from the cheapest to the most expensive model. A tier is only created
+    once a document reaches it, and released when done unless keep_loaded (so two vLLM engines never share the GPU).
+    Confidence is the score-mode probability of the answer, or, in generate mode, 1 when the answer is one of
+    the candidates and 0 otherwise. The last tier answers whatever its confidence.
+    """
+    def __init__(self, tiers: List[Tuple[str, Callable[[], DateSelector]]], threshold: float = 0.7,
+                 use_rules: bool = True, keep_loaded: bool = False):
+        self.tiers = tiers
+        self.threshold = threshold
+        self.use_rules = use_rules
+        self.keep_loaded = keep_loaded
+        self.selectors: Dict[str, DateSelector] = {}
+        self.routes: Dict[str, str] = {}  # local_filename -> tier that answered
+        self.confidences: Dict[str, float] = {}
+        self.escalated: Dict[str, str] = {}  # local_filename -> answer of the tier that passed it on
+
+    def confidence(self, selector: DateSelector, file: str, answer: str, timelist) -> float:
+        if file in selector.confidences:
+            return selector.confidences[file]
+        candidates = {date_cleaning.normalize_date(date)[1] for date in parse_candidates(timelist)}
+        return float(date_cleaning.normalize_date(str(answer))[1] in candidates - {None})
+
+    def select_dataframe(self, dataframe: pd.DataFrame, max_context_length: int = 4000) -> Dict[str, str]:
+        results_all = {}
+        remaining = dataframe
+        if self.use_rules:
+            answers = {file: rule_answer(timelist, context) for file, context, timelist in
+                       zip(dataframe['local_filename'], dataframe['text_content'], dataframe['time_list'])}
+            for file, answer in answers.items():
+                if answer is not None:
+                    results_all[file] = answer
+                    self.routes[file] = 'rules'
+                    self.confidences[file] = 1.0
+            remaining = dataframe[dataframe['local_filename'].map(answers).isna()]
+            metrics.count("cascade.rules", len(dataframe) - len(remaining))
+
+        for i, (name, make_selector) in enumerate(self.tiers):
+            if remaining.empty:
+                break
+            last = i == len(self.tiers) - 1
+            if name not in self.selectors:
+                self.selectors[name] = make_selector()
+            selector = self.selectors[name]
+            answers = selector.select_dataframe(remaining, max_context_length)
+            keep = []
+            for file, timelist in zip(remaining['local_filename'], remaining['time_list']):
+                confidence = self.confidence(selector, file, answers[file], timelist)
+                if last or confidence >= self.threshold:
+                    results_all[file] = answers[file]
+                    self.routes[file] = name
+                    self.confidences[file] = confidence
+                    keep.append(True)
+                else:
+                    self.escalated[file] = answers[file]
+                    keep.append(False)
+            metrics.count(f"cascade.{name}", sum(keep))
+            metrics.count("cascade.escalated", len(keep) - sum(keep))
+            remaining = remaining[[not k for k in keep]]
+            if not self.keep_loaded:
+                # the loop variables would keep the engine alive while the next tier loads
+                del self.selectors[name], selector, answers
+                release_gpu_memory()
+        return results_all
+
+    def report(self, dataframe: pd.DataFrame, results_all: Dict[str, str]) -> pd.DataFrame:
+        """Documents and accuracy against Gold_label per tier, and of the answers that were escalated"""
+        gold = dict(zip(dataframe['local_filename'], date_cleaning.normalize_dates(dataframe['Gold_label'])['cleaned_date']))
 
+        def accuracy(answers: Dict[str, str]) -> Optional[float]:
+            if not answers:
+                return None
+            return sum(date_cleaning.normalize_date(str(answer))[1] == gold[file]
+                       for file, answer in answers.items()) / len(answers) * 100
 
-    # generate
-    outputs = llm.generate(prompts, sampling_params)
+        rows = []
+        for name in ['rules'] + [name for name, _ in self.tiers]:
+            answers = {file: results_all[file] for file, tier in self.routes.items() if tier == name}
+            rows.append({'tier': name, 'documents': len(answers), 'share': len(answers) / max(len(results_all), 1) * 100,
+                         'accuracy': accuracy(answers)})
+        rows.append({'tier': 'escalated (answer before escalation)', 'documents': len(self.escalated),
+                     'share': len(self.escalated) / max(len(results_all), 1) * 100, 'accuracy': accuracy(self.escalated)})
+        rows.append({'tier': 'total', 'documents': len(results_all), 'share': 100.0, 'accuracy': accuracy(results_all)})
+        return pd.DataFrame(rows)
+
+
+def fake_app(latency: float = 0.05) -> 'aiohttp.web.Application':
+    """OpenAI-compatible /v1/completions answering like the fake backend, to run --backend openai --tokenizer plain
+    without a GPU. Every request waits `latency` seconds, as if it were queued on a real server."""
+    from aiohttp import web
+
+    backend = FakeBackend()
+
+    async def completions(request: web.Request) -> web.Response:
+        body = await request.json()
+        await asyncio.sleep(latency)
+        text = body['prompt']
+        if body.get('echo'):
+            # the scored continuation is what follows the assistant turn of the plain template
+            prompt, _, continuation = text.rpartition("<|assistant|>\n")
+            prompt += "<|assistant|>\n"
+            score = backend.score([(prompt, continuation)])[0]
+            tokens = list(re.finditer(r"\w+|[^\w\s]", text))
+            logprobs = [None] + [score if match.start() == len(prompt) else (0.0 if match.start() > len(prompt) else -1.0)
+                                 for match in tokens[1:]]
+            choice = {'text': text, 'logprobs': {'tokens': [match.group(0) for match in tokens],
+                                                 'token_logprobs': logprobs,
+                                                 'text_offset': [match.start() for match in tokens]}}
+            completion_tokens = 0
+        else:
+            completion = backend.generate([text], max_tokens=body.get('max_tokens', 100))[0]
+            choice = {'text': completion, 'logprobs': None}
+            completion_tokens = backend.count_tokens(completion)
+        return web.json_response({
+            'object': 'text_completion',
+            'model': body.get('model'),
+            'choices': [{'index': 0, 'finish_reason': 'stop', **choice}],
+            'usage': {'prompt_tokens': backend.count_tokens(text), 'completion_tokens': completion_tokens},
+        })
+
+    app = web.Application(client_max_size=64 * 1024 ** 2)
+    app.router.add_post('/v1/completions', completions)
+    return app
+
+
+def serve_fake(port: int = 8000, latency: float = 0.05) -> None:
+    from aiohttp import web
+    web.run_app(fake_app(latency), host='127.0.0.1', port=port)
+
+
+def benchmark_prefill(dataframe: pd.DataFrame) -> None:
+    """Prefill tokens per document with the fake engine, without and with automatic prefix caching
+
+    In score mode every candidate is a request of its own that cannot use the prefix cache.
+    """
+    for mode in ("generate", "score"):
+        for enable_prefix_caching in (False, True):
+            backend = FakeBackend(enable_prefix_caching=enable_prefix_caching)
+            DateSelector(backend, mode=mode).select_dataframe(dataframe)
+            print(f"{mode}, prefix caching {'on' if enable_prefix_caching else 'off'}: "
+                  f"{backend.prompt_tokens / len(dataframe):.0f} prompt tokens/doc, "
+                  f"{backend.prefill_tokens / len(dataframe):.0f} prefill tokens/doc")
+
+
+def benchmark_context(dataframe: pd.DataFrame, backend, mode: str = "generate", window_chars: int = 150,
+                      budgets: Tuple[int, ...] = (256, 512, 1024)) -> pd.DataFrame:
+    """Prompt tokens and accuracy against Gold_label of the 4000-character truncation and of candidate windows
+
+    gold_in_context is the share of documents whose reference text contains a candidate equal to the gold date
+    after normalization, what the model needs to be able to answer whatever the backend.
+    """
+    gold = dict(zip(dataframe['local_filename'], date_cleaning.normalize_dates(dataframe['Gold_label'])['cleaned_date']))
+    layouts = [("truncate 4000", "truncate", 512)] + [(f"windows {budget}", "windows", budget) for budget in budgets]
+    rows = []
+    for name, context, budget in layouts:
+        selector = DateSelector(backend, mode=mode, context=context, window_chars=window_chars, context_tokens=budget)
+        prompts, candidates = selector.build_prompts(dataframe)
+        in_context = 0
+        for file, prompt in prompts.items():
+            reference_text = prompt.rsplit("[Reference Text]", 1)[-1]
+            in_context += any(date in reference_text and date_cleaning.normalize_date(date)[1] == gold[file]
+                              for date in candidates[file])
+        results_all = selector.select_dataframe(dataframe)
+        correct = sum(date_cleaning.normalize_date(str(answer))[1] == gold[file] for file, answer in results_all.items())
+        rows.append({
+            'context': name,
+            'prompt_tokens': sum(map(backend.count_tokens, prompts.values())) / max(len(prompts), 1),
+            'reference_tokens': sum(backend.count_tokens(prompt.rsplit("[Reference Text]", 1)[-1])
+                                    for prompt in prompts.values()) / max(len(prompts), 1),
+            'gold_in_context': in_context / max(len(prompts), 1) * 100,
+            'accuracy': correct / max(len(results_all), 1) * 100,
+        })
+    return pd.DataFrame(rows)
+
+
+# Version of the prompt layout, bump it whenever SHARED_PREFIX or TASK_TEMPLATE change
+PROMPT_VERSION = "v3"
+
+# Instructions, rules and examples: byte-identical for every document so the engine prefix cache reuses them
+SHARED_PREFIX = """Select and Return ONLY EXACTLY ONE the most accurate publication date from the given date list and reference text, THE DATE YOU CHOOSE SHOULD APPEAR IN THE Date List:
+
+Rules:
+1. Output exactly one date
+2. Must be a date from the Date List
+3. No explanations, no prefix, Only return result after assistant!
+4. Keep original date format
+
+2 examples：
+
+Example 1:
+[Date List]
+['31 janvier 2024', '23/11/2023', '10 mars 2023', '15 janvier 2024', '31 janvier', 'février 2024', '01/12/2023']
+[Reference Text]
+"https://www.cc-bocage-bourbonnais.com/images/Délibération_ZA_Enr/20231130_Tronget.pdfCOMMUNE DE TRONGET EXTRAIT DU REGISTRE DES DÉLIBÉRATIONS République Française L’an deux mil vingt-trois, le jeudi 30 novembre 2023 à 19h30, le Conseil Municipal, Département de l’Allier dûment convoqué, s’est réuni salle de la Mairie sise 8 passage de la mairie, en session Arrondissement de Moulins ordinaire, sous la présidence du Maire, Jean-Marc DUMONT. Date de convocation : Présents : Patrick AMATHIEU, Elena BARANSKI, Daniel CANTE, Alain DETERNES, 23/11/2023 Jean-Marc DUMONT, Audrey GERAUD, Patricia RAYNAUD, Pascal RAYNAUD, Sylvain RIBIER, Franck VALETTE Nombre de conseillers : Excusés : Laurent BRUN, Jean-Marc CARTE, Stéphane HERAULT, Annie WEGRZYN En exercice : 14 Présents : 10 Votants : 14 Le quorum étant atteint, le | Pouvoirs: Laurent BRUN à Franck VALETTE, Jean-Marc CARTE à Jean-Marc Conseil Municipal peut | DUMONT, Stéphane HERAULT à Pascal RAYNAUD, Annie WEGRZYN à Eléna valablement délibérer. BARANSKI Secrétaire de séance : Daniel CANTE Zones d’Accélération des Energies Renouvelables N°36/2023 La loi n° 2023-175 du 10 mars 2023 relative à l’accélération de la production d’énergies renouvelables, dite loi APER, vise à accélérer et simplifier les projets d’implantation de producteurs d’énergie et à répondre à l’enjeu de l’acceptabilité locale. En particulier, son article 15 permet aux communes de définir, après concertation avec leurs administrés, des zones d’accélération où elles souhaitent prioritairement voir des projets d’énergies renouvelables s’implanter. Les zones d’accélération (ZAENR) concernent ainsi l’implantation d'installations terrestres de production d’énergies renouvelables, ainsi que de leurs ouvrages connexes. Ces ZAENR peuvent concerner toutes les énergies renouvelables (ENR). Elles sont définies, pour chaque catégorie de sources et de types d’installation de production d’ENR, en tenant compte de la nécessaire diversification des ENR, des potentiels du territoire concerné et de la puissance d’ENR déjà installée. (L.141-5-3 du code de l’énergie) Ces zones d’accélération ne sont pas des zones exclusives. Des projets pourront être autorisés en dehors. Toutefois, un comité de projet sera obligatoire pour ces projets, afin de garantir la bonne inclusion de la commune d’implantation et des communes limitrophes dans la conception du projet, au plus tôt et en continu. Les porteurs de projets seront, quoi qu’il en soit, incités à se diriger vers ces ZAENR qui témoignent d’une volonté politique et d’une adhésion locale du projet ENR. Monsieur le Maire précise que : ° Pour un projet, le fait d’être situé en zone d’accélération ne garantit pas son autorisation, celui-ci devant, dans tous les cas, respecter les dispositions réglementaires applicables et en tout état de cause l’instruction des projets reste faite au cas par cas. + Les zones doivent être à faibles enjeux environnementaux, agricoles et paysagers. + L’article L.314-41. du code de l’énergie prévoit que les candidats retenus à l’issue d’une procédure de mise en concurrence ou d’appel à projets sont tenus de financer notamment des projets portés par la commune ou par l’établissement public de coopération intercommunale à fiscalité propre d’implantation de l’installation en faveur de la transition énergétique. + Les communes identifient par délibération du conseil municipal des zones qui sont soumises à concertation du public selon les modalités qu’elles déterminent librement. Compte tenu de ces éléments, Monsieur le Maire expose : Les propositions de zones d’accélération pour les énergies renouvelables se fondent sur les critères suivants : + Des délaissés d’infrastructures, + __ Des zones dégradées, + Des terres agricoles inexploitables, + La présence de projets déjà connus, Les ZAENR proposées à la concertation sont les suivantes : + __ Solaire photovoltaïque : sur l’ensemble des bâtiments communaux et domaine public + __ Solaire photovoltaïque au sol dont ombrières : sur le domaine public et biens publics + _ Éolien, méthanisation : pas détermination de zone + Réseau de chaleur, bois-énergie, géothermie : projets communaux ou publics Les modalités de concertation proposées sont les suivantes : + Mise à disposition des documents et d’un registre en mairie du 15 janvier 2024 au 31 janvier 2024. + Mise à disposition des documents et d’un formulaire sur le site internet de la Communauté de Communes du Bocage Bourbonnais du 15 janvier 2024 au 31 janvier 2024. Le conseil municipal procédera à l’élaboration d’un bilan de la concertation en février 2024 et apportera les éventuelles modifications aux propositions des zones d’accélération des énergies renouvelables. Monsieur le Maire propose donc au conseil municipal d’émettre un avis favorable à : + La proposition de ZAENR pour leur mise en concertation du public, + La proposition des modalités de concertation. Après en avoir délibéré et à l'unanimité des membres présents et représentés, le Conseil Municipal décide : + D'’identifier les zones d’accélération pour l’implantation d’installations terrestres de production d’énergies renouvelables ainsi que leurs ouvrages connexes mentionnées ci- après, ainsi que sur les cartes annexées à la présente décision, qui seront soumises à concertation du public ; + Valide les modalités de concertation ; + Charge le maire ou son représentant de transmettre à l’EPCI, les zones identifiées pour concertation du public. ONT VOTE POUR : 14 ONT VOTE CONTRE : / SE SONT ABSTENUS : / ACTE EXECUTOIRE Reçu par le représentant de l’Etat le 01/12/2023 et publié le 01/12/2023 Pour extrait conforme au registre des délibérations du conseil municipal, Fait à Tronget, le 01/12/2023 Le Maire, UNS Jean-Marc DUMONT"
+Answer:31 janvier 2024
+
+Example 2: 
+[Date List]
+['06/01/2024', '05 Janvier 2024', '03-2024', '10 mars 2023', '19/12/2023', '30/12/2023']
+[Reference Text]
+"https://mairiechars95.fr/wp-content/uploads/2024/03/Deliberation-3-Zone-dacceleration-des-energies-renouvelables.pdfEnvoyé en préfecture le 06/01/2024 RÉPUBLIQUE FRANÇAISE M À | FR | E D FC Reu en préfecturé1e06/0172024 VAL-D'OISE | Publié le ID : 095-219501426-20240105-032024-DE Extrait du registre des délibérations du conseil municipal de CHARS Séance du 05 Janvier 2024 03-2024 OBJET : Décision du conseil municipal sur les zones d'accélération des énergies renouvelables Présents : 15 Evelyne BOSSU Xavier BACHELET Ariane MARTIN Carole BOUILLONNEC Vincent DELCHOQUE Jean-Pierre BAZIN Sébastien RAVOISIER Sheila DEPUILLE Pierre-Antoine DHUICQ Patricia CHAILLOU-LEPAREUR Sylviane LEPAPE Gérard GENNISSON Nathalie GROM Philippe CHAUVET Nicolas BELANGÉ Absents et procurations : 4 Sandrine LHORSET excusée Nicolas PRIOUX excusé Agnès AGLAVE-LUCAS excusée Caroline BOURG Pouvoir à Sylviane LEPAPE Le Président a ouvert la séance et fait l’appel nominal, il a été procédé en conformité avec l’article L.2121-15 du code général des collectivités territoriales, à la nomination d'un secrétaire pris au sein du conseil. Monsieur Philippe CHAUVET est désigné pour remplir cette fonction. Pour rappel : La loi n° 2023-175 du 10 mars 2023 relative à l'accélération de la production d'énergies renouvelables vise à accélérer le développement des énergies renouvelables de manière à lutter contre le changement climatique et préserver la sécurité d'approvisionnement de la France en électricité. L'article 15 de la loi a introduit dans le code de l'énergie un dispositif de planification territoriale à la main des communes. D'ici la fin de l’année 2023, les communes sont invitées à identifier les zones d'accélération pour l'implantation d'installations terrestres de production d'énergie renouvelable. En application de l’article L141-5-3 du code de l'énergie, ces zones sont définies, pour chaque catégorie de sources et de types d'installation de production d'énergies renouvelables : éolien terrestre, photovoltaïque, méthanisation, hydroélectricité, géothermie, en tenant compte de la nécessaire diversification des énergies renouvelables en fonction des potentiels du territoire concerné et de la puissance des projets d'énergies renouvelables déjà installée. La zone d'accélération illustre la volonté de la commune d'orienter préférentiellement les projets vers des espaces qu'elle estime adaptés. Ces projets pourront bénéficier de mécanismes financiers incitatifs. En revanche, pour un projet, le fait d’être situé en zone d'accélération ne garantit pas la délivrance de son autorisation ou de son permis. Le projet doit dans tous les cas respecter les dispositions réglementaires applicables. Un projet peut également s'implanter en dehors des zones d'accélération. Dans ce cas, un comité de projet sera obligatoire. Ce comité inclura les différentes parties prenantes concernées par un projet d'énergie renouvelable, dont les communes limitrophes. Dans le cas où les zones d'accélération au niveau régional sont suffisantes pour atteindre les objectifs régionaux de développement des énergies renouvelables, la commune peut définir des zones d'exclusion de ces projets. Le conseil municipal de la commune de Chars, régulièrement convoqué, s'est réuni sous la présidence de Madame BOSSU Evelyne, afin de délibérer sur les zones d'accélération proposée par la commune sur son territoire. Madame le Maire constate que le conseil réunit les conditions pour délibérer valablement. Vu la loi n° 2023-175 du 10 mars 2023 relative à l'accélération de la production d'énergies renouvelables, notamment son article 15, 2, rue de Gisors 95750 Chars - Téléphone 01 30 39 72 36 - Télécopie 01 30 39 94 64 Envoyé en préfecture le 06/01/2024 Reçu en préfecture le 06/01/2024 Publié le ID : 095-219501426-20240105-032024-DE Madame le Maire présente les zones identifiées comme zones d'accélération pour le développement des énergies renouvelables ainsi que les arguments ayant conduit à ces propositions de zones. Conformément à la loi, une consultation du public a été effectuée du 19/12/2023 au 30/12/2023 selon les modalités suivantes : sur le site internet de la Commune et dossier consultable en libre d'accès en Mairie. - La Commune de Chars souhaite donc s'orienter principalement vers le développement de l’énergies solaire et a identifié, dans ce cadre, deux solutions : a/ Les ombrières photovoltaïques sur le parking de la gare, b/ Le photovoltaïque de toiture sur différents bâtiments communaux suffisamment dimensionnées pour accueillir des structures viables économiquement et sur l'ensemble des toitures de la ZA des 9 arpents. (détails des zones en annexe) Madame le Maire soumet cette proposition de zones à délibération. Suite à l'exposé de Madame le Maire et après avoir délibéré à l'unanimité des présents, le conseil municipal : - DEFINIT comme zones d'accélération des énergies renouvelables de la commune les zones proposées figurant en annexe à la présente délibération - __ VALIDE la transmission de la cartographie de ces zones à Madame le sous-préfet, référent préfectoral à l'instruction des projets d'énergies renouvelables et des projets industriels nécessaires à la transition énergétique, du département de Chars, ainsi qu’à la Communauté de Commune Vexin Centre dont elles sont membres. Certifié exécutoire À CHARS, le 05 Janvier 2024 compte tenu de la transmission Evelyne BOSSU, en sous-préfecture, le ….. et de la publication, le …"
+Answer: 06/01/2024
+
+"""
+
+# Everything specific to one document comes after the shared prefix
+TASK_TEMPLATE = """Current Task:
+[Date List]
+{Event_List}
+[Reference Text]
+{text}
+"""
+TEMPLATE_HASH = hashlib.sha256((PROMPT_VERSION + SHARED_PREFIX + TASK_TEMPLATE).encode('utf-8')).hexdigest()[:12]
+
+# columns read by the selection and written to the output file
+SELECTION_COLUMNS = ['local_filename', 'text_content', 'time_list', 'duplicate_of']
+# also read by --context windows
+WINDOW_COLUMNS = ['raw_text_content', 'time_offsets']
+OUTPUT_COLUMNS = ['doc_id', 'url', 'cache', 'text version', 'nature', 'published', 'entity', 'entity_type',
+                  'predicted_time', 'Gold_label']
 
-    return outputs
 
 if __name__ == "__main__":
-    # initialize VLLM engine
+    parser = argparse.ArgumentParser()
     # model = "/home/sidney/models_llm/hub/Qwen/Qwen2___5-14B-Instruct"
-    model = "/home/sidney/models_llm/hub/Qwen/Qwen2___5-7B-Instruct"
-    tokenizer = None
-    template = """
-    Select and Return ONLY EXACTLY ONE the most accurate publication date from the given date list and reference text, THE DATE YOU CHOOSE SHOULD APPEAR IN THE Date List:
-    
-    2 examples：
-    
-    Example 1:
-    [Date List]
-    ['31 janvier 2024','23/11/2023','10 mars 2023','15 janvier 2024','31 janvier','15 janvier 2024','en février 2024 et','le 01/12/2023','le 01/12/2023','le 01/12/2023']
-    [Reference Text]
-    "https://www.cc-bocage-bourbonnais.com/images/Délibération_ZA_Enr/20231130_Tronget.pdfCOMMUNE DE TRONGET EXTRAIT DU REGISTRE DES DÉLIBÉRATIONS République Française L’an deux mil vingt-trois, le jeudi 30 novembre 2023 à 19h30, le Conseil Municipal, Département de l’Allier dûment convoqué, s’est réuni salle de la Mairie sise 8 passage de la mairie, en session Arrondissement de Moulins ordinaire, sous la présidence du Maire, Jean-Marc DUMONT. Date de convocation : Présents : Patrick AMATHIEU, Elena BARANSKI, Daniel CANTE, Alain DETERNES, 23/11/2023 Jean-Marc DUMONT, Audrey GERAUD, Patricia RAYNAUD, Pascal RAYNAUD, Sylvain RIBIER, Franck VALETTE Nombre de conseillers : Excusés : Laurent BRUN, Jean-Marc CARTE, Stéphane HERAULT, Annie WEGRZYN En exercice : 14 Présents : 10 Votants : 14 Le quorum étant atteint, le | Pouvoirs: Laurent BRUN à Franck VALETTE, Jean-Marc CARTE à Jean-Marc Conseil Municipal peut | DUMONT, Stéphane HERAULT à Pascal RAYNAUD, Annie WEGRZYN à Eléna valablement délibérer. BARANSKI Secrétaire de séance : Daniel CANTE Zones d’Accélération des Energies Renouvelables N°36/2023 La loi n° 2023-175 du 10 mars 2023 relative à l’accélération de la production d’énergies renouvelables, dite loi APER, vise à accélérer et simplifier les projets d’implantation de producteurs d’énergie et à répondre à l’enjeu de l’acceptabilité locale. En particulier, son article 15 permet aux communes de définir, après concertation avec leurs administrés, des zones d’accélération où elles souhaitent prioritairement voir des projets d’énergies renouvelables s’implanter. Les zones d’accélération (ZAENR) concernent ainsi l’implantation d'installations terrestres de production d’énergies renouvelables, ainsi que de leurs ouvrages connexes. Ces ZAENR peuvent concerner toutes les énergies renouvelables (ENR). Elles sont définies, pour chaque catégorie de sources et de types d’installation de production d’ENR, en tenant compte de la nécessaire diversification des ENR, des potentiels du territoire concerné et de la puissance d’ENR déjà installée. (L.141-5-3 du code de l’énergie) Ces zones d’accélération ne sont pas des zones exclusives. Des projets pourront être autorisés en dehors. Toutefois, un comité de projet sera obligatoire pour ces projets, afin de garantir la bonne inclusion de la commune d’implantation et des communes limitrophes dans la conception du projet, au plus tôt et en continu. Les porteurs de projets seront, quoi qu’il en soit, incités à se diriger vers ces ZAENR qui témoignent d’une volonté politique et d’une adhésion locale du projet ENR. Monsieur le Maire précise que : ° Pour un projet, le fait d’être situé en zone d’accélération ne garantit pas son autorisation, celui-ci devant, dans tous les cas, respecter les dispositions réglementaires applicables et en tout état de cause l’instruction des projets reste faite au cas par cas. + Les zones doivent être à faibles enjeux environnementaux, agricoles et paysagers. + L’article L.314-41. du code de l’énergie prévoit que les candidats retenus à l’issue d’une procédure de mise en concurrence ou d’appel à projets sont tenus de financer notamment des projets portés par la commune ou par l’établissement public de coopération intercommunale à fiscalité propre d’implantation de l’installation en faveur de la transition énergétique. + Les communes identifient par délibération du conseil municipal des zones qui sont soumises à concertation du public selon les modalités qu’elles déterminent librement. Compte tenu de ces éléments, Monsieur le Maire expose : Les propositions de zones d’accélération pour les énergies renouvelables se fondent sur les critères suivants : + Des délaissés d’infrastructures, + __ Des zones dégradées, + Des terres agricoles inexploitables, + La présence de projets déjà connus, Les ZAENR proposées à la concertation sont les suivantes : + __ Solaire photovoltaïque : sur l’ensemble des bâtiments communaux et domaine public + __ Solaire photovoltaïque au sol dont ombrières : sur le domaine public et biens publics + _ Éolien, méthanisation : pas détermination de zone + Réseau de chaleur, bois-énergie, géothermie : projets communaux ou publics Les modalités de concertation proposées sont les suivantes : + Mise à disposition des documents et d’un registre en mairie du 15 janvier 2024 au 31 janvier 2024. + Mise à disposition des documents et d’un formulaire sur le site internet de la Communauté de Communes du Bocage Bourbonnais du 15 janvier 2024 au 31 janvier 2024. Le conseil municipal procédera à l’élaboration d’un bilan de la concertation en février 2024 et apportera les éventuelles modifications aux propositions des zones d’accélération des énergies renouvelables. Monsieur le Maire propose donc au conseil municipal d’émettre un avis favorable à : + La proposition de ZAENR pour leur mise en concertation du public, + La proposition des modalités de concertation. Après en avoir délibéré et à l'unanimité des membres présents et représentés, le Conseil Municipal décide : + D'’identifier les zones d’accélération pour l’implantation d’installations terrestres de production d’énergies renouvelables ainsi que leurs ouvrages connexes mentionnées ci- après, ainsi que sur les cartes annexées à la présente décision, qui seront soumises à concertation du public ; + Valide les modalités de concertation ; + Charge le maire ou son représentant de transmettre à l’EPCI, les zones identifiées pour concertation du public. ONT VOTE POUR : 14 ONT VOTE CONTRE : / SE SONT ABSTENUS : / ACTE EXECUTOIRE Reçu par le représentant de l’Etat le 01/12/2023 et publié le 01/12/2023 Pour extrait conforme au registre des délibérations du conseil municipal, Fait à Tronget, le 01/12/2023 Le Maire, UNS Jean-Marc DUMONT"
-    Answer:31 janvier 2024
-    
-    Example 2: 
-    [Date List]
-    ['06/01/2024','05 Janvier 2024','03-2024','10 mars 2023','10 mars 2023','le 06/01/2024','le 06/01/2024','19/12/2023','30/12/2023','le 05 Janvier 2024']
-    [Reference Text]
-    "https://mairiechars95.fr/wp-content/uploads/2024/03/Deliberation-3-Zone-dacceleration-des-energies-renouvelables.pdfEnvoyé en préfecture le 06/01/2024 RÉPUBLIQUE FRANÇAISE M À | FR | E D FC Reu en préfecturé1e06/0172024 VAL-D'OISE | Publié le ID : 095-219501426-20240105-032024-DE Extrait du registre des délibérations du conseil municipal de CHARS Séance du 05 Janvier 2024 03-2024 OBJET : Décision du conseil municipal sur les zones d'accélération des énergies renouvelables Présents : 15 Evelyne BOSSU Xavier BACHELET Ariane MARTIN Carole BOUILLONNEC Vincent DELCHOQUE Jean-Pierre BAZIN Sébastien RAVOISIER Sheila DEPUILLE Pierre-Antoine DHUICQ Patricia CHAILLOU-LEPAREUR Sylviane LEPAPE Gérard GENNISSON Nathalie GROM Philippe CHAUVET Nicolas BELANGÉ Absents et procurations : 4 Sandrine LHORSET excusée Nicolas PRIOUX excusé Agnès AGLAVE-LUCAS excusée Caroline BOURG Pouvoir à Sylviane LEPAPE Le Président a ouvert la séance et fait l’appel nominal, il a été procédé en conformité avec l’article L.2121-15 du code général des collectivités territoriales, à la nomination d'un secrétaire pris au sein du conseil. Monsieur Philippe CHAUVET est désigné pour remplir cette fonction. Pour rappel : La loi n° 2023-175 du 10 mars 2023 relative à l'accélération de la production d'énergies renouvelables vise à accélérer le développement des énergies renouvelables de manière à lutter contre le changement climatique et préserver la sécurité d'approvisionnement de la France en électricité. L'article 15 de la loi a introduit dans le code de l'énergie un dispositif de planification territoriale à la main des communes. D'ici la fin de l’année 2023, les communes sont invitées à identifier les zones d'accélération pour l'implantation d'installations terrestres de production d'énergie renouvelable. En application de l’article L141-5-3 du code de l'énergie, ces zones sont définies, pour chaque catégorie de sources et de types d'installation de production d'énergies renouvelables : éolien terrestre, photovoltaïque, méthanisation, hydroélectricité, géothermie, en tenant compte de la nécessaire diversification des énergies renouvelables en fonction des potentiels du territoire concerné et de la puissance des projets d'énergies renouvelables déjà installée. La zone d'accélération illustre la volonté de la commune d'orienter préférentiellement les projets vers des espaces qu'elle estime adaptés. Ces projets pourront bénéficier de mécanismes financiers incitatifs. En revanche, pour un projet, le fait d’être situé en zone d'accélération ne garantit pas la délivrance de son autorisation ou de son permis. Le projet doit dans tous les cas respecter les dispositions réglementaires applicables. Un projet peut également s'implanter en dehors des zones d'accélération. Dans ce cas, un comité de projet sera obligatoire. Ce comité inclura les différentes parties prenantes concernées par un projet d'énergie renouvelable, dont les communes limitrophes. Dans le cas où les zones d'accélération au niveau régional sont suffisantes pour atteindre les objectifs régionaux de développement des énergies renouvelables, la commune peut définir des zones d'exclusion de ces projets. Le conseil municipal de la commune de Chars, régulièrement convoqué, s'est réuni sous la présidence de Madame BOSSU Evelyne, afin de délibérer sur les zones d'accélération proposée par la commune sur son territoire. Madame le Maire constate que le conseil réunit les conditions pour délibérer valablement. Vu la loi n° 2023-175 du 10 mars 2023 relative à l'accélération de la production d'énergies renouvelables, notamment son article 15, 2, rue de Gisors 95750 Chars - Téléphone 01 30 39 72 36 - Télécopie 01 30 39 94 64 Envoyé en préfecture le 06/01/2024 Reçu en préfecture le 06/01/2024 Publié le ID : 095-219501426-20240105-032024-DE Madame le Maire présente les zones identifiées comme zones d'accélération pour le développement des énergies renouvelables ainsi que les arguments ayant conduit à ces propositions de zones. Conformément à la loi, une consultation du public a été effectuée du 19/12/2023 au 30/12/2023 selon les modalités suivantes : sur le site internet de la Commune et dossier consultable en libre d'accès en Mairie. - La Commune de Chars souhaite donc s'orienter principalement vers le développement de l’énergies solaire et a identifié, dans ce cadre, deux solutions : a/ Les ombrières photovoltaïques sur le parking de la gare, b/ Le photovoltaïque de toiture sur différents bâtiments communaux suffisamment dimensionnées pour accueillir des structures viables économiquement et sur l'ensemble des toitures de la ZA des 9 arpents. (détails des zones en annexe) Madame le Maire soumet cette proposition de zones à délibération. Suite à l'exposé de Madame le Maire et après avoir délibéré à l'unanimité des présents, le conseil municipal : - DEFINIT comme zones d'accélération des énergies renouvelables de la commune les zones proposées figurant en annexe à la présente délibération - __ VALIDE la transmission de la cartographie de ces zones à Madame le sous-préfet, référent préfectoral à l'instruction des projets d'énergies renouvelables et des projets industriels nécessaires à la transition énergétique, du département de Chars, ainsi qu’à la Communauté de Commune Vexin Centre dont elles sont membres. Certifié exécutoire À CHARS, le 05 Janvier 2024 compte tenu de la transmission Evelyne BOSSU, en sous-préfecture, le ….. et de la publication, le …"
-    Answer: 06/01/2024
-    
-    Current Task:
-    [Date List]
-    {Event_List}
-    [Reference Text]
-    {text}
-    
-    Rules:
-    1. Output exactly one date
-    2. Must be a date from the Date List
-    3. No explanations, no prefix, Only return result after assistant!
-    4. Keep original date format
-    
-    """
+    parser.add_argument("--model", type=str, default="/home/sidney/models_llm/hub/Qwen/Qwen2___5-7B-Instruct", help="Model path")
+    parser.add_argument("--input_csv", type=str, default="./dataset_valid_ner.csv", help="NER output csv")
+    parser.add_argument("--output_csv", type=str, default="final_results_predicted.csv", help="Output csv")
+    parser.add_argument("--backend", type=str, default="vllm", choices=["vllm", "fake", "openai"],
+                        help="openai: client of an OpenAI-compatible server at --base_url, e.g. vllm serve")
+    parser.add_argument("--base_url", type=str, default="http://127.0.0.1:8000", help="OpenAI-compatible server")
+    parser.add_argument("--tokenizer", type=str, default=None,
+                        help="openai: tokenizer for the chat template (default: --model, plain: no template)")
+    parser.add_argument("--max_in_flight", type=int, default=64, help="openai: concurrent requests to the server")
+    parser.add_argument("--request_timeout", type=float, default=300, help="openai: seconds per request")
+    parser.add_argument("--serve_fake", type=int, default=None, metavar="PORT",
+                        help="Serve the fake backend as an OpenAI-compatible server on this port")
+    parser.add_argument("--chunk_size", type=int, default=None, help="Prompts per generate call (default: all at once)")
+    parser.add_argument("--store", type=str, default=None,
+                        help="SQLite checkpoint file, written after every generate call: use with --chunk_size")
+    parser.add_argument("--response_cache", type=str, default=None, help="SQLite cache of completions by prompt")
+    parser.add_argument("--cache_max_mb", type=int, default=512, help="Size above which old completions are evicted")
+    parser.add_argument("--bypass_cache", action="store_true", help="Regenerate every prompt and refresh the cache")
+    parser.add_argument("--selection", type=str, default="generate", choices=["generate", "score"],
+                        help="score: rank the NER candidates by log-probability instead of generating an answer")
+    parser.add_argument("--cascade", action="store_true",
+                        help="Resolve trivial documents with rules, then --model, and escalate low-confidence answers")
+    parser.add_argument("--escalate_model", type=str, default="/home/sidney/models_llm/hub/Qwen/Qwen2___5-14B-Instruct",
+                        help="Cascade: model for the answers of --model below --escalate_threshold")
+    parser.add_argument("--escalate_threshold", type=float, default=0.7, help="Cascade: minimum confidence to keep an answer")
+    parser.add_argument("--context", type=str, default="truncate", choices=["truncate", "windows"],
+                        help="windows: header and text around each NER candidate instead of the first 4000 characters")
+    parser.add_argument("--context_tokens", type=int, default=512, help="Windows: token budget of the reference text")
+    parser.add_argument("--window_chars", type=int, default=150, help="Windows: characters kept on each side of a candidate")
+    parser.add_argument("--verbose", action="store_true", help="Log the answer of every file")
+    instrumentation.add_arguments(parser)
+    parser.add_argument("--benchmark_prefill", action="store_true",
+                        help="Count prefill tokens per document of --input_csv with the fake engine and exit")
+    parser.add_argument("--benchmark_context", action="store_true",
+                        help="Compare prompt tokens and accuracy of truncation and windows on --input_csv and exit")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    instrumentation.configure_from_args(args)
+
+    if args.serve_fake:
+        serve_fake(args.serve_fake)
+        raise SystemExit(0)
+    if args.benchmark_prefill:
+        benchmark_prefill(read_table(args.input_csv, SELECTION_COLUMNS))
+        raise SystemExit(0)
+    if args.benchmark_context:
+        dataframe = read_table(args.input_csv, SELECTION_COLUMNS + WINDOW_COLUMNS + ['text version', 'context', 'Gold_label'])
+        # the demo_data files call text_content "context"
+        dataframe = dataframe.rename(columns={'context': 'text_content'})
+        backend = build_backend(args.backend, args.model, base_url=args.base_url, tokenizer=args.tokenizer,
+                                max_in_flight=args.max_in_flight, request_timeout=args.request_timeout)
+        print(benchmark_context(dataframe, backend, args.selection, args.window_chars).to_string(
+            index=False, float_format="%.1f"))
+        raise SystemExit(0)
+
+    store = ResultStore(Path(args.store)) if args.store else None
+
+    # per model: its response cache and server counters, the engines themselves are released between tiers
+    usage: List[Tuple[str, Optional[ResponseCache], Optional[Dict[str, int]]]] = []
+
+    def make_selector(model: str) -> Callable[[], DateSelector]:
+        # initialize the engine once for the whole run
+        def make() -> DateSelector:
+            backend = build_backend(args.backend, model, args.response_cache, args.cache_max_mb, args.bypass_cache,
+                                    args.base_url, args.tokenizer, args.max_in_flight, args.request_timeout)
+            cache = backend.cache if isinstance(backend, CachedBackend) else None
+            engine = backend.backend if cache is not None else backend
+            usage.append((Path(model).name, cache, engine.stats if isinstance(engine, OpenAIBackend) else None))
+            return DateSelector(backend, chunk_size=args.chunk_size, store=store, mode=args.selection,
+                                context=args.context, window_chars=args.window_chars,
+                                context_tokens=args.context_tokens)
+        return make
 
+    if args.cascade:
+        selector = CascadeRouter([(Path(args.model).name, make_selector(args.model)),
+                                  (Path(args.escalate_model).name, make_selector(args.escalate_model))],
+                                 threshold=args.escalate_threshold)
+    else:
+        selector = make_selector(args.model)()
 
+    # the raw text is only needed to cut the windows
+    dataframe = read_table(args.input_csv, SELECTION_COLUMNS + OUTPUT_COLUMNS +
+                           (WINDOW_COLUMNS if args.context == "windows" else []))
+    # documents marked by dedup.py get the answer of their representative
+    duplicates = dedup.duplicate_map(dataframe)
+    representatives = dataframe[~dataframe['local_filename'].isin(duplicates)]
+    if duplicates:
+        logging.info(f"Selecting {len(representatives)} representatives, {len(duplicates)} duplicates copied")
+    with metrics.span("selection", documents=len(representatives)):
+        results_all = selector.select_dataframe(representatives)
+    metrics.memory("selection")
+    for file, results in results_all.items():
+        logging.debug(f"{file}: {results!r}")
+    if args.cascade and 'Gold_label' in dataframe.columns:
+        print(selector.report(representatives, results_all).to_string(index=False, float_format="%.1f"))
+    for name, cache, server in usage:
+        tier = f"{name}: " if args.cascade else ""
+        if cache is not None:
+            logging.info(f"{tier}Response cache: {cache.stats}, hit rate {cache.hit_rate():.1%}")
+        if server is not None:
+            logging.info(f"{tier}Server: {server['requests']} requests, {server['retries']} retries, "
+                         f"{server['prompt_tokens']} prompt / {server['completion_tokens']} completion tokens")
 
-    
-
-    dataframe_path = "./dataset_valid_ner.csv"
-    dataframe = pd.read_csv(dataframe_path)
-    file_list = dataframe['local_filename'].to_list()
-    # print(file_list[:40])
-    results_all ={}
-    counter = 1
-    total_file = len(file_list)
-    for file in file_list:
-        total_file -= counter
-        print(f"now start processing {file}, left{total_file} files  ")
-        row = dataframe[dataframe['local_filename']==file]
-        context = row['text_content'].iloc[0]# Preventing return series
-        # clean " \n"
-        context_cleaned= clean_text(context)
-        context_cleaned = context_cleaned[:4000]
-
-        timelist = row['time_list'].iloc[0]
-        input = template.format(Event_List=timelist,text=context_cleaned)
-        print(input)
-
-        outputs = get_completion(input, model, tokenizer=tokenizer, max_tokens=25, temperature=0.08, top_p=0.95)
-        for output in outputs:
-            results = output.outputs[0].text
-            print(results)
-        results_all[file] = results
-        # print(results_all)
-        # break
-    dataframe["predicted_time"] = dataframe['local_filename'].map(results_all)
-    df = dataframe[['doc_id','url','cache','text version','nature','published','entity','entity_type','predicted_time','Gold_label']]
-    df.to_csv("final_results_predicted.csv",index=False)
+    dataframe["predicted_time"] = dataframe['local_filename'].map(dedup.fan_out(results_all, duplicates))
+    columns = list(OUTPUT_COLUMNS)
+    if selector.confidences:
+        dataframe["confidence"] = dataframe['local_filename'].map(dedup.fan_out(selector.confidences, duplicates))
+        columns.append("confidence")
+    if args.cascade:
+        dataframe["tier"] = dataframe['local_filename'].map(dedup.fan_out(selector.routes, duplicates))
+        columns.append("tier")
+    df = dataframe[columns]
+    write_table(df, args.output_csv)
+    metrics.finish()
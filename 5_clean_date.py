@@ -2,82 +2,157 @@
 # python ./clean_date.py ./predicted_dates.csv -o ./cleaned_dates.csv
 
 import pandas as pd
+import numpy as np
 import re
+import time
 from datetime import datetime
+from functools import lru_cache
+from typing import Optional, Tuple
 import argparse
+from document_store import read_table, write_table
+from instrumentation import metrics
+import instrumentation
 
 # df = pd.read_csv('predicted_dates.csv')
 
-# regular expression for dates
+# month names are matched case-insensitively and with or without accents
+MONTH_ALTERNATION = r'janvier|f[eé]vrier|mars|avril|mai|juin|juillet|ao[uû]t|septembre|octobre|novembre|d[eé]cembre'
+
+# regular expression for dates, in priority order
 date_patterns = [
-    r'\b(\d{1,2})(?:\s*er)?\s*(janvier|Janvier|février|Février|mars|avril|mai|juin|Juin|juillet|août|septembre|octobre|Octobre|novembre|Novembre|décembre|JANVIER|FÉVRIER|FEVRIER|MARS|AVRIL|MAI|JUIN|JUILLET|AOÛT|SEPTEMBRE|OCTOBRE|NOVEMBRE|DÉCEMBRE|DECEMBRE)\s*(\d{4})?\b',  # “1er juillet 2023” or “10 FÉVRIER”
-    r'\b(\d{1,2})\s*/\s*(\d{1,2})\s*/\s*(\d{2,4})\b',  # “02/02/2023” or “2/2/20”
-    r'\b(\d{1,2})\s*[-/]\s*(\d{1,2})\s*[-/]\s*(\d{2}|\d{4})\b',  # “02-02-2023” or “27-02-20”
-    r'\b(\d{4})[-/](\d{1,2})[-/](\d{1,2})\b',  # “2023-10-01” or “23-10-01”
-    r'\b(janvier|février|mars|avril|mai|juin|juillet|août|septembre|octobre|Octobre|novembre|Novembre|décembre|JANVIER|FÉVRIER|MARS|AVRIL|MAI|JUIN|JUILLET|AOÛT|SEPTEMBRE|OCTOBRE|NOVEMBRE|DÉCEMBRE)\s+(\d{4})\b'  # “OCTOBRE 2022” or “octobre 2023”
+    rf'\b(?P<day1>\d{{1,2}})(?:\s*er)?\s*(?P<month1>{MONTH_ALTERNATION})\s*(?P<year1>\d{{4}})?\b',  # “1er juillet 2023” or “10 FÉVRIER”
+    r'\b(?P<day2>\d{1,2})\s*/\s*(?P<month2>\d{1,2})\s*/\s*(?P<year2>\d{2,4})\b',  # “02/02/2023” or “2/2/20”
+    r'\b(?P<day3>\d{1,2})\s*[-/]\s*(?P<month3>\d{1,2})\s*[-/]\s*(?P<year3>\d{2}|\d{4})\b',  # “02-02-2023” or “27-02-20”
+    r'\b(?P<year4>\d{4})[-/](?P<month4>\d{1,2})[-/](?P<day4>\d{1,2})\b',  # “2023-10-01” or “23-10-01”
+    rf'\b(?P<month5>{MONTH_ALTERNATION})\s+(?P<year5>\d{{4}})\b'  # “OCTOBRE 2022” or “octobre 2023”
 ]
 
-# convert month to number format
+# One pattern for all formats: each alternative scans the whole string before the next one is tried,
+# so the first format of date_patterns found anywhere wins, as with one re.search per pattern
+DATE_PATTERN = r'\A(?:' + '|'.join(
+    rf'.*?(?P<date{i}>{pattern})' for i, pattern in enumerate(date_patterns, 1)
+) + ')'
+DATE_FLAGS = re.IGNORECASE | re.DOTALL
+DATE_REGEX = re.compile(DATE_PATTERN, DATE_FLAGS)
+
+# é -> e, û -> u ... one character for one character
+ACCENT_FOLD = str.maketrans("àâäéèêëîïôöùûüç", "aaaeeeeiioouuuc")
+
+# convert month to number format, keys are lowercase without accents
 month_map = {
-    "janvier": "01", "Janvier": "01", "JANVIER": "01",
-    "février": "02", "Février": "02", "FÉVRIER": "02", "FEVRIER": "02", 
-    "mars": "03", "Mars": "03", "MARS": "03",
-    "avril": "04", "Avril": "04", "AVRIL": "04",
-    "mai": "05", "Mai": "05", "MAI": "05",
-    "juin": "06", "Juin": "06", "JUIN": "06",
-    "juillet": "07", "Juillet": "07", "JUILLET": "07",
-    "août": "08", "Août": "08", "AOÛT": "08",
-    "septembre": "09", "Septembre": "09", "SEPTEMBRE": "09",
-    "octobre": "10", "Octobre": "10", "OCTOBRE": "10",
-    "novembre": "11", "Novembre": "11", "NOVEMBRE": "11", 
-    "décembre": "12", "Décembre": "12", "DÉCEMBRE": "12", "DECEMBRE": "12"   
+    "janvier": "01", "fevrier": "02", "mars": "03", "avril": "04",
+    "mai": "05", "juin": "06", "juillet": "07", "aout": "08",
+    "septembre": "09", "octobre": "10", "novembre": "11", "decembre": "12"
 }
 
+
+def format_date(day: Optional[str], month: str, year: Optional[str]) -> Optional[str]:
+    """Unified "DD/MM/YYYY" format, None when the year is unknown"""
+    if not year:
+        return None
+    month = month_map.get(month.lower().translate(ACCENT_FOLD), month)
+    if len(year) == 2:
+        year = "20" + year  # assume the year is after 2000
+    return f"{int(day or 1):02}/{int(month):02}/{year}"
+
+
+@lru_cache(maxsize=1_000_000)
+def normalize_date(text: str) -> Tuple[Optional[str], Optional[str]]:
+    """Single pass over one string: (extracted date, cleaned "DD/MM/YYYY" date)"""
+    match = DATE_REGEX.match(text)
+    if not match:
+        return None, None
+    # the outer date{i} group closes last, so it names the format that matched
+    i = match.lastgroup[4:]
+    day = match.group(f'day{i}') if i != '5' else None
+    return match.group(0)[match.start(f'date{i}'):], format_date(day, match.group(f'month{i}'), match.group(f'year{i}'))
+
+
+def candidate_key(text: str) -> Tuple[str, str]:
+    """(group key, surface form) of a candidate date, so that "le 01/12/2023" and "1er décembre 2023" are one date
+
+    The key is the cleaned date, "MM/YYYY" for a month without a day (it would otherwise clean to the 1st),
+    or the lowercase text when there is no year. The surface form is the date without its surroundings.
+    """
+    extracted, cleaned = normalize_date(text)
+    if cleaned is None:
+        form = extracted or text.strip()
+        return form.lower(), form
+    # formats with a day start with a digit, "octobre 2022" starts with the month
+    return (cleaned if extracted[0].isdigit() else cleaned[3:]), extracted
+
+
 # extract date from predicted_dates
 def extract_date(text):
-    for pattern in date_patterns:
-        match = re.search(pattern, text)
-        if match:
-            return match.group(0)
-    return None
+    return normalize_date(str(text))[0]
 
 # clean the date into a unified format from extracted_dates
 def clean_date(date_str):
     if not date_str:
         return None
-    for pattern in date_patterns:
-        match = re.search(pattern, date_str)
-        if match:
-            groups = match.groups()
-            if len(groups) == 3:
-                day, month, year = groups
-            elif len(groups) == 2:
-                day = "01"
-                month, year = groups
-            else:
-                continue      
-            month = month_map.get(month, month)    
-            if year and len(year) == 2:
-                year = "20" + year  # assume the year is after 2000
-            try:
-                return f"{int(day):02}/{month}/{year}"  # "DD/MM/YYYY"
-            except ValueError:
-                return None
-    return None
+    return normalize_date(str(date_str))[1]
+
+
+def normalize_dates(values: pd.Series) -> pd.DataFrame:
+    """Column-wise normalize_date: returns extracted_date and cleaned_date, each distinct string is scanned once"""
+    with metrics.span("cleaning", documents=len(values)):
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        parsed = pd.DataFrame([normalize_date(str(text)) for text in uniques],
+                              columns=['extracted_date', 'cleaned_date'], dtype=object)
+    metrics.count("cleaning.values", len(values))
+    metrics.count("cleaning.distinct_values", len(uniques))
+    metrics.count("cleaning.unparsed_values", int(parsed['cleaned_date'].isna().sum()))
+    result = parsed.iloc[codes]
+    result.index = values.index
+    return result
+
+
+def benchmark(n_rows: int, seed: int = 0) -> None:
+    """Time normalize_dates on synthetic LLM answers"""
+    rng = np.random.default_rng(seed)
+    samples = np.array([
+        " Assistant:le 16 janvier 2023, 12 décembre 2023 30", "1er juillet 2023", "10 FÉVRIER 2024", "06/01/2024",
+        "27-02-20", "2023-10-01", "OCTOBRE 2022", "Mars 2021", "Publié le 5 Août 2023", "pas de date",
+    ])
+    # half repeated answers, half unique ones
+    texts = samples[rng.integers(0, len(samples), n_rows)].astype(object)
+    unique = rng.random(n_rows) < 0.5
+    texts[unique] = [f"délibération n°{i} du {d} mai {y}" for i, d, y in zip(
+        np.flatnonzero(unique), rng.integers(1, 29, unique.sum()), rng.integers(2000, 2030, unique.sum())
+    )]
+    series = pd.Series(texts)
+
+    normalize_date.cache_clear()
+    for run in ("cold memo", "warm memo"):
+        start = time.perf_counter()
+        normalize_dates(series)
+        elapsed = time.perf_counter() - start
+        print(f"{n_rows} rows, {run}: {elapsed:.2f}s ({n_rows / elapsed:,.0f} rows/s)")
 
 #### main
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("input_csv", type=str, help="input csv file")
-    parser.add_argument("-o", "--output_csv", type=str, help="output csv file",required=True)
+    parser.add_argument("input_csv", type=str, nargs="?", help="input csv file")
+    parser.add_argument("-o", "--output_csv", type=str, help="output csv file")
+    parser.add_argument("--benchmark", type=int, default=None, help="benchmark on this many synthetic rows and exit")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    instrumentation.configure_from_args(args)
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+        raise SystemExit(0)
+    if not args.input_csv or not args.output_csv:
+        parser.error("input_csv and -o/--output_csv are required")
 
-    df = pd.read_csv(args.input_csv)
-    df['extracted_date'] = df['predicted_time'].apply(lambda x: extract_date(str(x)))
-    df['cleaned_prediction_date'] = df['extracted_date'].apply(lambda x: clean_date(x))
-    df['cleaned_gold_label'] = df['Gold_label'].apply(lambda x: clean_date(x))
+    df = read_table(args.input_csv)
+    dates = normalize_dates(df['predicted_time'])
+    df['extracted_date'] = dates['extracted_date']
+    df['cleaned_prediction_date'] = dates['cleaned_date']
+    df['cleaned_gold_label'] = normalize_dates(df['Gold_label'])['cleaned_date']
     # print(df.columns.to_list())
     # print(df[['predicted_time', 'extracted_date', 'cleaned_date']])
     df = df[['doc_id', 'url', 'cache', 'text version', 'nature', 'published', 'entity', 'entity_type', 'Gold_label','cleaned_prediction_date','cleaned_gold_label']]
-    df.to_csv(args.output_csv, index=False)
+    write_table(df, args.output_csv)
+    metrics.finish()
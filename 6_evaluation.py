@@ -1,14 +1,178 @@
-import pandas as pd
+# Using this command to compare several runs (prediction files, or every selection config of a checkpoint store)
+# python ./6_evaluation.py -i ./run_7B.csv ./run_14B.csv --traces ./run_7B.jsonl ./run_14B.jsonl --report ./comparison.csv --target 85
+# python ./6_evaluation.py -i ./results.sqlite --gold ./dataset_valid_ner.csv --report ./comparison.csv
+"""Accuracy of the predictions against the gold labels
+
+With one input, -o writes the per-document file of run.sh. With --report, every input is evaluated in its own
+process and the runs are compared side by side: accuracy with a bootstrap confidence interval, matches at the
+year and month level, accuracy per nature and entity_type, and the cost recorded in the --trace file of the run
+(seconds and tokens per document). --target picks the cheapest run that reaches the accuracy bar.
+
+An input is a prediction file of 4_llm_reference.py, 5_clean_date.py or this script, or a results.sqlite of
+--store where each selection configuration is one run (its answers are joined with --gold by local_filename).
+"""
 import argparse
+import importlib
+import multiprocessing
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from document_store import read_table, write_table
+from instrumentation import metrics
+import instrumentation
+from result_store import ResultStore
+
+date_cleaning = importlib.import_module("5_clean_date")
+
+GROUP_COLUMNS = ['nature', 'entity_type']
+# the only columns read from a prediction file, never the document text
+EVALUATION_COLUMNS = ['local_filename', 'doc_id', 'predicted_time', 'cleaned_prediction_date', 'predicted_date',
+                      'Gold_label', 'cleaned_gold_label', 'gold_label', 'published'] + GROUP_COLUMNS
+# slices of the "DD/MM/YYYY" dates of 5_clean_date.py
+PARTS = {'accuracy': slice(0, 10), 'month_acc': slice(3, 10), 'year_acc': slice(6, 10)}
+
+
+def list_runs(inputs: List[str], names: Optional[List[str]], traces: Optional[List[str]]) -> List[Dict[str, object]]:
+    """One run per prediction file, one per selection configuration of a results.sqlite"""
+    runs = []
+    for i, path in enumerate(inputs):
+        name = names[i] if names else Path(path).stem
+        trace = traces[i] if traces else None
+        if Path(path).suffix == '.sqlite':
+            store = ResultStore(Path(path))
+            runs += [{'name': f"{name}:{config}", 'path': path, 'config': config, 'trace': trace}
+                     for config in store.configs('selection')]
+            store.close()
+        else:
+            runs.append({'name': name, 'path': path, 'config': None, 'trace': trace})
+    return runs
+
+
+def load_run(run: Dict[str, object], gold_path: Optional[str]) -> pd.DataFrame:
+    """Predictions of a run with cleaned_prediction_date, cleaned_gold_label and the group columns"""
+    if run['config'] is not None:
+        store = ResultStore(Path(run['path']))
+        values = store.values('selection', run['config'])
+        store.close()
+        # score mode stores [answer, confidence]
+        df = pd.DataFrame({'local_filename': list(values),
+                           'predicted_time': [v[0] if isinstance(v, list) else v for v in values.values()]})
+    else:
+        df = read_table(run['path'], EVALUATION_COLUMNS)
+    # the output of this script
+    df = df.rename(columns={'predicted_date': 'cleaned_prediction_date', 'gold_label': 'cleaned_gold_label'})
+    if gold_path:
+        gold = read_table(gold_path, ['local_filename', 'doc_id', 'Gold_label', 'cleaned_gold_label', 'published']
+                          + GROUP_COLUMNS)
+        # pipeline_result.csv has no local_filename
+        key = 'local_filename' if 'local_filename' in df.columns and 'local_filename' in gold.columns else 'doc_id'
+        replaced = set(gold.columns) | {'Gold_label', 'cleaned_gold_label'}
+        df = df.drop(columns=[c for c in df.columns if c in replaced and c != key])
+        df = df.merge(gold.drop(columns=[c for c in ('local_filename', 'doc_id') if c != key and c in gold.columns]),
+                      on=key, how='inner')
+    if 'cleaned_prediction_date' not in df.columns:
+        df['cleaned_prediction_date'] = date_cleaning.normalize_dates(df['predicted_time'])['cleaned_date']
+    if 'cleaned_gold_label' not in df.columns:
+        df['cleaned_gold_label'] = date_cleaning.normalize_dates(df['Gold_label'])['cleaned_date']
+    return df
+
+
+def matches(df: pd.DataFrame) -> pd.DataFrame:
+    """Per document: exact date, same month and year, same year, and the published date of Datapolitics"""
+    predicted = df['cleaned_prediction_date'].astype('string')
+    gold = df['cleaned_gold_label'].astype('string')
+    result = pd.DataFrame({
+        name: (predicted.str[part] == gold.str[part]).fillna(False).astype(bool) for name, part in PARTS.items()
+    }, index=df.index)
+    if 'published' in df.columns:
+        result['given_acc'] = (df['published'].astype('string') == gold).fillna(False).astype(bool)
+    return result
+
+
+def bootstrap(correct: np.ndarray, n_resamples: int, rng: np.random.Generator,
+              level: float = 0.95) -> Tuple[float, float]:
+    """Percentile bootstrap interval of an accuracy, in %
+
+    Resampling the n documents with replacement draws the number of correct ones from Binomial(n, accuracy),
+    so the resamples are drawn directly instead of indexing n documents each time.
+    """
+    n = len(correct)
+    if n == 0:
+        return np.nan, np.nan
+    means = rng.binomial(n, correct.mean(), size=n_resamples) / n * 100
+    return float(np.percentile(means, (1 - level) / 2 * 100)), float(np.percentile(means, (1 + level) / 2 * 100))
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input_file", required=True, type=str, help="Input file")
-    parser.add_argument("-o", "--output_file", required=True, type=str, help="Output file")
-    args = parser.parse_args()
 
+def trace_costs(path: str, documents: int) -> Dict[str, float]:
+    """Seconds and tokens per document from the --trace file of the run"""
+    events = pd.read_json(path, lines=True)
+    spans = events[events['type'] == 'span'].groupby('name')['duration_ms'].sum() / 1000
+    counters = events[events['type'] == 'count'].groupby('name')['value'].sum()
+    documents = max(documents, 1)
+    return {
+        'ner_s_per_doc': (spans.get('ner', 0) + spans.get('pipeline.ner', 0)) / documents,
+        'selection_s_per_doc': (spans.get('selection', 0) + spans.get('pipeline.selection', 0)) / documents,
+        'prompt_tokens_per_doc': counters.get('llm.prompt_tokens', 0) / documents,
+        'generated_tokens_per_doc': counters.get('llm.generated_tokens', 0) / documents,
+    }
+
+
+def evaluate_run(run: Dict[str, object], gold_path: Optional[str], n_resamples: int = 1000,
+                 seed: int = 0) -> Tuple[Dict[str, object], pd.DataFrame]:
+    """Summary row of a run, and its accuracy per nature / entity_type"""
+    df = load_run(run, gold_path)
+    found = matches(df)
+    rng = np.random.default_rng(seed)
+    low, high = bootstrap(found['accuracy'].to_numpy(), n_resamples, rng)
+    summary = {'run': run['name'], 'documents': len(df), **(found.mean() * 100).to_dict(),
+               'ci_low': low, 'ci_high': high}
+    if run['trace']:
+        summary.update(trace_costs(run['trace'], len(df)))
+
+    groups = []
+    for column in GROUP_COLUMNS:
+        if column not in df.columns:
+            continue
+        for value, rows in found.groupby(df[column].fillna('unknown')):
+            low, high = bootstrap(rows['accuracy'].to_numpy(), n_resamples, rng)
+            groups.append({'run': run['name'], 'column': column, 'group': value, 'documents': len(rows),
+                           **(rows[list(PARTS)].mean() * 100).to_dict(), 'ci_low': low, 'ci_high': high})
+    return summary, pd.DataFrame(groups)
+
+
+def compare(runs: List[Dict[str, object]], gold_path: Optional[str], n_resamples: int = 1000, seed: int = 0,
+            workers: int = 4) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """evaluate_run of every run, in parallel processes"""
+    arguments = [(run, gold_path, n_resamples, seed) for run in runs]
+    if workers > 1 and len(runs) > 1:
+        with multiprocessing.get_context('spawn').Pool(min(workers, len(runs))) as pool:
+            results = pool.starmap(evaluate_run, arguments)
+    else:
+        results = [evaluate_run(*args) for args in arguments]
+    return pd.DataFrame([summary for summary, _ in results]), pd.concat([groups for _, groups in results],
+                                                                        ignore_index=True)
+
+
+def cheapest(summary: pd.DataFrame, target: float, cost: str = "seconds") -> Optional[pd.Series]:
+    """Run with the lowest cost (seconds or prompt tokens per document) among those reaching the target
+    accuracy, the most accurate one when no cost was recorded"""
+    reaching = summary[summary['accuracy'] >= target]
+    if reaching.empty:
+        return None
+    columns = ['ner_s_per_doc', 'selection_s_per_doc'] if cost == "seconds" else ['prompt_tokens_per_doc']
+    columns = [c for c in columns if c in reaching.columns]
+    if columns and reaching[columns].notna().any(axis=None):
+        return reaching.loc[reaching[columns].sum(axis=1, min_count=1).idxmin()]
+    return reaching.loc[reaching['accuracy'].idxmax()]
+
+
+def write_document_file(input_file: str, output_file: str) -> None:
+    """Per-document file of run.sh, with the two overall accuracies in the first row"""
     # Read input CSV file
-    df = pd.read_csv(args.input_file)
+    with metrics.span("evaluation.read"):
+        df = read_table(input_file)
 
     # Calculate accuracy between 'published' and 'cleaned_gold_label'
     df['Given_acc'] = (df['published'] == df['cleaned_gold_label']).astype(int)
@@ -37,19 +201,72 @@ if __name__ == '__main__':
         'cleaned_gold_label': 'gold_label'
     })
 
+    metrics.count("evaluation.documents", len(df))
+    metrics.gauge("evaluation.given_acc", df_filtered['given_acc'].iloc[0])
+    metrics.gauge("evaluation.our_prediction_acc", df_filtered['our_prediction_acc'].iloc[0])
+
     # Print accuracies
     print(f"Accuracy from Datapolitics: {df_filtered['given_acc'].iloc[0]:.2f}%")
     print(f"Accuracy from Our prediction: {df_filtered['our_prediction_acc'].iloc[0]:.2f}%")
 
-    # # Print available columns
-    # print("\nAvailable columns:")
-    # print(df_filtered.columns.tolist())
-
     # Save to output file
-    if args.output_file.endswith('.csv'):
-        output_path = args.output_file
+    if output_file.endswith(('.csv', '.parquet', '.arrow')):
+        output_path = output_file
     else:
-        output_path = args.output_file + '/evaluation.csv'
+        output_path = output_file + '/evaluation.csv'
 
-    df_filtered.to_csv(output_path, index=False)
+    write_table(df_filtered, output_path)
     print(f"\nResults saved to: {output_path}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input_file", required=True, type=str, nargs="+",
+                        help="Prediction file(s), or results.sqlite checkpoint store(s)")
+    parser.add_argument("-o", "--output_file", type=str, default=None, help="Per-document output file (one input)")
+    parser.add_argument("--report", type=str, default=None,
+                        help="Compare the runs: summary here, accuracy per nature/entity_type in <report>_groups")
+    parser.add_argument("--names", type=str, nargs="+", default=None, help="Run names (default: file names)")
+    parser.add_argument("--traces", type=str, nargs="+", default=None,
+                        help="--trace file of each input, for the seconds and tokens per document")
+    parser.add_argument("--gold", type=str, default=None,
+                        help="File with local_filename and Gold_label (and nature, entity_type, published) to join")
+    parser.add_argument("--target", type=float, default=None, help="Accuracy bar: report the cheapest run above it")
+    parser.add_argument("--cost", type=str, default="seconds", choices=["seconds", "tokens"],
+                        help="Cost minimized by --target: NER + selection seconds, or prompt tokens per document")
+    parser.add_argument("--bootstrap", type=int, default=1000, help="Resamples of the confidence intervals")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=4, help="Runs evaluated in parallel")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args(args)
+    for option, values in (('--names', args.names), ('--traces', args.traces)):
+        if values and len(values) != len(args.input_file):
+            parser.error(f"{option} needs one value per input")
+    if args.output_file and len(args.input_file) > 1:
+        parser.error("-o writes the per-document file of a single input, use --report to compare several")
+    if not args.output_file and not args.report:
+        parser.error("nothing to do: give -o and/or --report")
+
+    if args.output_file:
+        write_document_file(args.input_file[0], args.output_file)
+
+    if args.report:
+        runs = list_runs(args.input_file, args.names, args.traces)
+        with metrics.span("evaluation.compare", runs=len(runs)):
+            summary, groups = compare(runs, args.gold, args.bootstrap, args.seed, args.workers)
+        print(summary.to_string(index=False, float_format="%.2f"))
+        if not groups.empty:
+            # one accuracy column per run, the full table (partial matches, intervals) is in the file
+            print(groups.pivot_table(index=['column', 'group'], columns='run', values='accuracy', sort=False)
+                  .to_string(float_format="%.2f"))
+        report_path = Path(args.report)
+        write_table(summary, report_path)
+        write_table(groups, report_path.with_name(report_path.stem + "_groups" + report_path.suffix))
+        print(f"\nReport saved to: {report_path}")
+        if args.target is not None:
+            best = cheapest(summary, args.target, args.cost)
+            print(f"Cheapest run with accuracy >= {args.target}%: "
+                  f"{best['run'] if best is not None else 'none'}")
+
+    metrics.finish()
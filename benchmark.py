@@ -0,0 +1,231 @@
+# Using this command to benchmark every stage on synthetic documents and compare with a previous run
+# python ./benchmark.py --docs 500 --size 8000 -o ./benchmark.json --baseline ./benchmark_previous.json
+"""Per-stage throughput, latency and memory on synthetic délibérations
+
+Documents are generated offline with a fixed seed: a French municipal council délibération (header, séance,
+présents, exposé, vu/considérant, décision, transmission stamps) with dates embedded in every format
+5_clean_date.py understands. Each stage runs alone in a fresh process over the same documents, one document
+at a time, so its latencies and its peak RSS are its own. The LLM stages use the fake backend and the NER
+model only runs when --ner_model is given.
+"""
+import argparse
+import importlib
+import json
+import multiprocessing
+import platform
+import resource
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+MONTHS = ["janvier", "février", "mars", "avril", "mai", "juin", "juillet", "août", "septembre", "octobre",
+          "novembre", "décembre"]
+COMMUNES = ["Saint-Ay", "Chars", "Racan", "Montigny", "Villeneuve", "Beaumont", "Val-de-Reuil", "Sainte-Marie"]
+NAMES = ["Evelyne BOSSU", "Xavier BACHELET", "Ariane MARTIN", "Vincent DELCHOQUE", "Sheila DEPUILLE",
+         "Patricia CHAILLOU", "Gérard GENNISSON", "Nathalie GROM", "Philippe CHAUVET", "Nicolas BELANGÉ"]
+SUBJECTS = ["zones d'accélération des énergies renouvelables", "tarifs de la restauration scolaire",
+            "budget primitif", "convention de mise à disposition du personnel", "subvention aux associations",
+            "modification du plan local d'urbanisme", "travaux de voirie", "recrutement d'agents contractuels"]
+FILLER = ("Le conseil municipal, après en avoir délibéré, à l'unanimité des membres présents et représentés, "
+          "approuve la proposition présentée et autorise Madame le Maire à signer tout document s'y rapportant. "
+          "Les crédits nécessaires sont inscrits au budget de l'exercice en cours. ")
+
+
+def format_date(rng: np.random.Generator, day: int, month: int, year: int, fmt: Optional[int] = None) -> str:
+    """One date in one of the formats of 5_clean_date.date_patterns, chosen at random when fmt is None"""
+    fmt = rng.integers(0, 7) if fmt is None else fmt
+    name = MONTHS[month - 1]
+    return [
+        f"{day} {name} {year}",
+        f"{'1er' if day == 1 else day} {name.upper()} {year}",
+        f"{day:02}/{month:02}/{year}",
+        f"{day}/{month}/{year % 100:02}",
+        f"{day:02}-{month:02}-{year % 100:02}",
+        f"{year}-{month:02}-{day:02}",
+        f"{name.capitalize()} {year}",
+    ][fmt]
+
+
+def generate_document(rng: np.random.Generator, size: int) -> Dict[str, str]:
+    """A délibération of about `size` characters, its publication date and its séance date"""
+    year = int(rng.integers(2019, 2025))
+    month = int(rng.integers(1, 13))
+    day = int(rng.integers(1, 27))
+    published_day = day + int(rng.integers(1, 3))
+    commune = COMMUNES[rng.integers(len(COMMUNES))]
+    subject = SUBJECTS[rng.integers(len(SUBJECTS))]
+    present = rng.choice(NAMES, size=int(rng.integers(4, len(NAMES))), replace=False)
+
+    def random_date() -> str:
+        return format_date(rng, int(rng.integers(1, 29)), int(rng.integers(1, 13)), int(rng.integers(2010, 2025)))
+
+    stamp = (f"Envoyé en préfecture le {format_date(rng, published_day, month, year, 2)} "
+             f"Reçu en préfecture le {format_date(rng, published_day, month, year, 2)} "
+             f"Publié le ID : 0{rng.integers(10, 99)}-{rng.integers(200000000, 299999999)}-{year}{month:02}{day:02}-DE ")
+    parts = [
+        stamp,
+        f"RÉPUBLIQUE FRANÇAISE Extrait du registre des délibérations du conseil municipal de {commune.upper()} ",
+        f"Séance du {format_date(rng, day, month, year)} ",
+        f"OBJET : {subject} ",
+        f"Présents : {len(present)} {' '.join(present)} ",
+        f"Le {format_date(rng, day, month, year, 0)}, le conseil municipal, régulièrement convoqué le "
+        f"{format_date(rng, max(day - 5, 1), month, year)}, s'est réuni sous la présidence du Maire. ",
+    ]
+    body = []
+    while sum(map(len, parts + body)) < size - 200:
+        kind = rng.integers(0, 4)
+        if kind == 0:
+            body.append(f"Vu la loi n° {year - 1}-{rng.integers(100, 999)} du {random_date()} relative à {subject}, ")
+        elif kind == 1:
+            body.append(f"Vu la délibération du {random_date()} portant sur {SUBJECTS[rng.integers(len(SUBJECTS))]}, ")
+        elif kind == 2:
+            body.append(f"Considérant la consultation du public du {random_date()} au {random_date()}, ")
+        else:
+            body.append(FILLER)
+    parts += body
+    parts.append(f"Certifié exécutoire À {commune.upper()}, le {format_date(rng, published_day, month, year)} "
+                 f"compte tenu de la transmission en préfecture, le ….. et de la publication, le …")
+    return {
+        'text': ''.join(parts),
+        'published': f"{published_day:02}/{month:02}/{year}",
+        'seance': f"{day:02}/{month:02}/{year}",
+    }
+
+
+def generate_corpus(n_docs: int, size: int = 8000, seed: int = 0) -> pd.DataFrame:
+    """Synthetic dataset_valid.csv rows: same columns as the output of 1_dataset_rebuild.py plus Gold_label"""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in range(n_docs):
+        document = generate_document(rng, size)
+        url = f"https://example.org/deliberations/{i}.pdf"
+        rows.append({
+            'doc_id': f"synthetic/{i}.pdf",
+            'url': url,
+            'text version': url + ".txt",
+            'nature': 'deliberation',
+            'published': document['published'],
+            'local_filename': f"synthetic_{i}.txt",
+            'text_content': (url + document['text'])[:4000],
+            'raw_text_content': document['text'][:8000],
+            'Gold_label': document['published'],
+        })
+    return pd.DataFrame(rows)
+
+
+def make_stage(name: str, corpus: pd.DataFrame, ner_model: Optional[str]) -> Callable[[int], object]:
+    """Function running the stage on document i, everything it needs is loaded here, outside of the timings"""
+    if name == 'clean_text':
+        llm_reference = importlib.import_module("4_llm_reference")
+        return lambda i: llm_reference.clean_text(corpus['text_content'].iat[i])
+    if name == 'ner_rules':
+        extractor = importlib.import_module("2_ner").RuleDateExtractor()
+        return lambda i: extractor.extract(corpus['raw_text_content'].iat[i])
+    if name == 'ner_model':
+        processor = importlib.import_module("2_ner").OptimizedNERProcessor(ner_model, batch_size=1, num_workers=0)
+        return lambda i: processor.process_text(corpus['raw_text_content'].iat[i])
+    if name in ('build_prompt', 'selection_fake'):
+        llm_reference = importlib.import_module("4_llm_reference")
+        extractor = importlib.import_module("2_ner").RuleDateExtractor()
+        backend = llm_reference.FakeBackend()
+        time_lists = [str(extractor.extract(text)) for text in corpus['raw_text_content']]
+
+        def prompt(i: int) -> str:
+            return llm_reference.build_prompt(time_lists[i], corpus['text_content'].iat[i], 4000,
+                                              backend.apply_chat_template)
+        if name == 'build_prompt':
+            return prompt
+        prompts = [prompt(i) for i in range(len(corpus))]
+        return lambda i: backend.generate([prompts[i]], max_tokens=25)
+    if name == 'clean_date':
+        date_cleaning = importlib.import_module("5_clean_date")
+        date_cleaning.normalize_date.cache_clear()
+        # answers as the LLM writes them: a date in any format, sometimes with a prefix
+        answers = [f"Assistant: {text[text.find('Séance du') + 10:][:30]}" for text in corpus['raw_text_content']]
+        return lambda i: date_cleaning.clean_date(date_cleaning.extract_date(answers[i]))
+    raise ValueError(f"Unknown stage {name}")
+
+
+STAGES = ['clean_text', 'ner_rules', 'ner_model', 'build_prompt', 'selection_fake', 'clean_date']
+
+
+def run_stage(name: str, n_docs: int, size: int, seed: int, ner_model: Optional[str], queue) -> None:
+    """Runs in a fresh process: the peak RSS is the one of this stage alone"""
+    corpus = generate_corpus(n_docs, size, seed)
+    stage = make_stage(name, corpus, ner_model)
+    latencies = []
+    start = time.perf_counter()
+    for i in range(n_docs):
+        doc_start = time.perf_counter()
+        stage(i)
+        latencies.append(time.perf_counter() - doc_start)
+    elapsed = time.perf_counter() - start
+    queue.put({
+        'docs': n_docs,
+        'docs_per_s': n_docs / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def run_benchmark(stages: List[str], n_docs: int, size: int, seed: int = 0,
+                  ner_model: Optional[str] = None) -> Dict[str, object]:
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for name in stages:
+        if name == 'ner_model' and not ner_model:
+            continue
+        queue = context.Queue()
+        process = context.Process(target=run_stage, args=(name, n_docs, size, seed, ner_model, queue))
+        process.start()
+        results[name] = queue.get()
+        process.join()
+    return {
+        'config': {'docs': n_docs, 'size': size, 'seed': seed, 'ner_model': ner_model},
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'processor': platform.processor()},
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'stages': results,
+    }
+
+
+def compare(current: Dict[str, object], baseline: Dict[str, object]) -> pd.DataFrame:
+    """Relative change of every metric against a previous run, negative docs_per_s is a regression"""
+    rows = []
+    for name, metrics in current['stages'].items():
+        previous = baseline['stages'].get(name)
+        if previous is None:
+            continue
+        rows.append({'stage': name, **{
+            f"{metric} change %": (metrics[metric] / previous[metric] - 1) * 100
+            for metric in ('docs_per_s', 'p50_ms', 'p99_ms', 'peak_rss_mb') if previous.get(metric)
+        }})
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=200, help="Synthetic documents per stage")
+    parser.add_argument("--size", type=int, default=8000, help="Characters per document")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", type=str, nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--ner_model", type=str, default=None, help="Also time the NER model (name or local path)")
+    parser.add_argument("-o", "--output", type=str, default="benchmark.json", help="JSON report")
+    parser.add_argument("--baseline", type=str, default=None, help="Previous JSON report to compare with")
+    parser.add_argument("--sample", type=str, default=None, help="Only write the synthetic corpus to this file and exit")
+    args = parser.parse_args()
+
+    if args.sample:
+        importlib.import_module("document_store").write_table(generate_corpus(args.docs, args.size, args.seed), args.sample)
+        raise SystemExit(0)
+
+    report = run_benchmark(args.stages, args.docs, args.size, args.seed, args.ner_model)
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(pd.DataFrame(report['stages']).T.to_string(float_format="%.2f"))
+    print(f"Report saved to {args.output}")
+    if args.baseline:
+        print(compare(report, json.loads(Path(args.baseline).read_text())).to_string(index=False, float_format="%+.1f"))
@@ -0,0 +1,291 @@
+# Using this command to mark the duplicate documents of a stage file, then 2_ner.py / 4_llm_reference.py skip them
+# python ./dedup.py ./dataset_valid.csv -o ./dataset_valid.csv --threshold 0.9
+# python ./dedup.py --benchmark 50000
+"""Near-duplicate documents, so that the NER and the selection run once per cluster
+
+Délibérations are republished under several URLs, or copied almost word for word from one commune to the
+next. Every document gets a MinHash signature of its word shingles. LSH cuts the signature into bands and
+a document is only compared with the representatives sharing one whole band with it: a document costs one
+signature and a few dictionary lookups whatever the corpus size, never a pass over the other documents.
+Documents with identical words are found first by their hash.
+
+A document whose estimated Jaccard similarity with a representative reaches the threshold gets the file
+name of that representative in the `duplicate_of` column, the others become representatives. Documents are
+only compared with representatives, so every document is within the threshold of the one its results are
+copied from and a chain of small edits cannot drift into one cluster. 2_ner.py, 4_llm_reference.py and
+pipeline.py then process the documents without `duplicate_of` and copy their columns to the duplicates.
+"""
+import argparse
+import importlib
+import logging
+import multiprocessing
+import re
+import resource
+import time
+import zlib
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+import numpy as np
+import pandas as pd
+from document_store import read_table, write_table
+from instrumentation import metrics
+from result_store import content_hash
+
+WORD = re.compile(r"\w+")
+# largest prime below 2**32: a * x + b stays below 2**64 for 32-bit shingle hashes
+PRIME = (1 << 32) - 5
+MAX_WORDS = 1_000_000
+
+T = TypeVar('T')
+
+
+def words(text: str) -> List[str]:
+    return WORD.findall(str(text).lower())
+
+
+def lsh_bands(threshold: float, num_perm: int, recall: float = 0.95) -> Tuple[int, int]:
+    """(bands, rows): the most rows per band that still make a pair at the threshold a candidate with
+    probability `recall`, fewer rows would only add comparisons with dissimilar documents"""
+    for rows in range(num_perm, 0, -1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** rows) ** bands >= recall:
+            return bands, rows
+    return num_perm, 1
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        # one (a * x + b) mod PRIME permutation per row
+        self.a = rng.integers(1, PRIME, num_perm, dtype=np.uint64)[:, None]
+        self.b = rng.integers(0, PRIME, num_perm, dtype=np.uint64)[:, None]
+        self.shingle_size = shingle_size
+        self.word_hashes: Dict[str, int] = {}  # the vocabulary is shared by most documents
+
+    def shingles(self, tokens: List[str]) -> np.ndarray:
+        """32-bit hashes of the distinct word k-grams, the whole text when it is shorter than k words"""
+        if len(self.word_hashes) > MAX_WORDS:
+            self.word_hashes.clear()
+        self.word_hashes.update((word, zlib.crc32(word.encode('utf-8')))
+                                for word in set(tokens).difference(self.word_hashes))
+        hashes = np.fromiter(map(self.word_hashes.__getitem__, tokens), dtype=np.uint64, count=len(tokens))
+        k = min(self.shingle_size, len(hashes))
+        combined = np.zeros(len(hashes) - k + 1, dtype=np.uint64)
+        for i in range(k):
+            # wraps around modulo 2**64
+            combined = combined * np.uint64(1000003) + hashes[i:len(hashes) - k + 1 + i]
+        return np.unique((combined ^ (combined >> np.uint64(32))) & np.uint64(0xFFFFFFFF))
+
+    def signature(self, tokens: List[str]) -> np.ndarray:
+        shingles = self.shingles(tokens)
+        return ((self.a * shingles[None, :] + self.b) % np.uint64(PRIME)).min(axis=1).astype(np.uint32)
+
+
+class DedupIndex:
+    """Representatives seen so far, fed one document at a time so pipeline.py can use it across chunks"""
+    def __init__(self, threshold: float = 0.9, num_perm: int = 128, shingle_size: int = 5, seed: int = 0):
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, shingle_size, seed)
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+        self.exact: Dict[str, str] = {}  # hash of the words -> representative
+        self.buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(self.bands)]
+        self.keys: List[str] = []
+        self.signatures: List[np.ndarray] = []
+        self.stats = {'documents': 0, 'exact': 0, 'near': 0, 'comparisons': 0, 'chars': 0, 'skipped_chars': 0}
+
+    def add(self, key: str, text: str) -> Optional[str]:
+        """Representative `key` is a duplicate of, None when it is a representative itself"""
+        tokens = words(text)
+        self.stats['documents'] += 1
+        self.stats['chars'] += len(text)
+        if not tokens:
+            return None
+        digest = content_hash(' '.join(tokens))
+        if digest in self.exact:
+            self.stats['exact'] += 1
+            self.stats['skipped_chars'] += len(text)
+            return self.exact[digest]
+
+        signature = self.hasher.signature(tokens)
+        bands = [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+        candidates = set()
+        for bucket, band in zip(self.buckets, bands):
+            candidates.update(bucket.get(band, ()))
+        if candidates:
+            candidates = list(candidates)
+            self.stats['comparisons'] += len(candidates)
+            similarity = (np.stack([self.signatures[i] for i in candidates]) == signature).mean(axis=1)
+            best = int(similarity.argmax())
+            if similarity[best] >= self.threshold:
+                self.stats['near'] += 1
+                self.stats['skipped_chars'] += len(text)
+                self.exact[digest] = self.keys[candidates[best]]
+                return self.keys[candidates[best]]
+
+        self.exact[digest] = key
+        for bucket, band in zip(self.buckets, bands):
+            bucket.setdefault(band, []).append(len(self.keys))
+        self.keys.append(key)
+        self.signatures.append(signature)
+        return None
+
+    def report(self) -> Dict[str, float]:
+        """How much of the NER and selection work the duplicates save"""
+        documents = max(self.stats['documents'], 1)
+        duplicates = self.stats['exact'] + self.stats['near']
+        return {
+            'documents': self.stats['documents'],
+            'representatives': self.stats['documents'] - duplicates,
+            'exact_duplicates': self.stats['exact'],
+            'near_duplicates': self.stats['near'],
+            'comparisons_per_doc': self.stats['comparisons'] / documents,
+            'documents_saved_%': duplicates / documents * 100,
+            'characters_saved_%': self.stats['skipped_chars'] / max(self.stats['chars'], 1) * 100,
+        }
+
+
+def mark_duplicates(df: pd.DataFrame, index: DedupIndex) -> pd.DataFrame:
+    """Set the duplicate_of column from raw_text_content (text_content when the raw text is missing)"""
+    texts = df['raw_text_content'] if 'raw_text_content' in df.columns else df['text_content']
+    with metrics.span("dedup", documents=len(df)):
+        df['duplicate_of'] = [index.add(key, text) for key, text in zip(df['local_filename'], texts.fillna(''))]
+    metrics.count("dedup.duplicates", int(df['duplicate_of'].notna().sum()))
+    return df
+
+
+def duplicate_map(df: pd.DataFrame, known: Iterable[str] = ()) -> Dict[str, str]:
+    """local_filename -> representative, for the rows marked as duplicates of a representative in df or in
+    `known`: a duplicate whose representative is elsewhere (another shard) has to be processed itself"""
+    if 'duplicate_of' not in df.columns:
+        return {}
+    present = set(df['local_filename']).union(known)
+    return {fname: rep for fname, rep in zip(df['local_filename'], df['duplicate_of'])
+            if isinstance(rep, str) and rep in present}
+
+
+def fan_out(values: Dict[str, T], duplicates: Dict[str, str]) -> Dict[str, T]:
+    """values of the representatives, plus the value of its representative for every duplicate"""
+    return {**values, **{fname: values[rep] for fname, rep in duplicates.items() if rep in values}}
+
+
+def process_representatives(df: pd.DataFrame, func: Callable[[pd.DataFrame], pd.DataFrame], columns: List[str],
+                            known: Optional[Dict[str, Dict[str, object]]] = None) -> pd.DataFrame:
+    """func on the rows without duplicate_of, then its `columns` copied to the duplicates
+
+    `known` keeps the values of the representatives across calls, for the duplicates of a previous chunk.
+    """
+    duplicates = duplicate_map(df, known or ())
+    representatives = df[~df['local_filename'].isin(duplicates)] if duplicates else df
+    done = func(representatives.copy() if duplicates else df) if len(representatives) else representatives
+    known = {} if known is None else known
+    found = [column for column in columns if column in done.columns]
+    for fname, *values in zip(done['local_filename'], *(done[column] for column in found)):
+        known[fname] = dict(zip(found, values))
+    if not duplicates:
+        return done
+
+    logging.info(f"Processed {len(representatives)} representatives, {len(duplicates)} duplicates copied")
+    metrics.count("dedup.skipped", len(duplicates))
+    rows = [known[duplicates.get(fname, fname)] for fname in df['local_filename']]
+    df = df.copy()
+    for column in columns:
+        if any(column in row for row in rows):
+            df[column] = [row.get(column) for row in rows]
+    return df
+
+
+def clusters(df: pd.DataFrame) -> pd.DataFrame:
+    """Size of every cluster with duplicates, largest first"""
+    sizes = Counter(duplicate_map(df).values())
+    return pd.DataFrame([{'representative': rep, 'size': size + 1} for rep, size in sizes.most_common()])
+
+
+def synthetic_duplicates(n_docs: int, exact: float = 0.2, near: float = 0.2, edits: int = 3,
+                         size: int = 4000, seed: int = 0) -> pd.DataFrame:
+    """benchmark.py délibérations, a share of them republished as exact copies or with a few words changed
+
+    `source` is the original of every copy, for the recall of the dedup.
+    """
+    corpus = importlib.import_module("benchmark").generate_corpus(n_docs, size, seed)
+    rng = np.random.default_rng(seed + 1)
+    n_originals = n_docs - int(n_docs * exact) - int(n_docs * near)
+    texts = corpus['raw_text_content'].tolist()
+    sources = [None] * n_docs
+    for position, source in zip(range(n_originals, n_docs), rng.choice(n_originals, size=n_docs - n_originals)):
+        text = texts[source]
+        if position >= n_originals + int(n_docs * exact):
+            tokens = text.split(' ')
+            for edit in rng.integers(0, len(tokens), size=edits):
+                tokens[edit] = f"modifié{rng.integers(1000)}"
+            text = ' '.join(tokens)
+        texts[position] = text
+        sources[position] = corpus['local_filename'].iat[source]
+    corpus['raw_text_content'] = texts
+    corpus['text_content'] = [(url + text)[:4000] for url, text in zip(corpus['url'], texts)]
+    corpus['source'] = sources
+    # copies are spread through the corpus as they would be in the crawl order
+    return corpus.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def _benchmark(n_docs: int, threshold: float, num_perm: int, queue) -> None:
+    """Runs in a fresh process so the peak RSS is the one of the generation and the index"""
+    corpus = synthetic_duplicates(n_docs)
+    index = DedupIndex(threshold, num_perm)
+    start = time.perf_counter()
+    mark_duplicates(corpus, index)
+    elapsed = time.perf_counter() - start
+    copies = corpus['source'].notna()
+    # a copy may come before its source in the crawl order: both have to end in the same cluster
+    cluster = {fname: rep if isinstance(rep, str) else fname
+               for fname, rep in zip(corpus['local_filename'], corpus['duplicate_of'])}
+    origin = dict(zip(corpus['local_filename'], corpus['source'].where(copies, corpus['local_filename'])))
+    found = [cluster[fname] == cluster[source]
+             for fname, source in zip(corpus.loc[copies, 'local_filename'], corpus.loc[copies, 'source'])]
+    false = [origin[fname] != origin[cluster[fname]] for fname in corpus['local_filename']]
+    queue.put({
+        **index.report(),
+        'bands x rows': f"{index.bands} x {index.rows}",
+        'docs_per_s': n_docs / elapsed,
+        'copies_found_%': float(np.mean(found)) * 100,
+        'false_duplicates': int(np.sum(false)),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def benchmark(n_docs: int, threshold: float = 0.9, num_perm: int = 128) -> Dict[str, object]:
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_benchmark, args=(n_docs, threshold, num_perm, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", type=str, nargs="?", help="Stage file with raw_text_content (.csv, .parquet or .arrow)")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Output file with duplicate_of (default: input)")
+    parser.add_argument("--threshold", type=float, default=0.9, help="Estimated Jaccard similarity of a near-duplicate")
+    parser.add_argument("--num_perm", type=int, default=128, help="MinHash signature length")
+    parser.add_argument("--shingle_size", type=int, default=5, help="Words per shingle")
+    parser.add_argument("--benchmark", type=int, default=None, metavar="DOCS",
+                        help="Time the dedup and check its recall on this many synthetic documents with copies and exit")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.benchmark:
+        for name, value in benchmark(args.benchmark, args.threshold, args.num_perm).items():
+            print(f"{name}: {value:.2f}" if isinstance(value, float) else f"{name}: {value}")
+        raise SystemExit(0)
+
+    df = read_table(args.input)
+    index = DedupIndex(args.threshold, args.num_perm, args.shingle_size)
+    df = mark_duplicates(df, index)
+    write_table(df, args.output or args.input)
+    for name, value in index.report().items():
+        print(f"{name}: {value:.2f}" if isinstance(value, float) else f"{name}: {value}")
+    if len(clusters(df)):
+        print("Largest clusters:\n" + clusters(df).head(10).to_string(index=False))
+    print(f"Saved to {args.output or args.input}")
@@ -0,0 +1,203 @@
+# Using this command to convert a stage csv and compare load time / memory of the formats
+# python ./document_store.py ./dataset_valid.csv -o ./dataset_valid.arrow
+# python ./document_store.py ./dataset_valid.csv --benchmark --scale 100
+"""Columnar storage of the stage files, with a per-document index
+
+The stage files carry the whole document text (`text_content`, `raw_text_content`) in every row. As csv,
+each stage parses all of it even when it only needs a few small columns. The file suffix picks the format:
+
+- `.csv`: unchanged, for compatibility with run.sh and spreadsheets
+- `.parquet`: compressed columns, smallest on disk, a stage only decodes the columns it projects
+- `.arrow`: uncompressed Arrow IPC, memory-mapped: columns are used in place from the page cache and
+  only the pages actually touched are loaded
+
+read_table/write_table are drop-in replacements of pd.read_csv/DataFrame.to_csv for the scripts.
+DocumentStore gives the per-document access: a local_filename (or doc_id) -> row index built from one
+projected column, then each lookup is a dict access and a one-row slice.
+"""
+import argparse
+import gc
+import multiprocessing
+import resource
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+PathLike = Union[str, Path]
+
+
+def is_columnar(path: PathLike) -> bool:
+    return Path(path).suffix in ('.parquet', '.arrow')
+
+
+def read_arrow(path: PathLike, columns: Optional[List[str]] = None) -> pa.Table:
+    """Arrow table of a stage file, projected on the existing columns among `columns`"""
+    path = Path(path)
+    if path.suffix == '.arrow':
+        # buffers point into the mapped file, nothing is copied
+        table = ipc.open_file(pa.memory_map(str(path), 'r')).read_all()
+        return table.select([c for c in columns if c in table.column_names]) if columns else table
+    if path.suffix == '.parquet':
+        if columns:
+            columns = [c for c in columns if c in pq.read_schema(path).names]
+        return pq.read_table(path, columns=columns, memory_map=True)
+    convert_options = pv.ConvertOptions(include_columns=columns, include_missing_columns=False) if columns else None
+    return pv.read_csv(path, convert_options=convert_options)
+
+
+def read_table(path: PathLike, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """pd.read_csv for any stage file; `columns` only loads these columns (missing ones are skipped)"""
+    if not is_columnar(path):
+        return pd.read_csv(path, usecols=(lambda c: c in columns) if columns else None)
+    # the table is only used for this conversion: its buffers are released column by column
+    return read_arrow(path, columns).to_pandas(split_blocks=True, self_destruct=True)
+
+
+def write_table(df: pd.DataFrame, path: PathLike) -> None:
+    """DataFrame.to_csv(path, index=False) for any stage file"""
+    path = Path(path)
+    if not is_columnar(path):
+        df.to_csv(path, index=False)
+        return
+    # lists (time_list) are stored as their repr, as in the csv files, so every format reads back the same values
+    df = df.assign(**{
+        col: df[col].map(lambda v: repr(v) if isinstance(v, list) else v)
+        for col in df.columns if df[col].dtype == object and df[col].map(type).eq(list).any()
+    })
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if path.suffix == '.parquet':
+        pq.write_table(table, path)
+    else:
+        with ipc.new_file(str(path), table.schema) as writer:
+            writer.write_table(table)
+
+
+def iter_chunks(path: PathLike, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """Consecutive chunks of chunk_size rows, as pd.read_csv(path, chunksize=chunk_size)"""
+    if not is_columnar(path):
+        yield from pd.read_csv(path, chunksize=chunk_size)
+        return
+    table = read_arrow(path)
+    for start in range(0, table.num_rows, chunk_size):
+        chunk = table.slice(start, chunk_size).to_pandas()
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        yield chunk
+
+
+class DocumentStore:
+    """Per-document access to a stage file through an index on one key column"""
+    def __init__(self, path: PathLike, key: str = 'local_filename'):
+        self.path = Path(path)
+        self.key = key
+        self.tables: Dict[tuple, pa.Table] = {}  # projected tables, by column tuple
+        keys = self.table([key]).column(key).to_pylist()
+        self.index: Dict[str, int] = {value: row for row, value in enumerate(keys)}
+
+    def table(self, columns: Optional[List[str]] = None) -> pa.Table:
+        projection = tuple(columns) if columns else ()
+        if projection not in self.tables:
+            self.tables[projection] = read_arrow(self.path, columns)
+        return self.tables[projection]
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def get(self, key: str, columns: Optional[List[str]] = None) -> Dict[str, object]:
+        """One document as a dict, KeyError if unknown"""
+        row = self.table(columns).slice(self.index[key], 1).to_pylist()
+        return row[0]
+
+    def take(self, keys: List[str], columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Documents in the order of keys"""
+        return self.table(columns).take([self.index[key] for key in keys]).to_pandas()
+
+
+def convert(input_path: PathLike, output_path: PathLike) -> None:
+    write_table(read_table(input_path), output_path)
+
+
+def synthetic_corpus(df: pd.DataFrame, scale: int) -> pd.DataFrame:
+    """`scale` copies of df with distinct file names and doc ids"""
+    copies = []
+    for i in range(scale):
+        copy = df.copy()
+        for key in ('doc_id', 'local_filename'):
+            if key in copy.columns:
+                copy[key] = copy[key].astype(str) + f"#{i}"
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def _measure(path: str, columns: Optional[List[str]], queue) -> None:
+    """Runs in a fresh process so the peak RSS only reflects this load, lookups are timed afterwards"""
+    start = time.perf_counter()
+    df = read_table(path, columns)
+    elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    n_rows = len(df)
+    del df
+    lookup = 0.0
+    if is_columnar(path):
+        store = DocumentStore(path)
+        keys = list(store.index)[::max(len(store) // 1000, 1)]
+        lookup_start = time.perf_counter()
+        for key in keys:
+            store.get(key, columns)
+        lookup = (time.perf_counter() - lookup_start) / len(keys) * 1e6
+    queue.put((n_rows, elapsed, rss, lookup))
+
+
+def benchmark(input_path: PathLike, scale: int, work_dir: Path = Path("./benchmark_store")) -> pd.DataFrame:
+    """Load time and peak RSS of the csv / parquet / arrow versions of input_path repeated `scale` times"""
+    work_dir.mkdir(parents=True, exist_ok=True)
+    corpus = synthetic_corpus(read_table(input_path), scale)
+    paths = {fmt: work_dir / f"corpus_x{scale}.{fmt}" for fmt in ('csv', 'parquet', 'arrow')}
+    for path in paths.values():
+        write_table(corpus, path)
+    del corpus
+    gc.collect()
+
+    # columns a selection/cleaning stage needs, without the raw text
+    projected = ['local_filename', 'text_content', 'time_list', 'published', 'Gold_label', 'predicted_time']
+    context = multiprocessing.get_context('spawn')
+    rows = []
+    for fmt, path in paths.items():
+        for label, columns in (('all columns', None), ('projected', projected)):
+            queue = context.Queue()
+            process = context.Process(target=_measure, args=(str(path), columns, queue))
+            process.start()
+            n_rows, elapsed, rss, lookup = queue.get()
+            process.join()
+            rows.append({
+                'format': fmt, 'columns': label, 'rows': n_rows,
+                'file_mb': round(path.stat().st_size / 1024 ** 2, 1),
+                'load_s': round(elapsed, 3), 'peak_rss_mb': round(rss, 1),
+                'lookup_us': round(lookup, 1) if lookup else None,
+            })
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", type=str, help="Stage file (.csv, .parquet or .arrow)")
+    parser.add_argument("-o", "--output", type=str, help="Converted file, the format follows the suffix")
+    parser.add_argument("--benchmark", action="store_true", help="Compare load time and memory of the formats")
+    parser.add_argument("--scale", type=int, default=1, help="Benchmark corpus: input repeated this many times")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(benchmark(args.input, args.scale).to_string(index=False))
+    elif args.output:
+        convert(args.input, args.output)
+        print(f"{args.input} -> {args.output}")
+    else:
+        parser.error("-o/--output or --benchmark is required")
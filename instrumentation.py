@@ -0,0 +1,166 @@
+"""Timed spans, counters and memory gauges shared by every stage of the pipeline
+
+Scripts record into the module-level `metrics`. It is disabled by default: span() then returns one shared
+no-op context manager and count()/gauge() return at once, so the calls can stay in hot loops. With
+--metrics the scripts print a summary table at the end of the run (which stage dominates, documents,
+candidates, tokens, cache hits), and with --trace run.jsonl every span, counter increment and gauge is
+also appended to a JSONL trace:
+
+    {"type": "span", "name": "selection.generate", "ts": 1700000000.1, "duration_ms": 812.4, "documents": 64}
+    {"type": "count", "name": "llm.prompt_tokens", "ts": 1700000000.9, "value": 70211}
+    {"type": "gauge", "name": "ner.rss_mb", "ts": 1700000001.0, "value": 2310.5}
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class _Span:
+    def __init__(self, metrics: 'Metrics', name: str, attrs: Dict[str, object]):
+        self.metrics = metrics
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.metrics.record_span(self.name, duration, self.attrs)
+        return False
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.trace = None
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.spans: Dict[str, List[float]] = defaultdict(list)
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.gauges: Dict[str, List[float]] = defaultdict(list)
+
+    def configure(self, enabled: bool = True, trace_path: Optional[Path] = None) -> None:
+        self.enabled = enabled or trace_path is not None
+        self.started = time.perf_counter()
+        if trace_path is not None:
+            self.trace = open(trace_path, 'a', encoding='utf-8')
+
+    def write(self, event: Dict[str, object]) -> None:
+        if self.trace is not None:
+            self.trace.write(json.dumps(event, ensure_ascii=False, default=str) + '\n')
+
+    def span(self, name: str, **attrs):
+        """Context manager timing a stage, a batch or a document"""
+        if not self.enabled:
+            return NO_SPAN
+        return _Span(self, name, attrs)
+
+    def record_span(self, name: str, duration: float, attrs: Dict[str, object]) -> None:
+        with self.lock:
+            self.spans[name].append(duration)
+            self.write({'type': 'span', 'name': name, 'ts': time.time(), 'duration_ms': duration * 1000, **attrs})
+
+    def count(self, name: str, value: float = 1) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += value
+            self.write({'type': 'count', 'name': name, 'ts': time.time(), 'value': value})
+
+    def gauge(self, name: str, value: float) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[name].append(value)
+            self.write({'type': 'gauge', 'name': name, 'ts': time.time(), 'value': value})
+
+    def memory(self, prefix: str) -> None:
+        """Current and peak RSS of the process, and allocated GPU memory when torch is in use"""
+        if not self.enabled:
+            return
+        try:
+            with open('/proc/self/statm') as statm:
+                self.gauge(f"{prefix}.rss_mb", int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2)
+        except OSError:
+            pass
+        # ru_maxrss is in kB on Linux, in bytes on macOS
+        scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+        self.gauge(f"{prefix}.peak_rss_mb", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale)
+        torch = sys.modules.get('torch')
+        if torch is not None and torch.cuda.is_available():
+            self.gauge(f"{prefix}.gpu_allocated_mb", torch.cuda.memory_allocated() / 1024 ** 2)
+            self.gauge(f"{prefix}.gpu_utilization", torch.cuda.utilization())
+
+    def summary(self) -> Dict[str, pd.DataFrame]:
+        """Spans (time per stage and share of the run), counters and gauges"""
+        wall = time.perf_counter() - self.started
+        spans = pd.DataFrame([{
+            'span': name,
+            'count': len(durations),
+            'total_s': sum(durations),
+            'share_%': sum(durations) / wall * 100 if wall else 0.0,
+            'mean_ms': float(np.mean(durations)) * 1000,
+            'p50_ms': float(np.percentile(durations, 50)) * 1000,
+            'p99_ms': float(np.percentile(durations, 99)) * 1000,
+        } for name, durations in self.spans.items()])
+        if not spans.empty:
+            spans = spans.sort_values('total_s', ascending=False)
+        counters = pd.DataFrame([{'counter': name, 'value': value} for name, value in sorted(self.counters.items())])
+        gauges = pd.DataFrame([{'gauge': name, 'last': values[-1], 'max': max(values)}
+                               for name, values in sorted(self.gauges.items())])
+        return {'spans': spans, 'counters': counters, 'gauges': gauges}
+
+    def report(self) -> str:
+        wall = time.perf_counter() - self.started
+        sections = [f"Run time: {wall:.2f}s"]
+        for name, table in self.summary().items():
+            if not table.empty:
+                sections.append(f"{name}:\n{table.to_string(index=False, float_format='%.2f')}")
+        return '\n\n'.join(sections)
+
+    def finish(self) -> None:
+        """Print the summary and close the trace, nothing when disabled"""
+        if not self.enabled:
+            return
+        print(self.report())
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+
+metrics = Metrics()
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--metrics", action="store_true", help="Print time per stage, counters and memory at the end")
+    parser.add_argument("--trace", type=str, default=None, help="Also append every span/counter/gauge to this JSONL file")
+
+
+def configure_from_args(args: argparse.Namespace) -> None:
+    if args.metrics or args.trace:
+        metrics.configure(trace_path=Path(args.trace) if args.trace else None)
@@ -0,0 +1,163 @@
+"""Resident NER worker and its client
+
+Importing torch and transformers and loading camembert-ner-with-dates takes longer than the NER of a
+few documents. `2_ner.py --serve` loads the model once and answers the other 2_ner.py runs of the
+machine on a local socket, one JSON object per line:
+
+    {"op": "config"}
+        -> {"config": {...stage_config()...}, "pid": 1234}
+    {"op": "extract", "documents": [{"local_filename": ..., "raw_text_content": ..., "text version": ...}],
+     "store": "/abs/path/results.sqlite" or null}
+        -> {"time_list": [...], "time_groups": [...], "time_offsets": [...], "seconds": 0.4}
+
+A failed request is answered {"error": "..."}. This module only imports the standard library and
+pandas, so that a client starts in the time of a pandas import.
+"""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from result_store import ResultStore
+
+DEFAULT_ADDRESS = "127.0.0.1:7861"
+DOCUMENT_COLUMNS = ['local_filename', 'raw_text_content', 'text version']
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    return host or "127.0.0.1", int(port)
+
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], processor, columns: List[str]):
+        self.processor = processor  # OptimizedNERProcessor, loaded once
+        self.columns = columns
+        self.lock = threading.Lock()  # one request at a time on the model
+        self.stores: Dict[str, ResultStore] = {}
+        self.stats = {'requests': 0, 'documents': 0, 'seconds': 0.0}
+        super().__init__(address, WorkerHandler)
+
+    def answer(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        op = request.get('op')
+        if op == 'config':
+            return {'config': self.processor.stage_config(), 'pid': os.getpid()}
+        if op != 'extract':
+            raise ValueError(f"Unknown op {op!r}")
+        df = pd.DataFrame(request['documents'], columns=DOCUMENT_COLUMNS)
+        with self.lock:
+            start = time.perf_counter()
+            self.processor.store = self.store(request.get('store'))
+            df = self.processor.process_dataframe(df)
+            # the processor keeps the groups and offsets of every document it saw
+            self.processor.groups.clear()
+            self.processor.offsets.clear()
+            seconds = time.perf_counter() - start
+            self.stats['requests'] += 1
+            self.stats['documents'] += len(df)
+            self.stats['seconds'] += seconds
+        logging.info(f"Request of {len(df)} documents in {seconds:.3f}s ({self.stats})")
+        response = {column: df[column].tolist() for column in self.columns}
+        response['seconds'] = seconds
+        return response
+
+    def store(self, path: Optional[str]) -> Optional[ResultStore]:
+        """The --store of the client, opened once"""
+        if path is None:
+            return None
+        if path not in self.stores:
+            self.stores[path] = ResultStore(Path(path))
+        return self.stores[path]
+
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.answer(json.loads(line))
+            except Exception as e:
+                logging.error(f"NER worker request failed: {e}")
+                response = {'error': f"{type(e).__name__}: {e}"}
+            self.wfile.write((json.dumps(response, ensure_ascii=False) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+def serve(processor, address: str, columns: List[str]) -> None:
+    """Answer requests with this processor until interrupted"""
+    with WorkerServer(parse_address(address), processor, columns) as server:
+        logging.info(f"NER worker ready on {address} (pid {os.getpid()})")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logging.info(f"NER worker stopped: {server.stats}")
+
+
+class WorkerClient:
+    """process_dataframe() of OptimizedNERProcessor, run by a resident worker"""
+    def __init__(self, connection: socket.socket, columns: List[str], store: Optional[str] = None,
+                 batch_size: int = 64):
+        self.connection = connection
+        self.reader = connection.makefile('rb')
+        self.columns = columns
+        self.store = str(Path(store).resolve()) if store else None  # opened by the worker
+        self.batch_size = batch_size  # documents per request
+        self.config: Dict[str, Any] = {}
+
+    @classmethod
+    def connect(cls, address: str, expected: Dict[str, Any], columns: List[str], store: Optional[str] = None,
+                timeout: float = 1.0) -> Optional['WorkerClient']:
+        """Client of the worker at this address, None when none answers or it runs another configuration"""
+        try:
+            connection = socket.create_connection(parse_address(address), timeout=timeout)
+        except OSError:
+            return None
+        connection.settimeout(None)
+        client = cls(connection, columns, store)
+        client.config = client.request({'op': 'config'})['config']
+        mismatched = {key: (value, client.config.get(key)) for key, value in expected.items()
+                      if client.config.get(key) != value}
+        if mismatched:
+            logging.warning(f"NER worker at {address} ignored, different configuration (ours, its): {mismatched}")
+            client.close()
+            return None
+        return client
+
+    def request(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        self.connection.sendall((json.dumps(payload, ensure_ascii=False) + '\n').encode('utf-8'))
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("The NER worker closed the connection")
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError(f"NER worker: {response['error']}")
+        return response
+
+    def process_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        results = {column: [] for column in self.columns}
+        documents = df[[column for column in DOCUMENT_COLUMNS if column in df.columns]]
+        for start in range(0, len(df), self.batch_size):
+            response = self.request({
+                'op': 'extract',
+                'documents': documents.iloc[start:start + self.batch_size].to_dict('records'),
+                'store': self.store,
+            })
+            for column in self.columns:
+                results[column].extend(response[column])
+        for column in self.columns:
+            df[column] = results[column]
+        return df
+
+    def close(self) -> None:
+        self.reader.close()
+        self.connection.close()
@@ -0,0 +1,298 @@
+# Using this command to run the whole pipeline in one process
+# python ./pipeline.py --dataset ./dataset_200example.csv --sink_dir .
+"""Streaming runner: download -> NER -> selection -> cleaning -> evaluation in a single process
+
+The dataset is read in chunks of --chunk_size rows. Each stage takes chunks from a bounded queue and puts
+its result on the next one, so a stage blocks when the following one falls behind (back-pressure), memory
+holds at most a few chunks whatever the corpus size, and the NER/LLM stages start on the first chunk while
+the next ones are still downloading. The per-stage CSVs of run.sh are kept as optional sinks.
+"""
+import argparse
+import asyncio
+import importlib
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+import dedup
+from document_store import iter_chunks
+from instrumentation import metrics
+import instrumentation
+from result_store import ResultStore
+
+dataset_rebuild = importlib.import_module("1_dataset_rebuild")
+ner_extraction = importlib.import_module("2_ner")
+llm_reference = importlib.import_module("4_llm_reference")
+date_cleaning = importlib.import_module("5_clean_date")
+
+# columns of the run.sh intermediate files
+PREDICTED_COLUMNS = ['doc_id', 'url', 'cache', 'text version', 'nature', 'published', 'entity', 'entity_type',
+                     'predicted_time', 'Gold_label', 'confidence', 'tier']
+CLEANED_COLUMNS = ['doc_id', 'url', 'cache', 'text version', 'nature', 'published', 'entity', 'entity_type',
+                   'Gold_label', 'cleaned_prediction_date', 'cleaned_gold_label']
+
+
+class CsvSink:
+    """Append chunks to a csv, writing the header with the first one"""
+    def __init__(self, path: Optional[Path], columns: Optional[List[str]] = None):
+        self.path = path
+        self.columns = columns
+        self.started = False
+
+    def write(self, df: pd.DataFrame) -> None:
+        if self.path is None:
+            return
+        if self.columns:
+            df = df[[col for col in self.columns if col in df.columns]]
+        df.to_csv(self.path, mode='a' if self.started else 'w', header=not self.started, index=False)
+        self.started = True
+
+
+class Evaluation:
+    """Running version of 6_evaluation.py accuracies"""
+    def __init__(self):
+        self.total = 0
+        self.given_correct = 0
+        self.predicted_correct = 0
+
+    def update(self, df: pd.DataFrame) -> None:
+        if 'cleaned_gold_label' not in df.columns:
+            return
+        self.total += len(df)
+        self.given_correct += int((df['published'] == df['cleaned_gold_label']).sum())
+        self.predicted_correct += int((df['cleaned_prediction_date'] == df['cleaned_gold_label']).sum())
+
+    def report(self) -> Dict[str, float]:
+        total = max(self.total, 1)
+        return {
+            'documents': self.total,
+            'given_acc': self.given_correct / total * 100,
+            'our_prediction_acc': self.predicted_correct / total * 100,
+        }
+
+
+class StreamingPipeline:
+    def __init__(
+            self,
+            processor,
+            ner_mode: str,
+            make_ner_processor: Callable,
+            selector,
+            output_dir: Path = Path("./txt"),
+            sink_dir: Optional[Path] = None,
+            chunk_size: int = 64,
+            queue_size: int = 2,
+            dedup_index: Optional[dedup.DedupIndex] = None
+    ):
+        self.processor = processor
+        self.ner_mode = ner_mode
+        self.make_ner_processor = make_ner_processor
+        self.selector = selector
+        self.output_dir = output_dir
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size  # chunks waiting between two stages
+        self.evaluation = Evaluation()
+        # near-duplicates of any earlier chunk get the NER and selection results of their representative
+        self.dedup_index = dedup_index
+        self.known = {'ner': {}, 'selection': {}}
+        self.sinks = {
+            'download': CsvSink(sink_dir / "dataset_valid.csv" if sink_dir else None),
+            'ner': CsvSink(sink_dir / "dataset_valid_ner.csv" if sink_dir else None),
+            'selection': CsvSink(sink_dir / "final_results_predicted.csv" if sink_dir else None, PREDICTED_COLUMNS),
+            'cleaning': CsvSink(sink_dir / "pipeline_result.csv" if sink_dir else None, CLEANED_COLUMNS),
+        }
+
+    def ner(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        if self.dedup_index is not None:
+            chunk = dedup.mark_duplicates(chunk, self.dedup_index)
+        return dedup.process_representatives(
+            chunk, lambda todo: ner_extraction.extract_time_lists(todo, self.ner_mode, self.make_ner_processor),
+            ner_extraction.TIME_COLUMNS, self.known['ner'] if self.dedup_index is not None else None)
+
+    def select_representatives(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        results_all = self.selector.select_dataframe(chunk)
+        chunk["predicted_time"] = chunk['local_filename'].map(results_all)
+        if self.selector.confidences:
+            chunk["confidence"] = chunk['local_filename'].map(self.selector.confidences)
+        if isinstance(self.selector, llm_reference.CascadeRouter):
+            chunk["tier"] = chunk['local_filename'].map(self.selector.routes)
+        return chunk
+
+    def select(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        return dedup.process_representatives(chunk, self.select_representatives,
+                                             ['predicted_time', 'confidence', 'tier'],
+                                             self.known['selection'] if self.dedup_index is not None else None)
+
+    def clean(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        dates = date_cleaning.normalize_dates(chunk['predicted_time'])
+        chunk['extracted_date'] = dates['extracted_date']
+        chunk['cleaned_prediction_date'] = dates['cleaned_date']
+        if 'Gold_label' in chunk.columns:
+            chunk['cleaned_gold_label'] = date_cleaning.normalize_dates(chunk['Gold_label'])['cleaned_date']
+        return chunk
+
+    async def stage(self, name: str, func, inbox: asyncio.Queue, outbox: Optional[asyncio.Queue]) -> None:
+        """Move chunks from inbox to outbox through func, None marks the end of the stream"""
+        while True:
+            wait_start = time.perf_counter()
+            chunk = await inbox.get()
+            # time spent starved by the previous stage
+            metrics.count(f"pipeline.{name}.wait_s", time.perf_counter() - wait_start)
+            if chunk is None:
+                break
+            metrics.gauge(f"pipeline.{name}.queue", inbox.qsize())
+            with metrics.span(f"pipeline.{name}", documents=len(chunk)):
+                if asyncio.iscoroutinefunction(func):
+                    chunk = await func(chunk)
+                else:
+                    # blocking model stages run in a thread so downloads keep going meanwhile
+                    chunk = await asyncio.to_thread(func, chunk)
+            metrics.memory("pipeline")
+            if name in self.sinks:
+                self.sinks[name].write(chunk)
+            logging.info(f"{name}: {len(chunk)} documents")
+            if outbox is not None and len(chunk):
+                await outbox.put(chunk)
+        if outbox is not None:
+            await outbox.put(None)
+
+    async def run(self, dataset_path: Path) -> Dict[str, float]:
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(5)]
+        async with self.processor.create_session() as session:
+            async def download(chunk: pd.DataFrame) -> pd.DataFrame:
+                return await self.processor.process_dataset(chunk, self.output_dir, session)
+
+            def evaluate(chunk: pd.DataFrame) -> pd.DataFrame:
+                self.evaluation.update(chunk)
+                return chunk
+
+            async def feed() -> None:
+                for chunk in iter_chunks(dataset_path, self.chunk_size):
+                    await queues[0].put(chunk)
+                await queues[0].put(None)
+
+            tasks = [
+                asyncio.create_task(feed()),
+                asyncio.create_task(self.stage('download', download, queues[0], queues[1])),
+                asyncio.create_task(self.stage('ner', self.ner, queues[1], queues[2])),
+                asyncio.create_task(self.stage('selection', self.select, queues[2], queues[3])),
+                asyncio.create_task(self.stage('cleaning', self.clean, queues[3], queues[4])),
+                asyncio.create_task(self.stage('evaluation', evaluate, queues[4], None)),
+            ]
+            # a failed stage stops reading its inbox: the others would wait on full queues forever
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task in tasks:
+                if task in done and task.exception() is not None:
+                    raise task.exception()
+        return self.evaluation.report()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", type=str, default="./dataset_200example.csv", help="Input dataset csv")
+    parser.add_argument("--output_dir", type=str, default="./txt", help="Directory of the downloaded text files")
+    parser.add_argument("--sink_dir", type=str, default=None, help="Also write the per-stage csv files of run.sh here")
+    parser.add_argument("--chunk_size", type=int, default=64, help="Documents per chunk")
+    parser.add_argument("--queue_size", type=int, default=2, help="Chunks buffered between two stages")
+    parser.add_argument("--ner_mode", type=str, default="model", choices=["model", "rules", "hybrid"])
+    parser.add_argument("--ner_model", type=str, default="Jean-Baptiste/camembert-ner-with-dates")
+    parser.add_argument("--ner_batch_size", type=int, default=16)
+    parser.add_argument("--llm_model", type=str, default="/home/sidney/models_llm/hub/Qwen/Qwen2___5-7B-Instruct")
+    parser.add_argument("--backend", type=str, default="vllm", choices=["vllm", "fake", "openai"],
+                        help="openai: share a long-lived OpenAI-compatible server (--base_url) instead of loading vLLM")
+    parser.add_argument("--base_url", type=str, default="http://127.0.0.1:8000")
+    parser.add_argument("--tokenizer", type=str, default=None, help="openai: chat template tokenizer (default: --llm_model)")
+    parser.add_argument("--max_in_flight", type=int, default=64)
+    parser.add_argument("--gpu_memory_utilization", type=float, default=0.95,
+                        help="vllm: share of the GPU memory of the selection engines, split between the cascade tiers")
+    parser.add_argument("--request_timeout", type=float, default=300)
+    parser.add_argument("--selection", type=str, default="generate", choices=["generate", "score"])
+    parser.add_argument("--cascade", action="store_true",
+                        help="Rules, then --llm_model, then --escalate_model for low-confidence answers (both stay "
+                             "loaded: with vllm each engine gets half of --gpu_memory_utilization)")
+    parser.add_argument("--escalate_model", type=str, default="/home/sidney/models_llm/hub/Qwen/Qwen2___5-14B-Instruct")
+    parser.add_argument("--escalate_threshold", type=float, default=0.7)
+    parser.add_argument("--context", type=str, default="truncate", choices=["truncate", "windows"],
+                        help="windows: header and text around each NER candidate instead of the first 4000 characters")
+    parser.add_argument("--context_tokens", type=int, default=512)
+    parser.add_argument("--window_chars", type=int, default=150)
+    parser.add_argument("--dedup_threshold", type=float, default=None,
+                        help="NER and selection once per cluster of near-duplicates (see dedup.py), across chunks")
+    parser.add_argument("--store", type=str, default=None,
+                        help="SQLite checkpoint file: NER and selection skip documents already processed")
+    parser.add_argument("--response_cache", type=str, default=None, help="SQLite cache of completions by prompt")
+    parser.add_argument("--cache_max_mb", type=int, default=512)
+    parser.add_argument("--bypass_cache", action="store_true")
+    dataset_rebuild.add_download_arguments(parser)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args(args)
+    store = ResultStore(Path(args.store)) if args.store else None
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                        handlers=[logging.StreamHandler(sys.stdout)])
+
+    # the NER model is loaded once, on the first chunk that needs it
+    ner_processors = []
+    def make_ner_processor():
+        if not ner_processors:
+            # DataLoader workers would be respawned for every chunk
+            ner_processors.append(ner_extraction.OptimizedNERProcessor(
+                model_name=args.ner_model, batch_size=args.ner_batch_size, num_workers=0, store=store
+            ))
+        return ner_processors[0]
+
+    # the cascade tiers stay loaded side by side, two vLLM engines cannot each take the whole budget
+    gpu_memory_utilization = args.gpu_memory_utilization / (2 if args.cascade else 1)
+
+    def make_selector(model: str) -> Callable:
+        def make():
+            backend = llm_reference.build_backend(args.backend, model, args.response_cache,
+                                                  args.cache_max_mb, args.bypass_cache, args.base_url,
+                                                  args.tokenizer, args.max_in_flight, args.request_timeout,
+                                                  gpu_memory_utilization)
+            return llm_reference.DateSelector(backend, store=store, mode=args.selection, context=args.context,
+                                              window_chars=args.window_chars, context_tokens=args.context_tokens)
+        return make
+
+    if args.cascade:
+        # chunks keep coming, so every tier stays loaded once created
+        selector = llm_reference.CascadeRouter(
+            [(Path(args.llm_model).name, make_selector(args.llm_model)),
+             (Path(args.escalate_model).name, make_selector(args.escalate_model))],
+            threshold=args.escalate_threshold, keep_loaded=True
+        )
+    else:
+        selector = make_selector(args.llm_model)()
+
+    pipeline = StreamingPipeline(
+        processor=dataset_rebuild.processor_from_args(args),
+        ner_mode=args.ner_mode,
+        make_ner_processor=make_ner_processor,
+        selector=selector,
+        output_dir=Path(args.output_dir),
+        sink_dir=Path(args.sink_dir) if args.sink_dir else None,
+        chunk_size=args.chunk_size,
+        queue_size=args.queue_size,
+        dedup_index=dedup.DedupIndex(args.dedup_threshold) if args.dedup_threshold else None
+    )
+    report = asyncio.run(pipeline.run(Path(args.dataset)))
+
+    print(f"Documents evaluated: {report['documents']}")
+    print(f"Accuracy from Datapolitics: {report['given_acc']:.2f}%")
+    print(f"Accuracy from Our prediction: {report['our_prediction_acc']:.2f}%")
+    if args.cascade:
+        print("Documents per tier:", pd.Series(selector.routes).value_counts().to_dict())
+    if pipeline.dedup_index is not None:
+        print("Duplicates:", {name: round(value, 2) for name, value in pipeline.dedup_index.report().items()})
+    metrics.finish()
+
+
+if __name__ == "__main__":
+    main()
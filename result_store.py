@@ -0,0 +1,175 @@
+"""Durable per-document results of the pipeline stages
+
+Each stage records its output for a document as soon as it is computed, keyed by a hash of the
+document content and a hash of the stage configuration (model, prompt template, truncation...).
+A rerun after a crash, or on a grown dataset, only computes documents that are new or changed,
+or every document of a stage whose configuration changed.
+
+ResponseCache sits one level lower, behind the date-selection backends: it maps an exact prompt
+and sampling configuration to its completion, so reruns that only change downstream steps never
+reach the model.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from instrumentation import metrics
+
+
+def content_hash(*parts: Any) -> str:
+    """Hash of the document content a stage reads"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def config_hash(config: Dict[str, Any]) -> str:
+    """Hash of a stage configuration, independent of the key order"""
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+class ResultStore:
+    def __init__(self, path: Path = Path("./results.sqlite")):
+        self.path = Path(path)
+        # one connection per store, used from the stage threads of pipeline.py
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " stage TEXT NOT NULL,"
+            " config_hash TEXT NOT NULL,"
+            " doc_hash TEXT NOT NULL,"
+            " local_filename TEXT,"
+            " value TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " PRIMARY KEY (stage, config_hash, doc_hash))"
+        )
+        self.connection.commit()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get_many(self, stage: str, config: str, doc_hashes: Iterable[str]) -> Dict[str, Any]:
+        """Stored values of the documents already processed by this stage configuration"""
+        doc_hashes = list(dict.fromkeys(doc_hashes))
+        found = {}
+        # stay below the sqlite limit of bound parameters
+        for start in range(0, len(doc_hashes), 500):
+            batch = doc_hashes[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT doc_hash, value FROM results WHERE stage = ? AND config_hash = ?"
+                f" AND doc_hash IN ({','.join('?' * len(batch))})",
+                [stage, config, *batch]
+            )
+            found.update((doc_hash, json.loads(value)) for doc_hash, value in rows)
+        self.stats['hits'] += len(found)
+        self.stats['misses'] += len(doc_hashes) - len(found)
+        metrics.count(f"store.{stage}.hits", len(found))
+        metrics.count(f"store.{stage}.misses", len(doc_hashes) - len(found))
+        return found
+
+    def put_many(self, stage: str, config: str, entries: List[Tuple[str, Optional[str], Any]]) -> None:
+        """Record (doc_hash, local_filename, value) entries, committed at once so a crash keeps them"""
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+            [(stage, config, doc_hash, fname, json.dumps(value, ensure_ascii=False), now)
+             for doc_hash, fname, value in entries]
+        )
+        self.connection.commit()
+
+    def configs(self, stage: str) -> List[str]:
+        """Configuration hashes with results for this stage, oldest first"""
+        rows = self.connection.execute(
+            "SELECT config_hash FROM results WHERE stage = ? GROUP BY config_hash ORDER BY MIN(created_at)", [stage]
+        )
+        return [config for config, in rows]
+
+    def values(self, stage: str, config: str) -> Dict[str, Any]:
+        """local_filename -> value of every document stored for this stage configuration, latest first wins"""
+        rows = self.connection.execute(
+            "SELECT local_filename, value FROM results WHERE stage = ? AND config_hash = ? ORDER BY created_at",
+            [stage, config]
+        )
+        return {fname: json.loads(value) for fname, value in rows}
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class ResponseCache:
+    """On-disk LLM completions keyed by (model, sampling parameters, prompt), evicted least recently used first"""
+    def __init__(self, path: Path = Path("./llm_cache.sqlite"), max_bytes: int = 512 * 1024 ** 2):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " completion TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.connection.commit()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @staticmethod
+    def key(model: str, params: Dict[str, Any], prompt: str) -> str:
+        return content_hash(model, json.dumps(params, sort_keys=True), prompt)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, str]:
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT key, completion FROM responses WHERE key IN ({','.join('?' * len(batch))})", batch
+            )
+            found.update(rows)
+        if found:
+            now = time.time()
+            self.connection.executemany("UPDATE responses SET last_access = ? WHERE key = ?",
+                                        [(now, key) for key in found])
+            self.connection.commit()
+        self.stats['hits'] += len(found)
+        self.stats['misses'] += len(keys) - len(found)
+        metrics.count("llm.cache_hits", len(found))
+        metrics.count("llm.cache_misses", len(keys) - len(found))
+        return found
+
+    def put_many(self, completions: Dict[str, str]) -> None:
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+            [(key, completion, len(completion.encode('utf-8')) + len(key), now)
+             for key, completion in completions.items()]
+        )
+        self.connection.commit()
+        self.evict()
+
+    def size(self) -> int:
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def evict(self) -> None:
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        victims = []
+        for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", victims)
+        self.connection.commit()
+        self.stats['evictions'] += len(victims)
+
+    def hit_rate(self) -> float:
+        return self.stats['hits'] / max(self.stats['hits'] + self.stats['misses'], 1)
@@ -5,6 +5,8 @@ conda activate py312torch240cuda121
 #1. download all the text file from datapolitics
 echo "default dataset is dataset_200example, if you want to test on other dataset, please open 1_dataset_rebuild.py and change the dataset path"
 python 1_dataset_rebuild.py
+# optional: NER and LLM once per cluster of near-duplicate documents
+# python dedup.py ./dataset_valid.csv -o ./dataset_valid.csv --threshold 0.9
 #2. do ner
 python 2_ner.py --csv ./dataset_valid.csv
 #3. llm reference
@@ -17,3 +19,6 @@ echo "Ready to calculate accuracy"
 python 6_evaluation.py -i ./pipeline_result.csv -o ./pipeline_result_final.csv
 
 echo "pipeline end,please check the result in pipeline_result.csv"
+
+# the same steps can also run streamed in a single process, writing the same csv files:
+# python pipeline.py --dataset ./dataset_200example.csv --sink_dir .
@@ -0,0 +1,36 @@
+import asyncio
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+# the numbered scripts are imported with importlib.import_module("4_llm_reference"), as in the pipeline
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def http_server():
+    """Start an aiohttp application on an ephemeral port in a background thread and return its base URL"""
+    from aiohttp import web
+
+    started = []
+
+    def start(app: 'web.Application') -> str:
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        loop.run_until_complete(site.start())
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        started.append((loop, runner, thread))
+        host, port = runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    yield start
+    for loop, runner, thread in started:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
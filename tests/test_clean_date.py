@@ -0,0 +1,76 @@
+import importlib
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+clean_date = importlib.import_module("5_clean_date")
+
+# every distinct predicted_time and Gold_label of demo_data/1114final_results_predicted_14B.csv, with the
+# output of the former per-pattern re.search code ("before") and the expected output of the compiled pattern
+DEMO = json.loads((Path(__file__).parent / "data" / "clean_date_demo.json").read_text(encoding='utf-8'))
+
+
+def clean(column: str, value: str):
+    # predictions go through extract_date first, gold labels are cleaned directly
+    if column == 'predicted_time':
+        return clean_date.clean_date(clean_date.extract_date(value))
+    return clean_date.clean_date(value)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("2023-10-01", "01/10/2023"),  # ISO dates were read as 2023/10/2001
+    (" 2023-10-01-3\n\nAssistant: 2023-10-", "01/10/2023"),
+    ("12 DÉCEMBRE", None),  # a date without a year was rendered "12/12/None"
+    ("le 31 janvier", None),
+    ("01 Mars 2023", "01/03/2023"),  # capitalized months did not parse
+    ("01 Avril 2023 ", "01/04/2023"),
+    ("16 decembre 2022", "16/12/2022"),  # nor months without their accent
+    ("1er juillet 2023", "01/07/2023"),
+    ("OCTOBRE 2022", "01/10/2022"),
+    ("27-02-20", "27/02/2020"),
+    ("pas de date", None),
+])
+def test_documented_changes(text, expected):
+    assert clean_date.clean_date(clean_date.extract_date(text)) == expected
+
+
+def test_demo_outputs_are_unchanged_except_the_documented_ones():
+    changed = []
+    for row in DEMO:
+        assert clean(row['column'], row['value']) == row['expected'], row['value']
+        if row['before'] != row['expected']:
+            changed.append(row)
+    # the only changes: year-less dates now None, the ISO date, and gold labels that now parse
+    assert len(changed) == 9
+    for row in changed:
+        before = row['before'] or ""
+        assert before.endswith("/None") or before == "2023/10/2001" or (row['before'] is None and row['expected'])
+
+
+def test_normalize_dates_matches_normalize_date():
+    values = pd.Series([row['value'] for row in DEMO] * 2 + [np.nan, None], index=range(10, 10 + 2 * len(DEMO) + 2))
+
+    result = clean_date.normalize_dates(values)
+
+    assert list(result.index) == list(values.index)
+    expected = [clean_date.normalize_date(str(value)) for value in values]
+    assert list(zip(result['extracted_date'], result['cleaned_date'])) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("le 01/12/2023", ("01/12/2023", "01/12/2023")),
+    ("1er décembre 2023", ("01/12/2023", "1er décembre 2023")),
+    (" 1 Décembre 2023 ", ("01/12/2023", "1 Décembre 2023")),
+    ("2023-12-01", ("01/12/2023", "2023-12-01")),
+    # a month without a day is not the 1st of the month
+    ("décembre 2023", ("12/2023", "décembre 2023")),
+    ("Octobre 2022", ("10/2022", "Octobre 2022")),
+    # without a year, the lowercase date
+    ("le 31 Janvier", ("31 janvier", "31 Janvier")),
+    ("lundi", ("lundi", "lundi")),
+])
+def test_candidate_key(text, expected):
+    assert clean_date.candidate_key(text) == expected
@@ -0,0 +1,101 @@
+import importlib
+
+import pandas as pd
+
+llm_reference = importlib.import_module("4_llm_reference")
+
+URL = "https://example.org/1"
+HEADER = "Commune de Saint-Martin. Séance du conseil municipal. " + " ".join(["entête"] * 50)
+TEXT = (HEADER + " " + " ".join(["alpha"] * 200) + " adopté le 12 mars 2023 " + " ".join(["beta"] * 200)
+        + " publié le 15/03/2023 " + " ".join(["gamma"] * 200) + " rappel du 12 mars 2023 " + " ".join(["delta"] * 200))
+CANDIDATES = ["12 mars 2023", "15/03/2023"]
+
+
+def words(context: str) -> int:
+    # the default token count, without the elision marks
+    return len([word for word in context.split() if word != "…"])
+
+
+def test_locate_candidates():
+    spans = llm_reference.locate_candidates(TEXT, CANDIDATES)
+
+    assert [TEXT[start:end] for start, end in spans] == ["12 mars 2023", "15/03/2023", "12 mars 2023"]
+    assert spans == sorted(spans)
+    assert llm_reference.locate_candidates(TEXT, ["1er avril 2023"]) == []
+
+
+def test_parse_offsets():
+    offsets = [["12 mars 2023", 1614, 1626], ["15/03/2023", 2637, 2647]]
+
+    assert llm_reference.parse_offsets(offsets) == [(1614, 1626), (2637, 2647)]
+    # as read back from a csv
+    assert llm_reference.parse_offsets(repr(offsets)) == [(1614, 1626), (2637, 2647)]
+    assert llm_reference.parse_offsets(float("nan")) == []
+
+
+def test_header_and_windows_in_document_order():
+    spans = llm_reference.locate_candidates(TEXT, CANDIDATES)
+
+    context = llm_reference.window_context(TEXT, spans, url=URL, window_chars=30)
+
+    assert context.startswith(f'"{URL} {HEADER[:40]}')
+    assert context.endswith(' …"')
+    body = context.split(" … ")
+    assert len(body) == 4
+    assert "adopté le 12 mars 2023" in body[1]
+    assert "publié le 15/03/2023" in body[2]
+    assert "rappel du 12 mars 2023" in body[3]
+    # windows start and end on word boundaries
+    assert all(word in ("alpha", "beta") for word in (body[1].split()[0], body[1].split()[-1]))
+
+
+def test_first_occurrences_come_before_repeated_ones():
+    spans = llm_reference.locate_candidates(TEXT, CANDIDATES)
+    full = llm_reference.window_context(TEXT, spans, url=URL, window_chars=30)
+
+    # room for the header and two of the three windows
+    budget = words(full) - 5
+    context = llm_reference.window_context(TEXT, spans, url=URL, window_chars=30, max_tokens=budget)
+
+    assert words(context) <= budget
+    assert "adopté le 12 mars 2023" in context and "publié le 15/03/2023" in context
+    assert "rappel du" not in context
+
+
+def test_overlapping_windows_are_merged():
+    text = HEADER + " " + " ".join(["alpha"] * 100) + " du 12 mars 2023 au 15/03/2023 " + " ".join(["beta"] * 100)
+    spans = llm_reference.locate_candidates(text, CANDIDATES)
+
+    context = llm_reference.window_context(text, spans, window_chars=40)
+
+    assert context.count(" … ") == 1
+    assert "du 12 mars 2023 au 15/03/2023" in context
+    assert context.count("12 mars 2023") == 1
+
+
+def test_short_text_is_kept_whole():
+    text = "Séance du 12 mars 2023, publiée le 15/03/2023"
+    spans = llm_reference.locate_candidates(text, CANDIDATES)
+
+    assert llm_reference.window_context(text, spans, url=URL) == f'"{URL} {text}"'
+    assert llm_reference.window_context(text, []) == f'"{text}"'
+
+
+def test_selector_windows_from_offsets_or_located_candidates():
+    spans = llm_reference.locate_candidates(TEXT, CANDIDATES)
+    dataframe = pd.DataFrame({
+        'local_filename': ["doc.txt", "old.txt"],
+        'text_content': [f"{URL} {TEXT}"] * 2,
+        'raw_text_content': [TEXT] * 2,
+        'text version': [URL] * 2,
+        'time_list': [repr(CANDIDATES)] * 2,
+        # NER output written before time_offsets has none
+        'time_offsets': [repr([[TEXT[start:end], start, end] for start, end in spans]), None],
+    })
+    selector = llm_reference.DateSelector(llm_reference.FakeBackend(), context="windows", window_chars=30)
+
+    from_offsets, located = selector.window_contexts(dataframe)
+
+    assert from_offsets == located == llm_reference.window_context(
+        TEXT, spans, URL, window_chars=30, max_tokens=selector.context_tokens,
+        count_tokens=llm_reference.FakeBackend.count_tokens)
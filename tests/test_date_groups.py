@@ -0,0 +1,45 @@
+import importlib
+
+ner = importlib.import_module("2_ner")
+
+
+def test_forms_of_one_date_are_grouped():
+    spans = [("le 01/12/2023", 10, 23), ("décembre 2023", 40, 53), ("1er décembre 2023", 60, 77),
+             ("01/12/2023", 90, 100), ("12 décembre", 120, 131), ("le 01/12/2023", 150, 163)]
+
+    time_list, groups, offsets = ner.group_dates(spans)
+
+    # one surface form per date, in order of first appearance
+    assert time_list == ["01/12/2023", "décembre 2023", "12 décembre"]
+    assert groups == [
+        {'date': "01/12/2023", 'forms': ["le 01/12/2023", "1er décembre 2023", "01/12/2023"], 'first': 10, 'count': 4},
+        {'date': "12/2023", 'forms': ["décembre 2023"], 'first': 40, 'count': 1},
+        {'date': "12 décembre", 'forms': ["12 décembre"], 'first': 120, 'count': 1},
+    ]
+    assert offsets == [list(span) for span in spans]
+
+
+def test_non_dates_are_dropped():
+    time_list, groups, offsets = ner.group_dates([("2023", 0, 4), ("le 5 mai 2022", 10, 23)])
+
+    assert time_list == ["5 mai 2022"]
+    assert [group['date'] for group in groups] == ["05/05/2022"]
+    assert offsets == [["le 5 mai 2022", 10, 23]]
+
+
+def test_at_most_max_candidates_dates():
+    spans = [(f"{day} mars 2023", day * 20, day * 20 + 12) for day in range(1, 21)]
+    # a later occurrence of a kept date still counts
+    spans.append(("01/03/2023", 500, 510))
+
+    time_list, groups, offsets = ner.group_dates(spans)
+
+    assert len(time_list) == len(groups) == ner.MAX_CANDIDATES
+    assert time_list[-1] == f"{ner.MAX_CANDIDATES} mars 2023"
+    assert groups[0]['count'] == 2
+    assert len(offsets) == ner.MAX_CANDIDATES + 1
+
+
+def test_filter_dates():
+    assert ner.filter_dates(["le 01/12/2023", "1er décembre 2023", "2023", "décembre 2023"]) == \
+        ["01/12/2023", "décembre 2023"]
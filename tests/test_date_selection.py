@@ -0,0 +1,191 @@
+import importlib
+import math
+import weakref
+
+import pandas as pd
+import pytest
+
+llm_reference = importlib.import_module("4_llm_reference")
+
+
+def ner_output(n: int) -> pd.DataFrame:
+    """NER output rows whose first candidate identifies the document"""
+    return pd.DataFrame({
+        'local_filename': [f"doc{i}.txt" for i in range(n)],
+        'text_content': [f"https://example.org/{i} Séance du {i + 1} mars 2023, publiée le 02/04/2023" for i in range(n)],
+        'time_list': [repr([f"{i + 1} mars 2023", "02/04/2023"]) for i in range(n)],
+    })
+
+
+def test_select_batches_by_chunk_size():
+    backend = llm_reference.FakeBackend()
+    selector = llm_reference.DateSelector(backend, chunk_size=2)
+    prompts, _ = selector.build_prompts(ner_output(5))
+    chunks = []
+
+    results = selector.select(prompts, on_chunk=chunks.append)
+
+    assert backend.calls == [2, 2, 1]
+    assert [list(chunk) for chunk in chunks] == [["doc0.txt", "doc1.txt"], ["doc2.txt", "doc3.txt"], ["doc4.txt"]]
+    assert len(results) == 5
+
+
+def test_select_without_chunk_size_is_one_call():
+    backend = llm_reference.FakeBackend()
+    selector = llm_reference.DateSelector(backend)
+
+    selector.select_dataframe(ner_output(7))
+
+    assert backend.calls == [7]
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1, 3])
+def test_results_map_to_their_file(chunk_size):
+    selector = llm_reference.DateSelector(llm_reference.FakeBackend(), chunk_size=chunk_size)
+    # the answers must follow the files, not the input order
+    dataframe = ner_output(6).sample(frac=1, random_state=0)
+
+    results = selector.select_dataframe(dataframe)
+
+    assert list(results) == list(dataframe['local_filename'])
+    assert results == {f"doc{i}.txt": f"{i + 1} mars 2023" for i in range(6)}
+
+
+def test_empty_input():
+    backend = llm_reference.FakeBackend()
+    selector = llm_reference.DateSelector(backend, chunk_size=4)
+
+    assert selector.select({}) == {}
+    assert selector.select_dataframe(ner_output(0)) == {}
+    assert backend.calls == []
+
+
+def test_completion_count_mismatch_is_an_error():
+    class ShortBackend(llm_reference.FakeBackend):
+        def generate(self, prompts, **kwargs):
+            return super().generate(prompts, **kwargs)[:-1]
+
+    selector = llm_reference.DateSelector(ShortBackend())
+    prompts, _ = selector.build_prompts(ner_output(3))
+
+    with pytest.raises(ValueError):
+        selector.select(prompts)
+
+
+class FixedScoreBackend(llm_reference.FakeBackend):
+    """Log-probabilities given per candidate, `default` for the others"""
+    def __init__(self, logprobs, default=-2.0):
+        super().__init__()
+        self.logprobs = logprobs
+        self.default = default
+        self.pairs = []
+
+    def score(self, pairs):
+        self.pairs.extend(pairs)
+        return [self.logprobs.get(continuation, self.default) for _, continuation in pairs]
+
+
+def test_score_picks_the_most_likely_candidate_with_its_probability():
+    # the first candidate of each document gets the default -2.0
+    logprobs = {"02/04/2023": -0.5}
+    selector = llm_reference.DateSelector(FixedScoreBackend(logprobs), mode="score", chunk_size=2)
+
+    results = selector.select_dataframe(ner_output(3))
+
+    assert results == {f"doc{i}.txt": "02/04/2023" for i in range(3)}
+    expected = 1 / (1 + math.exp(-2.0 + 0.5))  # softmax over the two candidates
+    assert selector.confidences["doc0.txt"] == pytest.approx(expected)
+    # every candidate of every document is scored once, after its own prompt
+    assert [continuation for _, continuation in selector.backend.pairs[:2]] == ["1 mars 2023", "02/04/2023"]
+    assert selector.backend.pairs[0][0] != selector.backend.pairs[2][0]
+    assert len(selector.backend.pairs) == 6
+
+
+def test_score_confidence_of_a_single_candidate_is_one():
+    selector = llm_reference.DateSelector(FixedScoreBackend({"5 mai 2022": -7.0}), mode="score")
+    dataframe = pd.DataFrame({'local_filename': ["a.txt"], 'text_content': ["le 5 mai 2022"],
+                              'time_list': [repr(["5 mai 2022"])]})
+
+    assert selector.select_dataframe(dataframe) == {"a.txt": "5 mai 2022"}
+    assert selector.confidences["a.txt"] == pytest.approx(1.0)
+
+
+def test_score_with_the_fake_logprobs():
+    # the fake backend prefers the candidate repeated in the reference text
+    dataframe = pd.DataFrame({
+        'local_filename': ["a.txt"],
+        'text_content': ["Séance du 3 mars 2023. Publié le 10/03/2023, affiché le 10/03/2023, transmis le 10/03/2023"],
+        'time_list': [repr(["3 mars 2023", "10/03/2023"])],
+    })
+    selector = llm_reference.DateSelector(llm_reference.FakeBackend(), mode="score")
+
+    assert selector.select_dataframe(dataframe) == {"a.txt": "10/03/2023"}
+    assert 0.5 < selector.confidences["a.txt"] < 1
+
+
+def test_score_requests_are_full_prefills():
+    backend = llm_reference.FakeBackend()
+    selector = llm_reference.DateSelector(backend, mode="score")
+
+    selector.select_dataframe(ner_output(3))
+
+    # generate requests share the cached instructions, score requests recompute them for every candidate
+    assert backend.prefill_tokens == backend.prompt_tokens
+    generate = llm_reference.FakeBackend()
+    llm_reference.DateSelector(generate).select_dataframe(ner_output(3))
+    assert generate.prefill_tokens < generate.prompt_tokens
+
+
+def test_cached_scores_never_reach_the_model(tmp_path):
+    backend = FixedScoreBackend({"02/04/2023": -0.123456789})
+    cache = llm_reference.ResponseCache(tmp_path / "cache.sqlite")
+    selector = llm_reference.DateSelector(llm_reference.CachedBackend(backend, cache), mode="score")
+
+    first = selector.select_dataframe(ner_output(3)), dict(selector.confidences)
+    scored = len(backend.pairs)
+    second = selector.select_dataframe(ner_output(4)), dict(selector.confidences)
+
+    assert scored == 6
+    # only the two candidates of the new document are scored, the others come back as the same floats
+    assert backend.pairs[scored:] == [(backend.pairs[scored][0], "4 mars 2023"), (backend.pairs[scored][0], "02/04/2023")]
+    assert second[0] == {**first[0], "doc3.txt": "02/04/2023"}
+    assert {file: second[1][file] for file in first[1]} == first[1]
+    assert cache.stats['hits'] == 6
+
+    bypass = llm_reference.CachedBackend(backend, cache, bypass=True)
+    assert bypass.score(backend.pairs[:1]) == [-2.0]
+    assert len(backend.pairs) == scored + 3
+
+
+def test_score_without_candidates_falls_back_to_generation():
+    backend = FixedScoreBackend({})
+    selector = llm_reference.DateSelector(backend, mode="score")
+    dataframe = pd.DataFrame({'local_filename': ["a.txt"], 'text_content': ["pas de date"], 'time_list': ["[]"]})
+
+    assert selector.select_dataframe(dataframe) == {"a.txt": ""}
+    assert backend.pairs == [] and backend.calls == [1]
+    assert "a.txt" not in selector.confidences
+
+
+@pytest.mark.parametrize("keep_loaded", [False, True])
+def test_cascade_releases_a_tier_before_the_next_loads(keep_loaded):
+    loaded = []
+    alive_at_load = []
+
+    def make_selector():
+        alive_at_load.append([ref() is not None for ref in loaded])
+        selector = llm_reference.DateSelector(llm_reference.FakeBackend())
+        loaded.append(weakref.ref(selector))
+        return selector
+
+    # no confidence reaches the threshold: every document goes through both tiers
+    router = llm_reference.CascadeRouter([("small", make_selector), ("large", make_selector)], threshold=2,
+                                         use_rules=False, keep_loaded=keep_loaded)
+
+    results = router.select_dataframe(ner_output(3))
+
+    assert results == {f"doc{i}.txt": f"{i + 1} mars 2023" for i in range(3)}
+    assert set(router.routes.values()) == {"large"}
+    # the small model is gone before the large one is created, unless the tiers stay loaded
+    assert alive_at_load == [[], [keep_loaded]]
+    assert list(router.selectors) == (["small", "large"] if keep_loaded else [])
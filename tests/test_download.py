@@ -0,0 +1,198 @@
+import asyncio
+import importlib
+from collections import Counter
+from typing import List, Optional
+
+import pytest
+from aiohttp import web
+
+dataset_rebuild = importlib.import_module("1_dataset_rebuild")
+
+ETAG = '"v1"'
+BODY = "Délibération du conseil municipal.\n  Séance du 12 mars 2023,   publiée le 15/03/2023. " * 20
+
+
+def document_server(statuses: List[int], hits: Optional[Counter] = None) -> web.Application:
+    """/doc answers the given statuses in turn, then 200 with BODY; /missing is a 404"""
+    hits = Counter() if hits is None else hits
+    statuses = list(statuses)
+
+    async def doc(request: web.Request) -> web.Response:
+        hits['doc'] += 1
+        if statuses:
+            return web.Response(status=statuses.pop(0))
+        return web.Response(text=BODY, headers={'ETag': ETAG})
+
+    app = web.Application()
+    app.router.add_get('/doc', doc)
+    return app
+
+
+def download(processor, url, file_path):
+    async def run():
+        async with processor.create_session() as session:
+            return await processor.download_file(session, url, file_path)
+    return asyncio.run(run())
+
+
+def host_stats(processor):
+    (stats,) = processor.host_stats.values()
+    return stats
+
+
+def test_download(http_server, tmp_path):
+    base_url = http_server(document_server([]))
+    processor = dataset_rebuild.DatasetProcessor(backoff=0)
+
+    ok, (text_content, raw_text_content) = download(processor, f"{base_url}/doc", tmp_path / "doc.txt")
+
+    assert ok
+    assert (tmp_path / "doc.txt").read_text(encoding='utf-8') == BODY
+    assert text_content == dataset_rebuild.clean_text(f"{base_url}/doc\n{BODY}")[:4000]
+    assert raw_text_content == dataset_rebuild.clean_text(BODY)[:8000]
+    assert host_stats(processor)['requests'] == 1
+    assert host_stats(processor)['bytes'] == len(BODY.encode('utf-8'))
+    assert host_stats(processor)['retries'] == 0
+
+
+@pytest.mark.parametrize("statuses", [[429], [503, 500], [502, 429, 504]])
+def test_transient_statuses_are_retried(http_server, tmp_path, statuses):
+    hits = Counter()
+    base_url = http_server(document_server(statuses, hits))
+    processor = dataset_rebuild.DatasetProcessor(backoff=0, max_retries=3)
+
+    ok, _ = download(processor, f"{base_url}/doc", tmp_path / "doc.txt")
+
+    assert ok
+    assert hits['doc'] == len(statuses) + 1
+    assert host_stats(processor)['retries'] == len(statuses)
+    assert host_stats(processor)['requests'] == len(statuses) + 1
+    assert host_stats(processor)['failures'] == 0
+
+
+def test_retries_give_up(http_server, tmp_path):
+    base_url = http_server(document_server([503] * 10))
+    processor = dataset_rebuild.DatasetProcessor(backoff=0, max_retries=2)
+
+    ok, _ = download(processor, f"{base_url}/doc", tmp_path / "doc.txt")
+
+    assert not ok
+    assert host_stats(processor)['requests'] == 3
+    assert host_stats(processor)['retries'] == 2
+    assert host_stats(processor)['failures'] == 1
+    assert processor.failed_downloads == [f"{base_url}/doc"]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_permanent_error_is_not_retried(http_server, tmp_path):
+    base_url = http_server(document_server([]))
+    processor = dataset_rebuild.DatasetProcessor(backoff=0)
+
+    ok, _ = download(processor, f"{base_url}/missing", tmp_path / "doc.txt")
+
+    assert not ok
+    assert host_stats(processor)['requests'] == 1
+    assert host_stats(processor)['retries'] == 0
+    assert host_stats(processor)['failures'] == 1
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_short_documents_are_dropped(http_server, tmp_path):
+    base_url = http_server(document_server([]))
+    processor = dataset_rebuild.DatasetProcessor(backoff=0, min_length=len(BODY) + 1)
+
+    ok, _ = download(processor, f"{base_url}/doc", tmp_path / "doc.txt")
+
+    assert not ok
+    assert not (tmp_path / "doc.txt").exists()
+
+
+def revalidating_server(state: dict, requests: List[dict]) -> web.Application:
+    """/doc honours If-None-Match against state['etag'], or answers state['status'] when set"""
+    async def doc(request: web.Request) -> web.Response:
+        requests.append(dict(request.headers))
+        if state.get('status'):
+            return web.Response(status=state['status'])
+        if request.headers.get('If-None-Match') == state['etag']:
+            return web.Response(status=304)
+        return web.Response(text=state['body'], headers={'ETag': state['etag']})
+
+    app = web.Application()
+    app.router.add_get('/doc', doc)
+    return app
+
+
+def closed_port_url() -> str:
+    import socket
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{probe.getsockname()[1]}/doc"
+
+
+def test_fresh_entries_are_not_requested(http_server, tmp_path):
+    requests = []
+    url = http_server(revalidating_server({'etag': ETAG, 'body': BODY}, requests)) + "/doc"
+    cache = dataset_rebuild.DownloadCache(tmp_path / "cache")
+    processor = dataset_rebuild.DatasetProcessor(backoff=0, cache=cache)
+
+    assert download(processor, url, tmp_path / "a.txt")[0]
+    assert download(processor, url, tmp_path / "b.txt")[0]
+
+    assert len(requests) == 1
+    assert cache.stats['misses'] == 1 and cache.stats['hits'] == 1
+    assert (tmp_path / "b.txt").read_text(encoding='utf-8') == BODY
+
+
+def test_stale_entries_are_revalidated(http_server, tmp_path):
+    requests = []
+    state = {'etag': ETAG, 'body': BODY}
+    url = http_server(revalidating_server(state, requests)) + "/doc"
+    cache = dataset_rebuild.DownloadCache(tmp_path / "cache", max_age=0)
+    processor = dataset_rebuild.DatasetProcessor(backoff=0, cache=cache)
+
+    download(processor, url, tmp_path / "a.txt")
+    ok, (_, raw_text_content) = download(processor, url, tmp_path / "b.txt")
+
+    assert ok
+    assert requests[1]['If-None-Match'] == ETAG
+    assert cache.stats['revalidated'] == 1
+    assert raw_text_content == dataset_rebuild.clean_text(BODY)[:8000]
+    assert (tmp_path / "b.txt").read_text(encoding='utf-8') == BODY
+
+    # a changed document is downloaded again and replaces the entry
+    state.update(etag='"v2"', body=BODY + " Modifiée.")
+    download(processor, url, tmp_path / "c.txt")
+    assert cache.stats['misses'] == 2
+    assert cache.read(url) == BODY + " Modifiée."
+    assert cache.get(url)['etag'] == '"v2"'
+
+
+@pytest.mark.parametrize("unreachable", ["connection refused", "overloaded"])
+def test_stale_entry_is_served_when_revalidation_fails(http_server, tmp_path, unreachable):
+    if unreachable == "overloaded":
+        url = http_server(revalidating_server({'etag': ETAG, 'status': 503}, [])) + "/doc"
+    else:
+        url = closed_port_url()
+    cache = dataset_rebuild.DownloadCache(tmp_path / "cache", max_age=0)
+    cache.put(url, BODY, etag=ETAG)
+    processor = dataset_rebuild.DatasetProcessor(backoff=0, max_retries=1, cache=cache)
+
+    ok, _ = download(processor, url, tmp_path / "doc.txt")
+
+    assert ok
+    assert cache.stats['stale'] == 1
+    assert processor.failed_downloads == []
+    assert (tmp_path / "doc.txt").read_text(encoding='utf-8') == BODY
+
+
+def test_removed_document_is_not_served_from_the_cache(http_server, tmp_path):
+    url = http_server(revalidating_server({'etag': ETAG, 'status': 404}, [])) + "/doc"
+    cache = dataset_rebuild.DownloadCache(tmp_path / "cache", max_age=0)
+    cache.put(url, BODY, etag=ETAG)
+    processor = dataset_rebuild.DatasetProcessor(backoff=0, cache=cache)
+
+    ok, _ = download(processor, url, tmp_path / "doc.txt")
+
+    assert not ok
+    assert cache.stats['stale'] == 0
+    assert not (tmp_path / "doc.txt").exists()
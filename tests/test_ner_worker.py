@@ -0,0 +1,144 @@
+import argparse
+import ast
+import importlib
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+import ner_worker
+
+ner = importlib.import_module("2_ner")
+
+DOCUMENTS = pd.DataFrame({
+    'local_filename': [f"doc{i}.txt" for i in range(5)],
+    'raw_text_content': [f"Séance du {i + 1} mars 2023. Publié le 0{i + 1}/04/2023, affiché le 0{i + 1}/04/2023"
+                         for i in range(4)] + ["Délibération sans date"],
+    'text version': [f"https://example.org/{i}" for i in range(5)],
+})
+
+
+class StubProcessor:
+    """OptimizedNERProcessor stand-in: the rules extractor with the model's configuration"""
+    def __init__(self, stride: int = 128):
+        self.model_name = "Jean-Baptiste/camembert-ner-with-dates"
+        self.max_length = 512
+        self.stride = stride
+        self.quantize = False
+        self.store = None
+        self.groups = {}
+        self.offsets = {}
+        self.requests = 0
+
+    stage_config = ner.OptimizedNERProcessor.stage_config
+
+    def process_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        self.requests += 1
+        df = ner.RuleDateExtractor().process_dataframe(df)
+        self.groups.update(zip(df['local_filename'], df['time_groups']))
+        self.offsets.update(zip(df['local_filename'], df['time_offsets']))
+        return df
+
+
+@pytest.fixture
+def worker():
+    """A resident worker on an ephemeral port: (address, its processor)"""
+    processor = StubProcessor()
+    server = ner_worker.WorkerServer(("127.0.0.1", 0), processor, ner.TIME_COLUMNS)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    yield f"{host}:{port}", processor
+    server.shutdown()
+    server.server_close()
+
+
+def closed_address() -> str:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return f"127.0.0.1:{probe.getsockname()[1]}"
+
+
+def cli_args(address: str, **overrides) -> argparse.Namespace:
+    args = dict(no_worker=False, worker=address, model="Jean-Baptiste/camembert-ner-with-dates", stride=128,
+                quantize=False, store=None)
+    return argparse.Namespace(**{**args, **overrides})
+
+
+def as_json(values):
+    # tuples come back as lists
+    return json.loads(json.dumps(values, ensure_ascii=False))
+
+
+def test_round_trip(worker):
+    address, processor = worker
+    client = ner_worker.WorkerClient.connect(address, {}, ner.TIME_COLUMNS)
+    client.batch_size = 2
+
+    served = client.process_dataframe(DOCUMENTS.copy())
+    local = ner.RuleDateExtractor().process_dataframe(DOCUMENTS.copy())
+
+    for column in ner.TIME_COLUMNS:
+        assert served[column].tolist() == as_json(local[column].tolist())
+    assert served['time_list'].tolist()[-1] == []
+    assert processor.requests == 3
+    # the resident processor does not keep the documents of past requests
+    assert processor.groups == {} and processor.offsets == {}
+    client.close()
+
+
+def test_config_and_errors(worker):
+    address, _ = worker
+    client = ner_worker.WorkerClient.connect(address, {'stride': 128}, ner.TIME_COLUMNS)
+
+    assert client.config['model'] == "Jean-Baptiste/camembert-ner-with-dates"
+    with pytest.raises(RuntimeError, match="Unknown op"):
+        client.request({'op': 'reload'})
+    # the connection survives a failed request
+    assert client.request({'op': 'config'})['config'] == client.config
+    client.close()
+
+
+def test_fallback_to_the_local_processor(worker):
+    address, _ = worker
+    local = object()
+
+    assert ner.worker_or_local(cli_args(closed_address()), lambda: local) is local
+    assert ner.worker_or_local(cli_args(address, no_worker=True), lambda: local) is local
+    # a worker running another configuration is not used
+    assert ner.worker_or_local(cli_args(address, stride=64), lambda: local) is local
+    assert isinstance(ner.worker_or_local(cli_args(address), lambda: local), ner_worker.WorkerClient)
+
+
+def test_model_mode_through_the_worker(worker):
+    address, _ = worker
+
+    served = ner.extract_time_lists(DOCUMENTS.copy(), "model", lambda: ner.worker_or_local(cli_args(address), StubProcessor))
+    local = ner.extract_time_lists(DOCUMENTS.copy(), "model", StubProcessor)
+
+    for column in ner.TIME_COLUMNS:
+        assert served[column].tolist() == as_json(local[column].tolist())
+
+
+def test_warm_worker_beats_a_cold_start(worker, tmp_path):
+    address, _ = worker
+    DOCUMENTS.to_csv(tmp_path / "docs.csv", index=False)
+    client = ner_worker.WorkerClient.connect(address, {}, ner.TIME_COLUMNS)
+
+    # the cheapest real cold start: a fresh interpreter that imports the pipeline and needs no model
+    start = time.perf_counter()
+    subprocess.run([sys.executable, ner.__file__, '--csv', "docs.csv", '--mode', "rules", '--no_worker'],
+                   cwd=tmp_path, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    served = client.process_dataframe(DOCUMENTS.copy())
+    warm = time.perf_counter() - start
+
+    assert served['time_list'].tolist() == pd.read_csv(tmp_path / "docs_ner.csv")['time_list'].map(ast.literal_eval).tolist()
+    assert warm < cold / 5
+    client.close()
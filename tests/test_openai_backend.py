@@ -0,0 +1,70 @@
+import importlib
+
+import pandas as pd
+import pytest
+from aiohttp import web
+
+llm_reference = importlib.import_module("4_llm_reference")
+
+DOCUMENTS = pd.DataFrame({
+    'local_filename': ["a.txt", "b.txt", "c.txt"],
+    'text_content': ["Séance du 3 mars 2023. Publié le 10/03/2023, affiché le 10/03/2023",
+                     "Arrêté du 1er juin 2021, transmis en préfecture le 4 juin 2021",
+                     "Délibération sans date"],
+    'time_list': [repr(["3 mars 2023", "10/03/2023"]), repr(["1er juin 2021", "4 juin 2021"]), "[]"],
+})
+
+
+def failing_first(app: web.Application, failures: int, status: int = 503) -> web.Application:
+    """Answer `status` to the first `failures` requests"""
+    failed = []
+
+    @web.middleware
+    async def fail(request, handler):
+        if len(failed) < failures:
+            failed.append(request.path)
+            return web.Response(status=status, text="overloaded")
+        return await handler(request)
+
+    app.middlewares.append(fail)
+    return app
+
+
+def client(base_url: str, **kwargs) -> 'llm_reference.OpenAIBackend':
+    return llm_reference.OpenAIBackend("fake", base_url=base_url, tokenizer="plain", backoff=0, **kwargs)
+
+
+@pytest.mark.parametrize("mode", ["generate", "score"])
+def test_results_match_the_fake_backend(http_server, mode):
+    backend = client(http_server(llm_reference.fake_app(latency=0)), max_in_flight=2)
+    served = llm_reference.DateSelector(backend, mode=mode)
+    local = llm_reference.DateSelector(llm_reference.FakeBackend(), mode=mode)
+
+    assert served.select_dataframe(DOCUMENTS) == local.select_dataframe(DOCUMENTS)
+    assert served.confidences == pytest.approx(local.confidences)
+    assert backend.stats['retries'] == 0
+    assert backend.stats['prompt_tokens'] > 0
+
+
+def test_transient_errors_are_retried(http_server):
+    backend = client(http_server(failing_first(llm_reference.fake_app(latency=0), failures=2)))
+
+    assert backend.generate([llm_reference.render_prompt("['5 mai 2022']", "le 5 mai 2022")]) == ["5 mai 2022"]
+    assert backend.stats['retries'] == 2
+    assert backend.stats['requests'] == 1
+
+
+def test_persistent_errors_raise(http_server):
+    backend = client(http_server(failing_first(llm_reference.fake_app(latency=0), failures=10)), max_retries=2)
+
+    with pytest.raises(llm_reference.ServerError):
+        backend.generate(["prompt"])
+    assert backend.stats['retries'] == 2
+
+
+def test_client_errors_are_not_retried(http_server):
+    backend = client(http_server(failing_first(llm_reference.fake_app(latency=0), failures=1, status=400)))
+
+    with pytest.raises(llm_reference.ServerError):
+        backend.generate(["prompt"])
+    assert backend.stats['retries'] == 0
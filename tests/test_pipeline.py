@@ -0,0 +1,70 @@
+import asyncio
+import contextlib
+
+import pandas as pd
+import pytest
+
+import pipeline
+from pipeline import llm_reference
+
+
+class LocalDocuments:
+    """DatasetProcessor stand-in: the text of every document is already in the dataset"""
+    def create_session(self):
+        return contextlib.nullcontext()
+
+    async def process_dataset(self, chunk: pd.DataFrame, output_dir, session) -> pd.DataFrame:
+        chunk = chunk.copy()
+        chunk['local_filename'] = [f"dataset_pdf_{i}.txt" for i in chunk.index]
+        chunk['text_content'] = chunk['text version'] + " " + chunk['body']
+        chunk['raw_text_content'] = chunk['body']
+        return chunk
+
+
+class FailingSelector(llm_reference.DateSelector):
+    def select_dataframe(self, dataframe, max_context_length=4000):
+        raise RuntimeError("boom")
+
+
+def dataset(tmp_path, n: int = 12):
+    path = tmp_path / "dataset.csv"
+    pd.DataFrame({
+        'doc_id': range(n),
+        'text version': [f"https://example.org/{i}" for i in range(n)],
+        'body': [f"Séance du {i + 1} mars 2023, affichée le 30/03/2023" for i in range(n)],
+        'published': ["30/03/2023"] * n,
+        'Gold_label': [f"{i + 1} mars 2023" for i in range(n)],
+    }).to_csv(path, index=False)
+    return path
+
+
+def run(tmp_path, selector, processor=None):
+    streaming = pipeline.StreamingPipeline(
+        processor=processor or LocalDocuments(), ner_mode="rules", make_ner_processor=None, selector=selector,
+        output_dir=tmp_path, chunk_size=2, queue_size=1)
+    return asyncio.run(asyncio.wait_for(streaming.run(dataset(tmp_path)), timeout=10))
+
+
+def test_run(tmp_path):
+    report = run(tmp_path, llm_reference.DateSelector(llm_reference.FakeBackend()))
+
+    assert report['documents'] == 12
+    # the fake model answers the first candidate, the session date
+    assert report['our_prediction_acc'] == 100
+    assert report['given_acc'] == 0
+
+
+def test_failing_stage_stops_the_run(tmp_path):
+    with pytest.raises(RuntimeError, match="boom"):
+        run(tmp_path, FailingSelector(llm_reference.FakeBackend()))
+
+
+def test_failing_first_stage_stops_the_run(tmp_path):
+    class FailingDownloads(LocalDocuments):
+        async def process_dataset(self, chunk, output_dir, session):
+            if chunk.index[0] >= 4:
+                raise ConnectionError("network down")
+            return await super().process_dataset(chunk, output_dir, session)
+
+    with pytest.raises(ConnectionError):
+        run(tmp_path, llm_reference.DateSelector(llm_reference.FakeBackend()), FailingDownloads())
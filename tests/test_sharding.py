@@ -0,0 +1,78 @@
+import importlib
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+ner = importlib.import_module("2_ner")
+
+DOCUMENTS = pd.DataFrame({
+    'doc_id': range(10),
+    'local_filename': [f"doc{i}.txt" for i in range(10)],
+    'raw_text_content': [f"Séance du {i + 1} mars 2023, publiée le {i + 10}/04/2023" for i in range(10)],
+    'text version': [f"https://example.org/{i}" for i in range(10)],
+})
+
+
+@pytest.mark.parametrize("value, expected", [("0/1", (0, 1)), ("2/3", (2, 3))])
+def test_parse_shard(value, expected):
+    assert ner.parse_shard(value) == expected
+
+
+@pytest.mark.parametrize("value", ["3/3", "-1/2", "1"])
+def test_parse_shard_rejects_bad_values(value):
+    with pytest.raises(ValueError):
+        ner.parse_shard(value)
+
+
+@pytest.mark.parametrize("count", [1, 3, 4, 12])
+def test_shards_merge_back_in_the_input_order(tmp_path, count):
+    output_path = tmp_path / "dataset_valid_ner.csv"
+    shards = [ner.take_shard(DOCUMENTS, index, count) for index in range(count)]
+
+    assert sum(len(shard) for shard in shards) == len(DOCUMENTS)
+    # workers finish in any order, and each one processes its own slice
+    for index in reversed(range(count)):
+        processed = ner.RuleDateExtractor().process_dataframe(shards[index])
+        ner.write_atomic(processed, ner.shard_path(output_path, index, count, tmp_path))
+    merged = ner.merge_shards(output_path, count, tmp_path)
+
+    expected = ner.RuleDateExtractor().process_dataframe(DOCUMENTS.copy())
+    assert list(merged.columns) == list(expected.columns)
+    assert merged['local_filename'].tolist() == DOCUMENTS['local_filename'].tolist()
+    assert merged['time_list'].tolist() == [str(value) for value in expected['time_list']]
+    assert not list(tmp_path.glob(".*"))
+
+
+def test_merge_refuses_missing_shards(tmp_path):
+    output_path = tmp_path / "out.csv"
+    ner.write_atomic(ner.take_shard(DOCUMENTS, 0, 2), ner.shard_path(output_path, 0, 2, tmp_path))
+
+    with pytest.raises(FileNotFoundError, match="1 shard"):
+        ner.merge_shards(output_path, 2, tmp_path)
+
+
+def test_merge_refuses_overlapping_shards(tmp_path):
+    output_path = tmp_path / "out.csv"
+    # the second shard comes from a run with another shard count
+    ner.write_atomic(ner.take_shard(DOCUMENTS, 0, 2), ner.shard_path(output_path, 0, 2, tmp_path))
+    ner.write_atomic(ner.take_shard(DOCUMENTS, 0, 3), ner.shard_path(output_path, 1, 2, tmp_path))
+
+    with pytest.raises(ValueError, match="overlap"):
+        ner.merge_shards(output_path, 2, tmp_path)
+
+
+def test_local_shards_match_a_single_process(tmp_path):
+    DOCUMENTS.to_csv(tmp_path / "docs.csv", index=False)
+
+    def run(*options):
+        subprocess.run([sys.executable, ner.__file__, '--csv', "docs.csv", '--mode', "rules", '--no_worker', *options],
+                       cwd=tmp_path, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return pd.read_csv(tmp_path / "docs_ner.csv")
+
+    single = run()
+    sharded = run('--processes', "3")
+
+    assert len(list((tmp_path / "ner_shards").glob("docs_ner.shard*of003.csv"))) == 3
+    pd.testing.assert_frame_equal(sharded, single)